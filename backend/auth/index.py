@@ -6,6 +6,7 @@ import secrets
 import time
 from datetime import datetime, timedelta
 import psycopg2
+import compression
 
 RATE_LIMIT = {}
 MAX_ATTEMPTS = 5
@@ -462,7 +463,8 @@ def handler(event: dict, context) -> dict:
             )
             users = cursor.fetchall()
             
-            return {
+            # Список всех пользователей растет вместе с базой, его тело сжимается по Accept-Encoding
+            return compression.compress_response({
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
@@ -480,7 +482,7 @@ def handler(event: dict, context) -> dict:
                     ]
                 }),
                 'isBase64Encoded': False
-            }
+            }, event)
         
         else:
             return {
@@ -0,0 +1,362 @@
+import base64
+import csv
+import io
+import json
+
+from metering import QuotaExceeded, consume
+from outbox import INSERT_EVENTS_SQL
+
+
+IMPORT_COLUMNS = ('line_no', 'name', 'email', 'phone', 'company', 'status', 'error')
+IMPORT_ERROR_REPORT_LIMIT = 100
+# Страница выгрузки собирается в памяти целиком и уходит одним телом ответа функции
+# (лимит платформы — 3,5 МБ). Клиент в среднем занимает ~150 Б в CSV и ~240 Б в NDJSON,
+# так что 10000 строк — около 2,4 МБ; дальше клиент идет по X-Next-After-Id
+EXPORT_PAGE_SIZE = 5000
+EXPORT_MAX_PAGE_SIZE = 10000
+
+# Заголовки колонок, которые встречаются в выгрузках ERP и в шаблоне импорта
+HEADER_ALIASES = {
+    'name': ('name', 'имя', 'фио'),
+    'email': ('email', 'e-mail', 'почта'),
+    'phone': ('phone', 'телефон', 'номер'),
+    'company': ('company', 'компания', 'юр. лицо'),
+    'status': ('status', 'статус')
+}
+
+
+class MalformedRecord:
+    '''Строка загрузки, которую не удалось разобрать: попадает в отчет об ошибках со своим номером'''
+
+    def __init__(self, error: str):
+        self.error = error
+
+
+class IteratorFile(io.TextIOBase):
+    '''Файлоподобный объект поверх итератора строк для потоковой передачи в COPY'''
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            chunk, self._buffer = self._buffer, ''
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def get_header(event: dict, name: str) -> str:
+    '''Возвращает заголовок запроса без учета регистра'''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value or ''
+    return ''
+
+
+def read_body(event: dict) -> str:
+    '''Возвращает тело запроса с учетом base64-кодирования платформой'''
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8-sig')
+    return body
+
+
+def detect_import_format(event: dict, params: dict) -> str:
+    '''Определяет формат загрузки: csv, ndjson или json'''
+    explicit = (params.get('format') or '').lower()
+    if explicit in ('csv', 'ndjson', 'json'):
+        return explicit
+
+    content_type = get_header(event, 'Content-Type').lower()
+    if 'csv' in content_type:
+        return 'csv'
+    if 'ndjson' in content_type or 'jsonlines' in content_type:
+        return 'ndjson'
+    return 'json'
+
+
+def iter_csv_records(body: str):
+    '''Построчно разбирает CSV с заголовком, сопоставляя колонки по псевдонимам.
+
+    Отдает пары (номер строки файла, запись); заголовок — строка 1, поэтому данные
+    начинаются со строки 2, а запись с переводом строки в кавычках получает номер первой строки.
+    '''
+    reader = csv.reader(io.StringIO(body))
+    header = next(reader, None)
+    if not header:
+        return
+
+    positions = {}
+    for index, title in enumerate(header):
+        title = title.strip().lower()
+        for field, aliases in HEADER_ALIASES.items():
+            if title in aliases and field not in positions:
+                positions[field] = index
+
+    line_no = reader.line_num + 1
+    for row in reader:
+        if any(row):
+            yield line_no, {
+                field: row[index] if index < len(row) else ''
+                for field, index in positions.items()
+            }
+        line_no = reader.line_num + 1
+
+
+def iter_ndjson_records(body: str):
+    '''Построчно разбирает NDJSON; битая строка не прерывает импорт, а становится ошибкой этой строки'''
+    for line_no, line in enumerate(io.StringIO(body), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except json.JSONDecodeError:
+            yield line_no, MalformedRecord('invalid json')
+
+
+def iter_copy_lines(records):
+    '''Превращает пары (номер строки, запись) в CSV-строки для COPY в staging-таблицу'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    for line_no, record in records:
+        error = ''
+        if isinstance(record, MalformedRecord):
+            error, record = record.error, {}
+        elif not isinstance(record, dict):
+            error, record = 'invalid record', {}
+        writer.writerow([
+            line_no,
+            record.get('name') or '',
+            record.get('email') or '',
+            record.get('phone') or '',
+            record.get('company') or '',
+            record.get('status') or '',
+            error
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def import_clients(cursor, conn, event: dict, params: dict):
+    '''Массовый импорт клиентов: COPY в staging-таблицу, нормализация и слияние одним SQL'''
+
+    import_format = detect_import_format(event, params)
+    body = read_body(event)
+    user_id = params.get('user_id')
+
+    if import_format == 'csv':
+        records = iter_csv_records(body)
+    elif import_format == 'ndjson':
+        records = iter_ndjson_records(body)
+    else:
+        # У JSON-массива строк нет: line_no в отчете — номер элемента clients, с 1
+        payload = json.loads(body) if body else {}
+        records = enumerate(payload.get('clients', []) if isinstance(payload, dict) else [], start=1)
+
+    cursor.execute("""
+        CREATE TEMP TABLE clients_import (
+            line_no INTEGER NOT NULL,
+            name TEXT,
+            email TEXT,
+            phone TEXT,
+            company TEXT,
+            status TEXT,
+            error TEXT
+        ) ON COMMIT DROP
+    """)
+
+    cursor.copy_expert(
+        f"COPY clients_import ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        IteratorFile(iter_copy_lines(records))
+    )
+
+    # Нормализация: телефон в формат +7XXXXXXXXXX, email в нижний регистр,
+    # русские названия статусов в значения CHECK-ограничения
+    cursor.execute("""
+        UPDATE clients_import SET
+            name = NULLIF(btrim(name), ''),
+            email = lower(btrim(coalesce(email, ''))),
+            company = NULLIF(btrim(company), ''),
+            phone = CASE
+                WHEN length(digits) = 11 AND left(digits, 1) IN ('7', '8') THEN '+7' || right(digits, 10)
+                WHEN length(digits) = 10 THEN '+7' || digits
+            END,
+            status = CASE lower(btrim(coalesce(status, '')))
+                WHEN '' THEN 'cold'
+                WHEN 'горячий' THEN 'hot'
+                WHEN 'теплый' THEN 'warm'
+                WHEN 'тёплый' THEN 'warm'
+                WHEN 'холодный' THEN 'cold'
+                ELSE lower(btrim(coalesce(status, '')))
+            END
+        FROM (
+            SELECT line_no AS src_line, regexp_replace(phone, '\\D', '', 'g') AS digits
+            FROM clients_import
+        ) normalized
+        WHERE clients_import.line_no = normalized.src_line
+    """)
+
+    cursor.execute("""
+        UPDATE clients_import SET error = CASE
+            WHEN error IS NOT NULL THEN error
+            WHEN name IS NULL THEN 'name is required'
+            WHEN email !~ '^[^@[:space:]]+@[^@[:space:]]+\\.[^@[:space:]]+$' THEN 'invalid email'
+            WHEN phone IS NULL THEN 'invalid phone'
+            WHEN status NOT IN ('hot', 'warm', 'cold') THEN 'invalid status'
+        END
+    """)
+
+    # Повторы email внутри файла схлопываем: побеждает последняя строка.
+    # Статус существующих клиентов при повторном импорте не перезаписываем.
+    # События outbox пишутся тем же запросом: новые клиенты целиком, обновленные — только
+    # перезаписанные поля
+    cursor.execute(f"""
+        WITH merged AS (
+            INSERT INTO clients (name, email, phone, company, status, user_id, last_contact)
+            SELECT DISTINCT ON (email) name, email, phone, company, status, %s::integer, NOW()
+            FROM clients_import
+            WHERE error IS NULL
+            ORDER BY email, line_no DESC
+            ON CONFLICT (lower(email)) WHERE email <> '' DO UPDATE SET
+                name = EXCLUDED.name,
+                phone = EXCLUDED.phone,
+                company = COALESCE(EXCLUDED.company, clients.company),
+                updated_at = NOW()
+            RETURNING id, user_id, name, email, phone, company, status, last_contact, created_at,
+                (xmax = 0) AS inserted
+        ),
+        events AS (
+            {INSERT_EVENTS_SQL}
+            SELECT
+                txid_current(), 'client', CASE WHEN inserted THEN 'insert' ELSE 'update' END, id, user_id,
+                CASE WHEN inserted
+                    THEN jsonb_build_object(
+                        'name', name, 'email', email, 'phone', phone, 'company', company,
+                        'status', status, 'last_contact', last_contact, 'created_at', created_at
+                    )
+                    ELSE jsonb_build_object('name', name, 'phone', phone, 'company', company)
+                END
+            FROM merged
+        )
+        SELECT
+            COUNT(*) FILTER (WHERE inserted) AS inserted,
+            COUNT(*) FILTER (WHERE NOT inserted) AS updated
+        FROM merged
+    """, (user_id,))
+    merge_stats = cursor.fetchone()
+
+    # Новые клиенты списываются из лимита тарифа; при превышении импорт откатывается целиком
+    if user_id and merge_stats['inserted']:
+        try:
+            consume(cursor, user_id, 'clients', merge_stats['inserted'])
+        except QuotaExceeded as e:
+            conn.rollback()
+            return e.as_result()
+
+    cursor.execute("""
+        SELECT
+            COUNT(*) AS total,
+            COUNT(*) FILTER (WHERE error IS NOT NULL) AS rejected
+        FROM clients_import
+    """)
+    totals = cursor.fetchone()
+
+    cursor.execute("""
+        SELECT line_no, error
+        FROM clients_import
+        WHERE error IS NOT NULL
+        ORDER BY line_no
+        LIMIT %s
+    """, (IMPORT_ERROR_REPORT_LIMIT,))
+    errors = [dict(row) for row in cursor.fetchall()]
+
+    conn.commit()
+
+    return {
+        'success': True,
+        'format': import_format,
+        'total': totals['total'],
+        'inserted': merge_stats['inserted'],
+        'updated': merge_stats['updated'],
+        'rejected': totals['rejected'],
+        'duplicates': totals['total'] - totals['rejected'] - merge_stats['inserted'] - merge_stats['updated'],
+        'errors': errors,
+        'errors_truncated': totals['rejected'] > len(errors)
+    }
+
+
+def export_clients(cursor, params: dict) -> dict:
+    '''Постраничная выгрузка клиентов по id через COPY TO STDOUT.
+
+    Страница собирается в памяти и возвращается одним телом, поэтому ее размер ограничен
+    EXPORT_MAX_PAGE_SIZE; следующую страницу клиент запрашивает с after_id из X-Next-After-Id.
+    Возвращает готовый HTTP-ответ либо словарь с ошибкой.
+    '''
+
+    export_format = (params.get('format') or 'csv').lower()
+    if export_format not in ('csv', 'ndjson'):
+        return {'error': 'format must be csv or ndjson'}
+
+    try:
+        after_id = int(params.get('after_id', 0))
+        limit = min(max(int(params.get('limit', EXPORT_PAGE_SIZE)), 1), EXPORT_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'error': 'after_id and limit must be integers'}
+
+    # Граница страницы берется из индекса по первичному ключу, поэтому
+    # сама выгрузка не требует сортировки, а строки не проходят через курсор Python
+    cursor.execute("""
+        SELECT id FROM clients
+        WHERE id > %s
+        ORDER BY id
+        OFFSET %s LIMIT 1
+    """, (after_id, limit - 1))
+    boundary = cursor.fetchone()
+    upper_id = boundary['id'] if boundary else None
+
+    select_sql = cursor.mogrify("""
+        SELECT id, name, email, phone, company, status, last_contact, created_at
+        FROM clients
+        WHERE id > %s AND (%s::integer IS NULL OR id <= %s::integer)
+        ORDER BY id
+    """, (after_id, upper_id, upper_id)).decode('utf-8')
+
+    output = io.BytesIO()
+    if export_format == 'csv':
+        cursor.copy_expert(f"COPY ({select_sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", output)
+        content_type = 'text/csv; charset=utf-8'
+    else:
+        # В CSV-режиме без кавычек и с непечатаемым разделителем JSON выходит без экранирования
+        cursor.copy_expert(
+            f"COPY (SELECT row_to_json(t)::text FROM ({select_sql}) t) TO STDOUT "
+            f"WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')",
+            output
+        )
+        content_type = 'application/x-ndjson; charset=utf-8'
+
+    headers = {
+        'Content-Type': content_type,
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Next-After-Id'
+    }
+    if upper_id is not None:
+        headers['X-Next-After-Id'] = str(upper_id)
+
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': output.getvalue().decode('utf-8')
+    }
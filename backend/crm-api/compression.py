@@ -0,0 +1,93 @@
+import base64
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Меньше порога сжатие не окупается: выигрыш в байтах съедают заголовки и время на CPU
+COMPRESSION_MIN_BYTES = 1400
+
+# Уровни выбраны по benchmarks/compression.py на ответах списков (4,6 МБ звонков):
+# brotli 5 — 845 КБ за 167 мс против 1,09 МБ за 160 мс у gzip 5; gzip 6 и 9 сжимают
+# на 13-17% лучше, но в 2-6 раз дольше. brotli 4 вдвое быстрее, но на транскрипциях
+# из узкого словаря (сид-данные benchmarks) проигрывает gzip 5 по размеру
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/x-ndjson')
+
+
+def accepted_encodings(event: dict) -> dict:
+    '''Кодировки из Accept-Encoding с их q; кодировки с q=0 клиент запретил'''
+    headers = event.get('headers') or {}
+    header = next((value for key, value in headers.items() if key.lower() == 'accept-encoding'), '') or ''
+
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+def choose_encoding(event: dict):
+    '''br, если клиент его принимает и модуль brotli установлен, иначе gzip либо None'''
+    accepted = accepted_encodings(event)
+    wildcard = accepted.get('*', 0.0)
+    candidates = ('br', 'gzip') if brotli is not None else ('gzip',)
+    ranked = [(accepted.get(name, wildcard), -i, name) for i, name in enumerate(candidates)]
+    quality, _, name = max(ranked)
+    return name if quality > 0 else None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY, mode=brotli.MODE_TEXT)
+    # wbits=31 — формат gzip (заголовок и CRC), а не «голый» zlib
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_response(response: dict, event: dict) -> dict:
+    '''Сжимает тело готового ответа по Accept-Encoding запроса.
+
+    Платформа отдает клиенту тело с isBase64Encoded=True уже декодированным, поэтому
+    по сети идут сжатые байты, а base64 существует только между функцией и шлюзом.
+    Маленькие, уже бинарные и несжимаемые по типу ответы возвращаются как есть.
+    '''
+    body = response.get('body')
+    headers = response.get('headers') or {}
+    if response.get('isBase64Encoded') or not isinstance(body, str) or 'Content-Encoding' in headers:
+        return response
+    if not headers.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+        return response
+
+    data = body.encode('utf-8')
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+
+    encoding = choose_encoding(event)
+    if encoding is None:
+        return response
+
+    compressed = compress(data, encoding)
+    if len(compressed) >= len(data):
+        return response
+
+    return {
+        **response,
+        'headers': {**headers, 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+        'body': base64.b64encode(compressed).decode('ascii'),
+        'isBase64Encoded': True
+    }
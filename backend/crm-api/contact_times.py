@@ -0,0 +1,144 @@
+from outbox import INSERT_EVENTS_SQL
+
+
+CONTACT_TIMEZONE = 'Europe/Moscow'
+CONTACT_WINDOWS_DEFAULT = 3
+CONTACT_WINDOWS_MAX = 24
+
+# Сколько звонков клиента «весит» статистика сегмента: пока у клиента мало звонков в этот час,
+# оценка близка к доле успешных по сегменту, с накоплением истории — к его собственной
+SEGMENT_PRIOR_WEIGHT = 5
+
+DAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+# Час недели в часовом поясе клиентов; created_at хранится в UTC
+HOUR_OF_WEEK_SQL = f"""
+    ((EXTRACT(ISODOW FROM (c.created_at AT TIME ZONE 'UTC') AT TIME ZONE '{CONTACT_TIMEZONE}') - 1) * 24
+     + EXTRACT(HOUR FROM (c.created_at AT TIME ZONE 'UTC') AT TIME ZONE '{CONTACT_TIMEZONE}'))::smallint
+"""
+
+
+def record_call_completion(cursor, call_id: int) -> bool:
+    '''Учитывает исход завершенного звонка в часе недели клиента и его сегмента.
+
+    Один запрос: отметка completed_at служит защитой от повторного вебхука, счетчики
+    клиента и сегмента увеличиваются только если звонок отмечен впервые. Тем же запросом
+    сдвигается last_contact клиента (по нему строятся сегменты no_contact_days) и пишется
+    событие outbox об этом изменении.
+    Вызывается в конце транзакции вебхука, чтобы строка сегмента была заблокирована недолго.
+    '''
+    cursor.execute(f"""
+        WITH done AS (
+            UPDATE calls c
+            SET completed_at = NOW()
+            FROM clients cl
+            WHERE c.id = %s AND c.completed_at IS NULL AND cl.id = c.client_id
+            RETURNING c.client_id, cl.status AS segment, {HOUR_OF_WEEK_SQL} AS hour_of_week,
+                (c.status = 'success')::int AS success
+        ), contacted AS (
+            UPDATE clients cl
+            SET last_contact = GREATEST(cl.last_contact, NOW())
+            FROM done
+            WHERE cl.id = done.client_id
+            RETURNING cl.id, cl.user_id, cl.last_contact
+        ), contact_events AS (
+            {INSERT_EVENTS_SQL}
+            SELECT txid_current(), 'client', 'update', id, user_id, jsonb_build_object('last_contact', last_contact)
+            FROM contacted
+        ), client_hours AS (
+            INSERT INTO client_contact_hours (client_id, hour_of_week, attempts, successes)
+            SELECT client_id, hour_of_week, 1, success FROM done
+            ON CONFLICT (client_id, hour_of_week) DO UPDATE
+            SET attempts = client_contact_hours.attempts + 1,
+                successes = client_contact_hours.successes + EXCLUDED.successes
+        )
+        INSERT INTO segment_contact_hours (segment, hour_of_week, attempts, successes)
+        SELECT segment, hour_of_week, 1, success FROM done
+        ON CONFLICT (segment, hour_of_week) DO UPDATE
+        SET attempts = segment_contact_hours.attempts + 1,
+            successes = segment_contact_hours.successes + EXCLUDED.successes
+    """, (call_id,))
+    return cursor.rowcount > 0
+
+
+def window_label(hour_of_week: int) -> str:
+    day, hour = divmod(hour_of_week, 24)
+    return f'{DAY_NAMES[day]} {hour:02d}:00–{(hour + 1) % 24:02d}:00'
+
+
+def best_windows(client_rows: list, segment_rows: list, limit: int) -> list:
+    '''Часы недели по убыванию оценки доли успешных звонков.
+
+    Доля по сегменту сглажена (успешные + 1) / (все + 2) и служит априорной оценкой
+    для клиента; часы без единого звонка ни у клиента, ни в сегменте не предлагаются.
+    '''
+    client = {row['hour_of_week']: row for row in client_rows}
+    segment = {row['hour_of_week']: row for row in segment_rows}
+
+    windows = []
+    for hour_of_week in client.keys() | segment.keys():
+        seg = segment.get(hour_of_week) or {'attempts': 0, 'successes': 0}
+        own = client.get(hour_of_week) or {'attempts': 0, 'successes': 0}
+        prior = (seg['successes'] + 1) / (seg['attempts'] + 2)
+        rate = (own['successes'] + SEGMENT_PRIOR_WEIGHT * prior) / (own['attempts'] + SEGMENT_PRIOR_WEIGHT)
+        windows.append({
+            'hour_of_week': hour_of_week,
+            'label': window_label(hour_of_week),
+            'success_rate': round(rate, 3),
+            'client_attempts': own['attempts'],
+            'client_successes': own['successes'],
+            'segment_attempts': seg['attempts'],
+            'segment_successes': seg['successes']
+        })
+
+    windows.sort(key=lambda w: (-w['success_rate'], -w['client_attempts'], w['hour_of_week']))
+    return windows[:limit]
+
+
+def contact_windows(cursor, client_id: int, limit: int = CONTACT_WINDOWS_DEFAULT) -> dict:
+    '''Лучшие часы для звонка клиенту: одно чтение по первичным ключам статистики клиента и сегмента'''
+    cursor.execute("""
+        SELECT 'client' AS scope, hour_of_week, attempts, successes
+        FROM client_contact_hours
+        WHERE client_id = %(client_id)s
+        UNION ALL
+        SELECT 'segment', hour_of_week, attempts, successes
+        FROM segment_contact_hours
+        WHERE segment = (SELECT status FROM clients WHERE id = %(client_id)s)
+    """, {'client_id': client_id})
+    rows = cursor.fetchall()
+
+    client_rows = [row for row in rows if row['scope'] == 'client']
+    segment_rows = [row for row in rows if row['scope'] == 'segment']
+    return {
+        'client_id': client_id,
+        'timezone': CONTACT_TIMEZONE,
+        'client_attempts': sum(row['attempts'] for row in client_rows),
+        'segment_attempts': sum(row['attempts'] for row in segment_rows),
+        'windows': best_windows(client_rows, segment_rows, limit)
+    }
+
+
+def get_contact_windows(cursor, params):
+    '''Лучшие часы для звонка клиенту по параметрам запроса client_id и limit'''
+    try:
+        client_id = int(params.get('client_id') or 0)
+        limit = min(max(int(params.get('limit', CONTACT_WINDOWS_DEFAULT)), 1), CONTACT_WINDOWS_MAX)
+    except (TypeError, ValueError):
+        return {'error': 'client_id and limit must be integers'}
+    if not client_id:
+        return {'error': 'client_id is required'}
+    return contact_windows(cursor, client_id, limit)
+
+
+def describe_windows(contact: dict) -> str:
+    '''Текст для промпта: лучшие окна со статистикой, на которой основана оценка'''
+    if not contact['windows']:
+        return 'Статистики звонков пока нет'
+    lines = [
+        f"- {w['label']}: оценка дозвона {round(w['success_rate'] * 100)}% "
+        f"(у клиента {w['client_successes']}/{w['client_attempts']}, "
+        f"в сегменте {w['segment_successes']}/{w['segment_attempts']})"
+        for w in contact['windows']
+    ]
+    return '\n'.join(lines)
@@ -0,0 +1,426 @@
+import contextvars
+import json
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+import outbox
+from metering import QuotaExceeded, consume
+
+
+DIALER_BATCH_SIZE = 50
+DIALER_TIME_BUDGET_SECONDS = 50
+DIALER_IDLE_SLEEP_SECONDS = 0.2
+DIALER_STALE_CLAIM_MINUTES = 5
+DEFAULT_CONCURRENCY = 5
+DEFAULT_CALLS_PER_MINUTE = 30
+MAX_CONCURRENCY = 50
+MAX_CALLS_PER_MINUTE = 600
+CLIENT_STATUSES = ('hot', 'warm', 'cold')
+CAMPAIGN_STATUSES = ('running', 'paused', 'cancelled')
+
+
+def parse_segment(segment) -> dict:
+    '''Проверяет фильтр сегмента: статусы клиентов и окно последнего контакта'''
+    if not isinstance(segment, dict):
+        raise ValueError('segment must be an object')
+
+    statuses = segment.get('status')
+    if isinstance(statuses, str):
+        statuses = [statuses]
+    if statuses:
+        invalid = [status for status in statuses if status not in CLIENT_STATUSES]
+        if invalid:
+            raise ValueError(f'Invalid client status: {", ".join(map(str, invalid))}')
+
+    bounds = {}
+    for key in ('last_contact_from', 'last_contact_to'):
+        if segment.get(key):
+            try:
+                bounds[key] = datetime.fromisoformat(str(segment[key]))
+            except ValueError:
+                raise ValueError(f'{key} must be an ISO date')
+
+    # no_contact_days: не звонили N дней и дольше. last_contact задан у каждого клиента
+    # (при создании — время создания) и сдвигается набором и завершением звонка
+    if segment.get('no_contact_days') is not None:
+        cutoff = datetime.now() - timedelta(days=int(segment['no_contact_days']))
+        bounds['last_contact_to'] = min(bounds.get('last_contact_to', cutoff), cutoff)
+
+    return {
+        'statuses': list(statuses) if statuses else None,
+        'last_contact_from': bounds.get('last_contact_from'),
+        'last_contact_to': bounds.get('last_contact_to')
+    }
+
+
+def create_dial_campaign(cursor, conn, body):
+    '''Создает кампанию обзвона и ставит в очередь весь сегмент одним INSERT ... SELECT'''
+    if not isinstance(body, dict):
+        return {'error': 'Invalid body format'}
+
+    name = str(body.get('name') or '').strip()
+    if not name:
+        return {'error': 'name is required'}
+    try:
+        segment = parse_segment(body.get('segment') or {})
+        concurrency = int(body.get('concurrency') or DEFAULT_CONCURRENCY)
+        calls_per_minute = int(body.get('calls_per_minute') or DEFAULT_CALLS_PER_MINUTE)
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}
+    if not 0 < concurrency <= MAX_CONCURRENCY:
+        return {'error': f'concurrency must be between 1 and {MAX_CONCURRENCY}'}
+    if not 0 < calls_per_minute <= MAX_CALLS_PER_MINUTE:
+        return {'error': f'calls_per_minute must be between 1 and {MAX_CALLS_PER_MINUTE}'}
+    user_id = body.get('user_id')
+
+    cursor.execute("""
+        INSERT INTO dial_campaigns (name, user_id, segment, concurrency, calls_per_minute, tokens)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (name, user_id, json.dumps(body.get('segment') or {}, ensure_ascii=False),
+          concurrency, calls_per_minute, concurrency))
+    campaign_id = cursor.fetchone()['id']
+
+    cursor.execute("""
+        WITH queued AS (
+            INSERT INTO dial_queue (campaign_id, client_id, phone)
+            SELECT %(campaign_id)s, c.id, c.phone
+            FROM clients c
+            WHERE (%(statuses)s::text[] IS NULL OR c.status = ANY(%(statuses)s::text[]))
+            AND (%(last_contact_from)s::timestamp IS NULL OR c.last_contact >= %(last_contact_from)s::timestamp)
+            AND (%(last_contact_to)s::timestamp IS NULL OR c.last_contact < %(last_contact_to)s::timestamp)
+            AND (%(user_id)s::integer IS NULL OR c.user_id = %(user_id)s::integer)
+            AND c.phone <> ''
+            ORDER BY c.last_contact
+            RETURNING 1
+        )
+        UPDATE dial_campaigns
+        SET total = (SELECT COUNT(*) FROM queued),
+            status = CASE WHEN (SELECT COUNT(*) FROM queued) = 0 THEN 'completed' ELSE status END
+        WHERE id = %(campaign_id)s
+        RETURNING total, status
+    """, {'campaign_id': campaign_id, 'user_id': user_id, **segment})
+    campaign = cursor.fetchone()
+    conn.commit()
+
+    return {
+        'success': True,
+        'campaign_id': campaign_id,
+        'queued': campaign['total'],
+        'status': campaign['status']
+    }
+
+
+def update_dial_campaign(cursor, conn, body):
+    '''Пауза, возобновление или отмена кампании; отмена снимает с очереди еще не набранные номера'''
+    campaign_id = body.get('campaign_id') if isinstance(body, dict) else None
+    status = body.get('status') if isinstance(body, dict) else None
+    if not campaign_id or status not in CAMPAIGN_STATUSES:
+        return {'error': f'campaign_id and status ({", ".join(CAMPAIGN_STATUSES)}) are required'}
+
+    cursor.execute("""
+        UPDATE dial_campaigns
+        SET status = %s, error = NULL, updated_at = NOW()
+        WHERE id = %s AND status NOT IN ('completed', 'cancelled')
+        RETURNING id, status
+    """, (status, campaign_id))
+    updated = cursor.fetchone()
+    if updated and status == 'cancelled':
+        cursor.execute("""
+            UPDATE dial_queue
+            SET status = 'failed', error = 'Campaign cancelled', updated_at = NOW()
+            WHERE campaign_id = %s AND status = 'pending'
+        """, (campaign_id,))
+    conn.commit()
+
+    if not updated:
+        return {'success': False, 'error': 'Campaign not found or already finished'}
+    return {'success': True, 'campaign_id': updated['id'], 'status': updated['status']}
+
+
+def get_dial_campaign(cursor, params):
+    '''Кампания и прогресс очереди по статусам'''
+    campaign_id = params.get('campaign_id')
+    if not campaign_id:
+        return {'error': 'campaign_id is required'}
+
+    cursor.execute("""
+        SELECT
+            d.id, d.name, d.status, d.segment, d.concurrency, d.calls_per_minute,
+            d.total, d.error, d.created_at, d.updated_at,
+            COUNT(*) FILTER (WHERE q.status = 'pending') AS pending,
+            COUNT(*) FILTER (WHERE q.status = 'dialing') AS dialing,
+            COUNT(*) FILTER (WHERE q.status = 'done') AS done,
+            COUNT(*) FILTER (WHERE q.status = 'failed') AS failed
+        FROM dial_campaigns d
+        LEFT JOIN dial_queue q ON q.campaign_id = d.id
+        WHERE d.id = %s
+        GROUP BY d.id
+    """, (campaign_id,))
+    campaign = cursor.fetchone()
+    if not campaign:
+        return {'error': 'Campaign not found'}
+    return {'campaign': campaign}
+
+
+def claim_dial_batch(cursor, conn, campaign_id: int, worker: str, batch_size: int = DIALER_BATCH_SIZE) -> list:
+    '''Захватывает номера кампании в пределах ее бюджета.
+
+    Строка кампании блокируется, поэтому воркеры делят бюджет последовательно:
+    слотов не больше min(токенов в ведре, concurrency - уже набираемых, batch_size).
+    Ведро пополняется со скоростью calls_per_minute и вмещает не больше concurrency
+    токенов, так что звонки идут равномерно, а не пачкой в начале минуты.
+    '''
+    cursor.execute("""
+        WITH campaign AS (
+            SELECT
+                id,
+                concurrency,
+                LEAST(
+                    concurrency::real,
+                    tokens + EXTRACT(EPOCH FROM clock_timestamp() - tokens_at) * calls_per_minute / 60.0
+                ) AS tokens
+            FROM dial_campaigns
+            WHERE id = %(campaign_id)s AND status = 'running'
+            FOR UPDATE
+        ),
+        budget AS (
+            SELECT
+                c.id,
+                c.tokens,
+                GREATEST(0, LEAST(
+                    FLOOR(c.tokens)::integer,
+                    c.concurrency - (
+                        SELECT COUNT(*) FROM dial_queue q
+                        WHERE q.campaign_id = c.id AND q.status = 'dialing'
+                    ),
+                    %(batch_size)s
+                )) AS slots
+            FROM campaign c
+        ),
+        next AS (
+            SELECT q.id
+            FROM dial_queue q
+            WHERE q.campaign_id = %(campaign_id)s AND q.status = 'pending'
+            ORDER BY q.id
+            LIMIT (SELECT COALESCE(MAX(slots), 0) FROM budget)
+            FOR UPDATE SKIP LOCKED
+        ),
+        claimed AS (
+            UPDATE dial_queue q
+            SET status = 'dialing', claimed_by = %(worker)s, claimed_at = NOW(), updated_at = NOW()
+            FROM next
+            WHERE q.id = next.id
+            RETURNING q.id, q.client_id, q.phone
+        ),
+        spent AS (
+            UPDATE dial_campaigns d
+            SET tokens = b.tokens - (SELECT COUNT(*) FROM claimed),
+                tokens_at = clock_timestamp()
+            FROM budget b
+            WHERE d.id = b.id
+        )
+        SELECT id, client_id, phone FROM claimed ORDER BY id
+    """, {'campaign_id': campaign_id, 'worker': worker, 'batch_size': batch_size})
+    batch = [dict(row) for row in cursor.fetchall()]
+    conn.commit()
+    return batch
+
+
+def release_stale_claims(cursor, conn):
+    '''Номера, захваченные упавшим воркером: набор мог уйти, поэтому не повторяем, а помечаем ошибкой'''
+    cursor.execute(f"""
+        UPDATE dial_queue
+        SET status = 'failed', error = 'Dialer worker lost', updated_at = NOW()
+        WHERE status = 'dialing'
+        AND claimed_at < NOW() - INTERVAL '{DIALER_STALE_CLAIM_MINUTES} minutes'
+    """)
+    conn.commit()
+
+
+def finish_campaigns(cursor, conn, campaign_ids: list) -> list:
+    '''Переводит в completed кампании, в очереди которых не осталось номеров'''
+    cursor.execute("""
+        UPDATE dial_campaigns d
+        SET status = 'completed', updated_at = NOW()
+        WHERE d.id = ANY(%s) AND d.status = 'running'
+        AND NOT EXISTS (
+            SELECT 1 FROM dial_queue q
+            WHERE q.campaign_id = d.id AND q.status IN ('pending', 'dialing')
+        )
+        RETURNING d.id
+    """, (campaign_ids,))
+    finished = [row['id'] for row in cursor.fetchall()]
+    conn.commit()
+    return finished
+
+
+def dial_batch(cursor, conn, campaign: dict, batch: list, executor) -> dict:
+    '''Записи звонков одной вставкой, параллельные callback MANGO, исходы двумя UPDATE'''
+    import mango
+
+    creds = mango.credentials()
+    initial_result = 'Инициируется...' if creds else 'Ожидание настройки MANGO OFFICE API'
+    rows = execute_values(cursor, """
+        INSERT INTO calls (client_id, status, duration, result, user_id, created_at)
+        VALUES %s
+        RETURNING id, user_id, client_id, status, duration, result, created_at
+    """, [
+        (item['client_id'], 'pending', '0:00', initial_result, campaign['user_id'])
+        for item in batch
+    ], template="(%s, %s, %s, %s, %s::integer, NOW())", fetch=True)
+    call_ids = {row['client_id']: row['id'] for row in rows}
+    for item in batch:
+        item['call_id'] = call_ids[item['client_id']]
+    outbox.record(cursor, 'call', 'insert', [dict(row) for row in rows])
+    # Звонки фиксируются до набора: вебхук MANGO может прийти раньше ответа на callback
+    conn.commit()
+
+    def dial(item):
+        try:
+            command_id, _ = mango.request_callback(item['call_id'], item['phone'], creds)
+            return 'success', f'Звонок инициирован через MANGO OFFICE (command_id: {command_id})', None
+        except Exception as e:
+            error = mango.error_message(e)
+            return 'failed', f'Ошибка MANGO OFFICE: {error}', error
+
+    if creds:
+        # Контекст копируется здесь, чтобы вызовы MANGO попали в Trace вызова
+        futures = [executor.submit(contextvars.copy_context().run, dial, item) for item in batch]
+        outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [('pending', initial_result, None)] * len(batch)
+
+    execute_values(cursor, """
+        UPDATE calls c
+        SET status = v.status, result = v.result
+        FROM (VALUES %s) AS v(id, status, result)
+        WHERE c.id = v.id
+    """, [
+        (item['call_id'], status, result)
+        for item, (status, result, _) in zip(batch, outcomes)
+    ], template='(%s::integer, %s, %s)')
+    outbox.record(cursor, 'call', 'update', [
+        {'id': item['call_id'], 'user_id': campaign['user_id'], 'status': status, 'result': result}
+        for item, (status, result, _) in zip(batch, outcomes)
+    ])
+    # Инициированный звонок — контакт: повторная кампания по no_contact_days клиента не возьмет
+    dialed = [item['client_id'] for item, (status, _, _) in zip(batch, outcomes) if status == 'success']
+    if dialed:
+        contacted = execute_values(cursor, """
+            UPDATE clients c
+            SET last_contact = GREATEST(c.last_contact, NOW())
+            FROM (VALUES %s) AS v(id)
+            WHERE c.id = v.id
+            RETURNING c.id, c.user_id, c.last_contact
+        """, [(client_id,) for client_id in dialed], template='(%s::integer)', fetch=True)
+        outbox.record(cursor, 'client', 'update', [dict(row) for row in contacted])
+    execute_values(cursor, """
+        UPDATE dial_queue q
+        SET status = v.status, call_id = v.call_id, error = v.error, updated_at = NOW()
+        FROM (VALUES %s) AS v(id, status, call_id, error)
+        WHERE q.id = v.id
+    """, [
+        (item['id'], 'failed' if status == 'failed' else 'done', item['call_id'], error)
+        for item, (status, _, error) in zip(batch, outcomes)
+    ], template='(%s::bigint, %s, %s::integer, %s)')
+    conn.commit()
+
+    failed = sum(1 for status, _, _ in outcomes if status == 'failed')
+    return {'dialed': len(batch) - failed, 'failed': failed}
+
+
+def run_dialer(cursor, conn, body):
+    '''Воркер обзвона: разбирает общую очередь запущенных кампаний в пределах их бюджетов.
+
+    Несколько воркеров можно запускать одновременно: номера захватываются с
+    SKIP LOCKED, а concurrency и calls_per_minute кампании действуют на всех сразу.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    body = body if isinstance(body, dict) else {}
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    batch_size = min(int(body.get('batch_size') or DIALER_BATCH_SIZE), DIALER_BATCH_SIZE)
+    deadline = time.monotonic() + min(float(body.get('time_budget') or DIALER_TIME_BUDGET_SECONDS),
+                                      DIALER_TIME_BUDGET_SECONDS)
+
+    release_stale_claims(cursor, conn)
+
+    cursor.execute("""
+        SELECT id, user_id, concurrency, calls_per_minute
+        FROM dial_campaigns
+        WHERE status = 'running' AND (%(campaign_id)s::integer IS NULL OR id = %(campaign_id)s::integer)
+        ORDER BY id
+    """, {'campaign_id': body.get('campaign_id')})
+    campaigns = {row['id']: dict(row) for row in cursor.fetchall()}
+    conn.commit()
+
+    totals = {'dialed': 0, 'failed': 0, 'batches': 0}
+    paused = {}
+    if not campaigns:
+        return {'success': True, **totals, 'completed_campaigns': [], 'paused_campaigns': paused}
+
+    workers = max(campaign['concurrency'] for campaign in campaigns.values())
+    active = list(campaigns)
+    completed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while active and time.monotonic() < deadline:
+            claimed_any = False
+            for campaign_id in list(active):
+                campaign = campaigns[campaign_id]
+                batch = claim_dial_batch(cursor, conn, campaign_id, worker, batch_size)
+                if not batch:
+                    continue
+                claimed_any = True
+
+                if campaign['user_id']:
+                    try:
+                        consume(cursor, campaign['user_id'], 'calls', len(batch))
+                    except QuotaExceeded as e:
+                        conn.rollback()
+                        pause_for_quota(cursor, conn, campaign_id, [item['id'] for item in batch], e)
+                        paused[campaign_id] = e.as_result()['error']
+                        active.remove(campaign_id)
+                        continue
+
+                outcome = dial_batch(cursor, conn, campaign, batch, executor)
+                totals['dialed'] += outcome['dialed']
+                totals['failed'] += outcome['failed']
+                totals['batches'] += 1
+
+            if not claimed_any:
+                finished = finish_campaigns(cursor, conn, active)
+                completed.extend(finished)
+                active = [campaign_id for campaign_id in active if campaign_id not in finished]
+                if active:
+                    # Бюджет исчерпан или номера набирают другие воркеры: ждем следующего токена
+                    time.sleep(max(DIALER_IDLE_SLEEP_SECONDS, min(
+                        60.0 / campaigns[campaign_id]['calls_per_minute'] for campaign_id in active
+                    )))
+
+    return {
+        'success': True,
+        **totals,
+        'completed_campaigns': completed,
+        'paused_campaigns': paused
+    }
+
+
+def pause_for_quota(cursor, conn, campaign_id: int, queue_ids: list, error: QuotaExceeded):
+    '''Квота звонков исчерпана: возвращаем захваченные номера в очередь и ставим кампанию на паузу'''
+    cursor.execute("""
+        UPDATE dial_queue
+        SET status = 'pending', claimed_by = NULL, claimed_at = NULL, updated_at = NOW()
+        WHERE id = ANY(%s)
+    """, (queue_ids,))
+    cursor.execute("""
+        UPDATE dial_campaigns
+        SET status = 'paused', error = %s, updated_at = NOW()
+        WHERE id = %s
+    """, (error.as_result()['error'], campaign_id))
+    conn.commit()
@@ -1,8 +1,19 @@
 import json
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
+import serialization
+import compression
+from instrumentation import TracedCursor, instrumented
+from metering import QuotaExceeded, consume
+import outbox
+
+
+# GET-пути с ETag: сущности outbox и счетчики data_versions, от которых зависит ответ
+ETAG_SOURCES = {
+    'stats': (('client', 'call'), ('email_campaigns',)),
+    'clients': (('client',), ('lead_scores',)),
+    'calls': (('call', 'client'), ())
+}
 
 
 def get_db_connection():
@@ -10,9 +21,10 @@ def get_db_connection():
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
         raise Exception('DATABASE_URL environment variable is not set')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    return psycopg2.connect(dsn, cursor_factory=TracedCursor)
 
 
+@instrumented('crm-api')
 def handler(event: dict, context) -> dict:
     '''Универсальный API для AVT CRM системы с функциями статистики, управления клиентами, звонками и вебхуками MANGO OFFICE'''
     
@@ -25,7 +37,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -39,6 +51,17 @@ def handler(event: dict, context) -> dict:
         params = event.get('queryStringParameters', {}) or {}
         path = params.get('path', 'stats')
         
+        # Версия ответа читается одним запросом по индексам; если у клиента она та же,
+        # сам запрос и сериализация не выполняются
+        etag = None
+        if method == 'GET' and path in ETAG_SOURCES:
+            entities, tables = ETAG_SOURCES[path]
+            etag = f'W/"{path}-{outbox.version_stamp(cursor, entities, tables)}"'
+            if etag_matches(event, etag):
+                cursor.close()
+                conn.close()
+                return not_modified_response(etag)
+        
         if method == 'GET':
             if path == 'stats':
                 result = get_statistics(cursor)
@@ -46,9 +69,40 @@ def handler(event: dict, context) -> dict:
                 result = get_clients(cursor)
             elif path == 'calls':
                 result = get_calls(cursor)
+            elif path == 'search_calls':
+                result = search_calls(cursor, params)
+            elif path == 'scenarios':
+                from scenarios import get_scenarios
+                result = get_scenarios(cursor)
+            elif path == 'dial_campaign':
+                from dialer import get_dial_campaign
+                result = get_dial_campaign(cursor, params)
+            elif path == 'contact_windows':
+                from contact_times import get_contact_windows
+                result = get_contact_windows(cursor, params)
+            elif path == 'suggestions':
+                from suggestions import get_suggestions
+                result = get_suggestions(cursor, params)
+            elif path == 'lead_scores':
+                from scoring import get_lead_scores
+                result = get_lead_scores(cursor, params)
+            elif path == 'changes':
+                result = outbox.get_changes(cursor, params, ('client', 'call'))
+            elif path == 'export_clients':
+                from clients_bulk import export_clients
+                result = export_clients(cursor, params)
+                if 'statusCode' in result:
+                    cursor.close()
+                    conn.close()
+                    return compression.compress_response(result, event)
             else:
                 result = {'error': 'Unknown path'}
         
+        elif method == 'POST' and path == 'import_clients':
+            # Тело импорта может быть CSV или NDJSON, поэтому не разбираем его как JSON
+            from clients_bulk import import_clients
+            result = import_clients(cursor, conn, event, params)
+        
         elif method == 'POST':
             body_str = event.get('body', '{}')
             body = json.loads(body_str) if body_str else {}
@@ -61,6 +115,36 @@ def handler(event: dict, context) -> dict:
                 result = ai_analyze_call(cursor, body)
             elif path == 'ai_suggest':
                 result = ai_suggest_action(cursor, body)
+            elif path == 'save_scenario':
+                from scenarios import save_scenario
+                result = save_scenario(cursor, conn, body)
+            elif path == 'delete_scenario':
+                from scenarios import delete_scenario
+                result = delete_scenario(cursor, conn, body)
+            elif path == 'start_scenario':
+                from scenarios import start_scenario
+                result = start_scenario(cursor, conn, body)
+            elif path == 'advance_scenario':
+                from scenarios import advance_scenario
+                result = advance_scenario(cursor, conn, body)
+            elif path == 'create_dial_campaign':
+                from dialer import create_dial_campaign
+                result = create_dial_campaign(cursor, conn, body)
+            elif path == 'update_dial_campaign':
+                from dialer import update_dial_campaign
+                result = update_dial_campaign(cursor, conn, body)
+            elif path == 'run_dialer':
+                from dialer import run_dialer
+                result = run_dialer(cursor, conn, body)
+            elif path == 'create_suggestion_job':
+                from suggestions import create_suggestion_job
+                result = create_suggestion_job(cursor, conn, body)
+            elif path == 'run_suggestion_job':
+                from suggestions import run_suggestion_job
+                result = run_suggestion_job(cursor, conn, body)
+            elif path == 'recompute_scores':
+                from scoring import recompute_scores
+                result = recompute_scores(cursor, conn, body)
             else:
                 result = {'error': 'Unknown path'}
         
@@ -70,7 +154,7 @@ def handler(event: dict, context) -> dict:
         cursor.close()
         conn.close()
         
-        return success_response(result)
+        return compression.compress_response(success_response(result, etag), event)
     
     except Exception as e:
         return error_response(str(e))
@@ -128,22 +212,15 @@ def get_clients(cursor):
     
     cursor.execute("""
         SELECT 
-            id, name, email, phone, status, 
-            last_contact, created_at
-        FROM clients
-        ORDER BY last_contact DESC
+            c.id, c.name, c.email, c.phone, c.status, 
+            c.last_contact, c.created_at, s.score
+        FROM clients c
+        LEFT JOIN lead_scores s ON s.client_id = c.id
+        ORDER BY c.last_contact DESC
     """)
     
-    clients = cursor.fetchall()
-    
-    # Конвертируем datetime в строки
-    for client in clients:
-        if client['last_contact']:
-            client['last_contact'] = client['last_contact'].isoformat()
-        if client['created_at']:
-            client['created_at'] = client['created_at'].isoformat()
-    
-    return {'clients': [dict(c) for c in clients]}
+    # Строки курсора и даты сериализует success_response, без копирования и обхода
+    return {'clients': cursor.fetchall()}
 
 
 def get_calls(cursor):
@@ -160,14 +237,95 @@ def get_calls(cursor):
         ORDER BY c.created_at DESC
     """)
     
-    calls = cursor.fetchall()
+    return {'calls': cursor.fetchall()}
+
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5, FragmentDelimiter=" … "'
+
+
+def search_calls(cursor, params):
+    '''Полнотекстовый поиск по транскрипциям, заметкам и результатам звонков с keyset-пагинацией'''
+    
+    query = (params.get('q') or '').strip()
+    if not query:
+        return {'error': 'q is required'}
     
-    # Конвертируем datetime в строки
-    for call in calls:
-        if call['created_at']:
-            call['created_at'] = call['created_at'].isoformat()
+    sort = params.get('sort', 'rank')
+    if sort not in ('rank', 'recent'):
+        return {'error': 'sort must be rank or recent'}
     
-    return {'calls': [dict(c) for c in calls]}
+    try:
+        limit = min(max(int(params.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'error': 'limit must be an integer'}
+    
+    # Курсор имеет вид "<ключ сортировки>|<id>" и возвращается клиенту как есть
+    after_key, after_id = None, None
+    page_cursor = params.get('cursor')
+    if page_cursor:
+        try:
+            after_key, after_id = page_cursor.rsplit('|', 1)
+            after_id = int(after_id)
+        except ValueError:
+            return {'error': 'Invalid cursor'}
+    
+    # Сначала по GIN-индексу выбираем только id страницы, а дорогой ts_headline
+    # считаем уже для найденных строк
+    if sort == 'rank':
+        keyset = "AND (ts_rank_cd(c.search_vector, q.query), c.id) < (%s::real, %s)"
+        order_by = "rank DESC, c.id DESC"
+        page_order_by = "page.rank DESC, page.id DESC"
+    else:
+        keyset = "AND (c.created_at, c.id) < (%s::timestamp, %s)"
+        order_by = "c.created_at DESC, c.id DESC"
+        page_order_by = "page.created_at DESC, page.id DESC"
+    
+    sql_params = [query]
+    if after_id is not None:
+        sql_params.extend([after_key, after_id])
+    sql_params.extend([limit + 1, SEARCH_HEADLINE_OPTIONS, SEARCH_HEADLINE_OPTIONS])
+    
+    cursor.execute(f"""
+        WITH q AS (SELECT websearch_to_tsquery('russian', %s) AS query),
+        page AS (
+            SELECT c.id, c.created_at, ts_rank_cd(c.search_vector, q.query) AS rank
+            FROM calls c, q
+            WHERE c.search_vector @@ q.query
+            {keyset if after_id is not None else ''}
+            ORDER BY {order_by}
+            LIMIT %s
+        )
+        SELECT 
+            c.id, c.client_id, c.status, c.duration, c.result, 
+            c.created_at, c.recording_url,
+            cl.name as client_name, cl.phone as client_phone,
+            page.rank,
+            ts_headline('russian', coalesce(c.transcript, ''), q.query, %s) as transcript_snippet,
+            ts_headline('russian', coalesce(c.notes, ''), q.query, %s) as notes_snippet
+        FROM page
+        JOIN calls c ON c.id = page.id
+        LEFT JOIN clients cl ON c.client_id = cl.id
+        CROSS JOIN q
+        ORDER BY {page_order_by}
+    """, sql_params)
+    
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        last_key = repr(last['rank']) if sort == 'rank' else last['created_at'].isoformat()
+        next_cursor = f"{last_key}|{last['id']}"
+    
+    return {
+        'calls': rows,
+        'next_cursor': next_cursor,
+        'sort': sort
+    }
 
 
 def initiate_call(cursor, conn, body):
@@ -182,21 +340,32 @@ def initiate_call(cursor, conn, body):
     if not client_id or not phone:
         return {'error': 'client_id and phone are required'}
     
+    # Звонок списывается из месячной квоты тарифа в одной транзакции с записью звонка
+    user_id = body.get('user_id')
+    if user_id:
+        try:
+            consume(cursor, user_id, 'calls')
+        except QuotaExceeded as e:
+            conn.rollback()
+            return e.as_result()
+    
+    import mango
+    import http_client
+    
     # Получаем учетные данные MANGO OFFICE
-    vpbx_api_key = os.environ.get('MANGO_VPBX_API_KEY')
-    vpbx_api_salt = os.environ.get('MANGO_VPBX_API_SALT')
-    from_extension = os.environ.get('MANGO_FROM_EXTENSION')
-    from_number = os.environ.get('MANGO_FROM_NUMBER')
+    creds = mango.credentials()
     
-    if not all([vpbx_api_key, vpbx_api_salt, from_extension]):
+    if creds is None:
         # Если credentials не настроены, создаем запись в БД без реального звонка
         cursor.execute("""
-            INSERT INTO calls (client_id, status, duration, result, created_at)
-            VALUES (%s, %s, %s, %s, NOW())
-            RETURNING id
-        """, (client_id, 'pending', '0:00', 'Ожидание настройки MANGO OFFICE API'))
+            INSERT INTO calls (client_id, status, duration, result, user_id, created_at)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+            RETURNING id, user_id, client_id, status, duration, result, created_at
+        """, (client_id, 'pending', '0:00', 'Ожидание настройки MANGO OFFICE API', user_id))
         
-        call_id = cursor.fetchone()['id']
+        call = dict(cursor.fetchone())
+        call_id = call['id']
+        outbox.record(cursor, 'call', 'insert', [call])
         conn.commit()
         
         return {
@@ -209,92 +378,49 @@ def initiate_call(cursor, conn, body):
     
     # Создаем запись звонка в БД
     cursor.execute("""
-        INSERT INTO calls (client_id, status, duration, result, created_at)
-        VALUES (%s, %s, %s, %s, NOW())
-        RETURNING id
-    """, (client_id, 'pending', '0:00', 'Инициируется...'))
-    
-    call_id = cursor.fetchone()['id']
+        INSERT INTO calls (client_id, status, duration, result, user_id, created_at)
+        VALUES (%s, %s, %s, %s, %s, NOW())
+        RETURNING id, user_id, client_id, status, duration, result, created_at
+    """, (client_id, 'pending', '0:00', 'Инициируется...', user_id))
+    
+    call = dict(cursor.fetchone())
+    call_id = call['id']
+    outbox.record(cursor, 'call', 'insert', [call])
     conn.commit()
     
     try:
-        import urllib.request
-        import urllib.parse
-        import hashlib
-        import json as json_lib
-        
-        # Подготовка данных для API MANGO OFFICE
-        # Документация: https://www.mango-office.ru/support/api/
+        command_id, result = mango.request_callback(call_id, phone, creds)
         
-        # Формируем JSON запрос
-        command_id = f"call_{call_id}_{int(datetime.now().timestamp())}"
-        
-        request_data = {
-            "command_id": command_id,
-            "from": {
-                "extension": from_extension,
-                "number": from_number or phone
-            },
-            "to_number": phone,
-            "line_number": from_number or "",
-            "sip_headers": {}
-        }
-        
-        json_request = json_lib.dumps(request_data, ensure_ascii=False)
-        
-        # Вычисляем sign (hash)
-        sign_string = vpbx_api_key + json_request + vpbx_api_salt
-        sign = hashlib.sha256(sign_string.encode('utf-8')).hexdigest()
-        
-        # Отправляем POST запрос к MANGO OFFICE API
-        url = 'https://app.mango-office.ru/vpbx/commands/callback'
-        
-        data = urllib.parse.urlencode({
-            'vpbx_api_key': vpbx_api_key,
-            'sign': sign,
-            'json': json_request
-        }).encode('utf-8')
+        # Обновляем запись звонка
+        call_result = f'Звонок инициирован через MANGO OFFICE (command_id: {command_id})'
+        cursor.execute("""
+            UPDATE calls 
+            SET status = %s, result = %s
+            WHERE id = %s
+        """, ('success', call_result, call_id))
+        outbox.record(cursor, 'call', 'update', [{'id': call_id, 'user_id': user_id, 'status': 'success', 'result': call_result}])
+        conn.commit()
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
+        return {
+            'success': True,
+            'call_id': call_id,
+            'mango_command_id': command_id,
+            'message': f'Звонок на номер {phone} успешно инициирован через MANGO OFFICE',
+            'status': 'success',
+            'mango_response': result
         }
-        
-        request = urllib.request.Request(url, data=data, headers=headers, method='POST')
-        
-        with urllib.request.urlopen(request, timeout=10) as response:
-            result = json_lib.loads(response.read().decode('utf-8'))
-            
-            # Обновляем запись звонка
-            cursor.execute("""
-                UPDATE calls 
-                SET status = %s, result = %s
-                WHERE id = %s
-            """, ('success', f'Звонок инициирован через MANGO OFFICE (command_id: {command_id})', call_id))
-            conn.commit()
-            
-            return {
-                'success': True,
-                'call_id': call_id,
-                'mango_command_id': command_id,
-                'message': f'Звонок на номер {phone} успешно инициирован через MANGO OFFICE',
-                'status': 'success',
-                'mango_response': result
-            }
-    
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        try:
-            error_data = json_lib.loads(error_body)
-            error_message = error_data.get('message', str(e))
-        except:
-            error_message = error_body or str(e)
+    
+    except http_client.HTTPError as e:
+        error_message = mango.error_message(e)
         
         # Обновляем запись об ошибке
+        call_result = f'Ошибка MANGO OFFICE: {error_message}'
         cursor.execute("""
             UPDATE calls 
             SET status = %s, result = %s
             WHERE id = %s
-        """, ('failed', f'Ошибка MANGO OFFICE: {error_message}', call_id))
+        """, ('failed', call_result, call_id))
+        outbox.record(cursor, 'call', 'update', [{'id': call_id, 'user_id': user_id, 'status': 'failed', 'result': call_result}])
         conn.commit()
         
         return {
@@ -305,11 +431,13 @@ def initiate_call(cursor, conn, body):
         }
     
     except Exception as e:
+        call_result = f'Ошибка: {str(e)}'
         cursor.execute("""
             UPDATE calls 
             SET status = %s, result = %s
             WHERE id = %s
-        """, ('failed', f'Ошибка: {str(e)}', call_id))
+        """, ('failed', call_result, call_id))
+        outbox.record(cursor, 'call', 'update', [{'id': call_id, 'user_id': user_id, 'status': 'failed', 'result': call_result}])
         conn.commit()
         
         return {
@@ -320,15 +448,42 @@ def initiate_call(cursor, conn, body):
         }
 
 
-def success_response(data):
-    '''Формирует успешный ответ'''
+def success_response(data, etag=None):
+    '''Формирует успешный ответ; ETag добавляется только к ответу без ошибки'''
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    if etag and not (isinstance(data, dict) and 'error' in data):
+        headers['ETag'] = etag
+        headers['Access-Control-Expose-Headers'] = 'ETag'
     return {
         'statusCode': 200,
+        'headers': headers,
+        'body': serialization.dumps(data)
+    }
+
+
+def etag_matches(event, etag):
+    '''Сравнивает ETag с If-None-Match запроса (слабое сравнение, допускается список и *)'''
+    headers = event.get('headers') or {}
+    header = next((value for key, value in headers.items() if key.lower() == 'if-none-match'), None)
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in tags)
+
+
+def not_modified_response(etag):
+    '''Ответ 304 без тела: данные у клиента актуальны'''
+    return {
+        'statusCode': 304,
         'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'ETag': etag,
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'ETag'
         },
-        'body': json.dumps(data, ensure_ascii=False, default=str)
+        'body': ''
     }
 
 
@@ -382,12 +537,15 @@ def handle_mango_webhook(cursor, conn, body):
         cursor.execute("""
             INSERT INTO calls (client_id, status, duration, result, recording_url, created_at)
             VALUES (%s, %s, %s, %s, %s, NOW())
-            RETURNING id
+            RETURNING id, client_id, status, duration, result, recording_url, created_at
         """, (client_id, 'pending', '0:00', 'Звонок от MANGO OFFICE', recording_url))
         
-        call_id = cursor.fetchone()['id']
+        call = dict(cursor.fetchone())
+        call_id = call['id']
+        outbox.record(cursor, 'call', 'insert', [call])
     else:
         call_id = call_record['id']
+        client_id = call_record['client_id']
     
     # Обновляем информацию о звонке в зависимости от состояния
     if call_state == 'Connected':
@@ -409,56 +567,73 @@ def handle_mango_webhook(cursor, conn, body):
         WHERE id = %s
     """, (status, duration_formatted, result, recording_url or None, call_id))
     
-    # Если есть запись разговора, запускаем транскрипцию
+    # Итог звонка, балл лида и статистика по часам коммитятся сразу: транскрипция и ИИ-анализ
+    # идут минутами, и держать ради них открытую транзакцию со строками calls и clients нельзя
+    call_changes = {
+        'id': call_id,
+        'status': status,
+        'duration': duration_formatted,
+        'result': result,
+        'recording_url': recording_url or None
+    }
+    
+    from scoring import score_clients
+    score_clients(cursor, [client_id])
+    
+    # Статистика по часам недели обновляется последней: строка сегмента общая для всех вебхуков
+    if call_state == 'Disconnected':
+        from contact_times import record_call_completion
+        record_call_completion(cursor, call_id)
+    
+    outbox.record(cursor, 'call', 'update', [call_changes])
+    conn.commit()
+    
+    # Если есть запись разговора, запускаем транскрипцию и ИИ-анализ вне транзакции
     if recording_url and call_state == 'Disconnected':
         # Получаем транскрипцию через MANGO OFFICE Speech API или сторонний сервис
         transcript = get_call_transcript(recording_url)
         if transcript and transcript != 'Транскрипция доступна после настройки Yandex SpeechKit или альтернативного сервиса':
-            cursor.execute("""
-                UPDATE calls 
-                SET transcript = %s
-                WHERE id = %s
-            """, (transcript, call_id))
-            
-            # Автоматически запускаем ИИ-анализ звонка
             cursor.execute("""
                 SELECT c.*, cl.name, cl.company, cl.email, cl.phone
                 FROM calls c
                 JOIN clients cl ON c.client_id = cl.id
                 WHERE c.id = %s
             """, (call_id,))
-            
             call_data = cursor.fetchone()
+            # Читающая транзакция закрывается до запроса к YandexGPT
+            conn.commit()
+            
+            analysis_changes = {'id': call_id, 'transcript': transcript}
+            ai_analysis = None
             if call_data:
+                import prompts
                 ai_analysis = call_yandex_gpt_agent(
                     transcript=transcript,
                     client_name=call_data['name'],
                     company=call_data['company'],
-                    prompt=f"""Проанализируй звонок с клиентом {call_data['name']} из компании {call_data['company']}.
-                    
-Транскрипция разговора:
-{transcript}
-
-Выдели:
-1. Основную цель звонка
-2. Ключевые вопросы клиента
-3. Договоренности и следующие шаги
-4. Настроение клиента (заинтересован/нейтрален/недоволен)
-5. Рекомендации менеджеру"""
+                    prompt=prompts.build(
+                        'analyze_call',
+                        transcript=transcript,
+                        name=call_data['name'],
+                        company=call_data['company']
+                    )
                 )
-                
-                # Сохраняем анализ в поле notes
-                cursor.execute("""
-                    UPDATE calls 
-                    SET notes = %s
-                    WHERE id = %s
-                """, (f"🤖 ИИ-анализ:\n{ai_analysis}", call_id))
-                
-                # Отправляем email менеджеру с резюме звонка
+                analysis_changes['notes'] = f"🤖 ИИ-анализ:\n{ai_analysis}"
+            
+            # Транскрипция и анализ пишутся отдельной короткой транзакцией со своим событием outbox
+            cursor.execute("""
+                UPDATE calls 
+                SET transcript = %s,
+                    notes = COALESCE(%s, notes)
+                WHERE id = %s
+            """, (transcript, analysis_changes.get('notes'), call_id))
+            outbox.record(cursor, 'call', 'update', [analysis_changes])
+            conn.commit()
+            
+            # Отправляем email менеджеру с резюме звонка
+            if call_data:
                 send_call_summary_email(call_data, ai_analysis, duration_formatted)
     
-    conn.commit()
-    
     return {
         'success': True,
         'message': 'Webhook processed',
@@ -471,15 +646,13 @@ def handle_mango_webhook(cursor, conn, body):
 
 
 def get_call_transcript(recording_url):
-    '''Получает транскрипцию записи звонка через Yandex SpeechKit'''
+    '''Получает транскрипцию записи звонка через Yandex SpeechKit; готовые транскрипции берутся из кэша'''
     
     if not recording_url:
         return None
     
     try:
-        import urllib.request
-        import base64
-        import time
+        from transcription import transcribe_cached
         
         # Используем Yandex SpeechKit для транскрипции
         # Документация: https://cloud.yandex.ru/docs/speechkit/
@@ -491,36 +664,9 @@ def get_call_transcript(recording_url):
             # Если нет ключей Yandex, пытаемся использовать альтернативу
             return transcribe_with_alternative(recording_url)
         
-        # Скачиваем аудио файл
-        audio_request = urllib.request.Request(recording_url)
-        with urllib.request.urlopen(audio_request, timeout=30) as audio_response:
-            audio_data = audio_response.read()
-        
-        # Отправляем на транскрипцию в Yandex SpeechKit
-        url = 'https://stt.api.cloud.yandex.net/speech/v1/stt:recognize'
-        
-        headers = {
-            'Authorization': f'Api-Key {yandex_api_key}',
-            'Content-Type': 'audio/ogg'
-        }
-        
-        params = urllib.parse.urlencode({
-            'lang': 'ru-RU',
-            'folderId': yandex_folder_id,
-            'format': 'oggopus'
-        })
-        
-        request = urllib.request.Request(
-            f'{url}?{params}',
-            data=audio_data,
-            headers=headers,
-            method='POST'
-        )
-        
-        with urllib.request.urlopen(request, timeout=60) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            transcript_text = result.get('result', '')
-            return transcript_text if transcript_text else 'Транскрипция недоступна'
+        # Запись скачивается во временный файл и распознается фрагментами по 30 секунд
+        transcript_text = transcribe_cached(get_db_connection, recording_url, yandex_api_key, yandex_folder_id)
+        return transcript_text if transcript_text else 'Транскрипция недоступна'
     
     except Exception as e:
         return f'Ошибка транскрипции: {str(e)}'
@@ -559,28 +705,23 @@ def ai_analyze_call(cursor, body):
     if not transcript:
         return {'error': 'No transcript available', 'message': 'Дождитесь завершения транскрипции'}
     
+    # Длинная транскрипция сжимается и при необходимости пересказывается по частям
+    import prompts
+    prompt = prompts.build('analyze_call', transcript=transcript, name=call['name'], company=call['company'])
+    
     # Вызываем YandexGPT агента для анализа
     analysis = call_yandex_gpt_agent(
         transcript=transcript,
         client_name=call['name'],
         company=call['company'],
-        prompt=f"""Проанализируй звонок с клиентом {call['name']} из компании {call['company']}.
-        
-Транскрипция разговора:
-{transcript}
-
-Выдели:
-1. Основную цель звонка
-2. Ключевые вопросы клиента
-3. Договоренности и следующие шаги
-4. Настроение клиента (заинтересован/нейтрален/недоволен)
-5. Рекомендации менеджеру"""
+        prompt=prompt
     )
     
     return {
         'success': True,
         'call_id': call_id,
         'analysis': analysis,
+        'tokens': prompt.report(),
         'client': {
             'name': call['name'],
             'company': call['company'],
@@ -608,7 +749,10 @@ def ai_suggest_action(cursor, body):
     
     # Получаем данные клиента и историю звонков
     cursor.execute("""
-        SELECT * FROM clients WHERE id = %s
+        SELECT c.*, s.score
+        FROM clients c
+        LEFT JOIN lead_scores s ON s.client_id = c.id
+        WHERE c.id = %s
     """, (client_id,))
     
     client = cursor.fetchone()
@@ -626,34 +770,30 @@ def ai_suggest_action(cursor, body):
     
     calls_history = cursor.fetchall()
     
-    # Формируем контекст для агента
-    history_text = "\n".join([
-        f"- {call['created_at'].strftime('%d.%m.%Y')}: {call['result']} (длительность: {call['duration']})"
-        for call in calls_history
-    ])
+    # Время связи берется из статистики исходов по часам недели, а не угадывается по истории
+    from contact_times import contact_windows, describe_windows
+    contact = contact_windows(cursor, client['id'])
     
     last_transcript = calls_history[0].get('transcript', '') if calls_history else ''
     
+    import prompts
+    prompt = prompts.build(
+        'suggest_action',
+        transcript=last_transcript,
+        name=client['name'],
+        company=client['company'],
+        email=client['email'],
+        phone=client['phone'],
+        status=client['status'],
+        score=f"{client['score']} из 100" if client['score'] is not None else 'не рассчитан',
+        contact_windows=describe_windows(contact)
+    )
+    
     suggestion = call_yandex_gpt_agent(
         transcript=last_transcript,
         client_name=client['name'],
         company=client['company'],
-        prompt=f"""Клиент: {client['name']} из компании {client['company']}
-Email: {client['email']}
-Телефон: {client['phone']}
-Статус: {client['status']}
-
-История звонков:
-{history_text}
-
-Последний разговор:
-{last_transcript if last_transcript else 'Нет транскрипции'}
-
-На основе истории взаимодействия предложи:
-1. Наиболее подходящее следующее действие (звонок, письмо, встреча)
-2. Когда лучше связаться
-3. О чем говорить / что предложить
-4. Ключевые моменты для обсуждения"""
+        prompt=prompt
     )
     
     return {
@@ -667,67 +807,23 @@ Email: {client['email']}
             'status': client['status']
         },
         'suggestion': suggestion,
+        'contact_windows': contact['windows'],
+        'tokens': prompt.report(),
         'calls_count': len(calls_history)
     }
 
 
-def call_yandex_gpt_agent(transcript: str, client_name: str, company: str, prompt: str) -> str:
+def call_yandex_gpt_agent(transcript: str, client_name: str, company: str, prompt) -> str:
     '''Вызывает YandexGPT агента для анализа и генерации рекомендаций'''
     
-    try:
-        import urllib.request
-        import urllib.parse
-        
-        yandex_api_key = os.environ.get('YANDEX_API_KEY')
-        yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID')
-        
-        if not yandex_api_key or not yandex_folder_id:
-            return 'Для использования ИИ-анализа настройте YANDEX_API_KEY и YANDEX_FOLDER_ID'
-        
-        # URI агента из запроса
-        agent_uri = 'gpt://b1gjbflgkc6kmaki44db/yandexgpt/rc'
-        
-        # Формируем запрос к YandexGPT Agent API
-        url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
-        
-        request_data = {
-            'modelUri': agent_uri,
-            'completionOptions': {
-                'stream': False,
-                'temperature': 0.7,
-                'maxTokens': 2000
-            },
-            'messages': [
-                {
-                    'role': 'system',
-                    'text': 'Ты — ИИ-помощник для CRM системы компании по продаже автозапчастей. Помогаешь менеджерам анализировать звонки и планировать работу с клиентами.'
-                },
-                {
-                    'role': 'user',
-                    'text': prompt
-                }
-            ]
-        }
-        
-        headers = {
-            'Authorization': f'Api-Key {yandex_api_key}',
-            'Content-Type': 'application/json',
-            'x-folder-id': yandex_folder_id
-        }
-        
-        data = json.dumps(request_data, ensure_ascii=False).encode('utf-8')
-        request = urllib.request.Request(url, data=data, headers=headers, method='POST')
-        
-        with urllib.request.urlopen(request, timeout=30) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            
-            # Извлекаем текст ответа из структуры YandexGPT
-            alternatives = result.get('result', {}).get('alternatives', [])
-            if alternatives:
-                return alternatives[0].get('message', {}).get('text', 'Ответ не получен')
-            
-            return 'Ошибка получения ответа от агента'
+    import yandex_gpt
     
+    try:
+        return yandex_gpt.complete(prompt)
+    except yandex_gpt.GPTNotConfigured:
+        return 'Для использования ИИ-анализа настройте YANDEX_API_KEY и YANDEX_FOLDER_ID'
+    except yandex_gpt.GPTError as e:
+        return str(e)
     except Exception as e:
         return f'Ошибка при обращении к YandexGPT агенту: {str(e)}'
 
@@ -736,7 +832,7 @@ def send_call_summary_email(call_data: dict, ai_analysis: str, duration: str):
     '''Отправляет email менеджеру с резюме звонка'''
     
     try:
-        import urllib.request
+        import http_client
         
         # Email для уведомлений
         manager_email = os.environ.get('MANAGER_EMAIL', 'zakaz6377@yandex.ru')
@@ -761,21 +857,8 @@ def send_call_summary_email(call_data: dict, ai_analysis: str, duration: str):
         }
         
         # Отправляем POST запрос к email-sender
-        data = json.dumps(email_payload, ensure_ascii=False).encode('utf-8')
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        
-        request = urllib.request.Request(
-            email_sender_url,
-            data=data,
-            headers=headers,
-            method='POST'
-        )
-        
-        with urllib.request.urlopen(request, timeout=10) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result.get('success', False)
+        result = http_client.post_json(email_sender_url, email_payload, target='email_sender', timeout=10).json()
+        return result.get('success', False)
     
     except Exception as e:
         # Не прерываем основной процесс если email не отправился
@@ -791,5 +874,5 @@ def error_response(error_message):
             'Content-Type': 'application/json',
             'Access-Control-Allow-Origin': '*'
         },
-        'body': json.dumps({'error': error_message}, ensure_ascii=False)
+        'body': serialization.dumps({'error': error_message})
     }
\ No newline at end of file
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import time
+
+import http_client
+
+
+def credentials():
+    '''Ключ, соль и линия MANGO OFFICE из окружения; None, если API не настроен'''
+    vpbx_api_key = os.environ.get('MANGO_VPBX_API_KEY')
+    vpbx_api_salt = os.environ.get('MANGO_VPBX_API_SALT')
+    from_extension = os.environ.get('MANGO_FROM_EXTENSION')
+    if not all([vpbx_api_key, vpbx_api_salt, from_extension]):
+        return None
+    return {
+        'vpbx_api_key': vpbx_api_key,
+        'vpbx_api_salt': vpbx_api_salt,
+        'from_extension': from_extension,
+        'from_number': os.environ.get('MANGO_FROM_NUMBER')
+    }
+
+
+def request_callback(call_id: int, phone: str, creds: dict) -> tuple:
+    '''Отправляет команду callback и возвращает (command_id, ответ API).
+
+    Без повторов: callback не идемпотентен, повтор означал бы второй звонок клиенту.
+    Документация: https://www.mango-office.ru/support/api/
+    '''
+    import urllib.parse
+
+    command_id = f'call_{call_id}_{int(time.time())}'
+    from_number = creds['from_number']
+
+    json_request = json.dumps({
+        'command_id': command_id,
+        'from': {
+            'extension': creds['from_extension'],
+            'number': from_number or phone
+        },
+        'to_number': phone,
+        'line_number': from_number or '',
+        'sip_headers': {}
+    }, ensure_ascii=False)
+
+    sign = hashlib.sha256((creds['vpbx_api_key'] + json_request + creds['vpbx_api_salt']).encode('utf-8')).hexdigest()
+
+    mango_api_url = os.environ.get('MANGO_API_URL', 'https://app.mango-office.ru/vpbx')
+    data = urllib.parse.urlencode({
+        'vpbx_api_key': creds['vpbx_api_key'],
+        'sign': sign,
+        'json': json_request
+    }).encode('utf-8')
+
+    response = http_client.request(
+        'POST',
+        f'{mango_api_url}/commands/callback',
+        body=data,
+        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+        target='mango',
+        timeout=10
+    )
+    return command_id, response.json()
+
+
+def error_message(error: Exception) -> str:
+    '''Текст ошибки MANGO: поле message из JSON-ответа, иначе тело или исключение'''
+    if isinstance(error, http_client.HTTPError):
+        body = error.text()
+        try:
+            return json.loads(body).get('message', str(error))
+        except (ValueError, AttributeError):
+            return body or str(error)
+    return str(error)
@@ -0,0 +1,254 @@
+import contextvars
+import math
+import re
+
+
+# Оценка без токенизатора: у YandexGPT русский текст дает около трех символов на токен
+CHARS_PER_TOKEN = 3.0
+
+# Контекст модели минус место под ответ и системный промпт
+MODEL_CONTEXT_TOKENS = 8000
+COMPLETION_TOKENS = 2000
+SYSTEM_PROMPT_TOKENS = 60
+
+# Map-reduce для длинных транскрипций: куски по CHUNK_TOKENS, не больше SUMMARY_ROUNDS проходов
+CHUNK_TOKENS = 1500
+SUMMARY_CONCURRENCY = 4
+SUMMARY_ROUNDS = 2
+SUMMARY_MAX_TOKENS = 300
+
+# Слова-паразиты и междометия распознавания речи; удаляются только как отдельные слова
+FILLER_RE = re.compile(
+    r'(?<![\w-])(?:э+(?:-э+)*|мм+|м-м+|э+м+|а-а+|как бы|короче|это самое|так сказать)'
+    r'(?![\w-])[,.]?',
+    re.IGNORECASE
+)
+# «Ну» и «в общем» несут смысл внутри фразы («ну и что», «в общем доступе»), поэтому
+# удаляются, только когда стоят особняком между знаками препинания: «Да, ну, хорошо»
+STANDALONE_FILLER_RE = re.compile(
+    r'(?:^|(?<=[,.!?…]))\s*(?:ну|в общем-то|в общем)\s*(?:[,.!?…]|$)',
+    re.IGNORECASE
+)
+REPEATED_WORD_RE = re.compile(r'\b([^\W\d_]+)(?:[,\s]+\1\b)+', re.IGNORECASE)
+SENTENCE_RE = re.compile(r'[^.!?…]+[.!?…]*')
+SPACES_RE = re.compile(r'\s+')
+DANGLING_PUNCTUATION_RE = re.compile(r'\s+([,.!?…])|^[,.\s]+')
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def compact_transcript(text: str) -> str:
+    '''Убирает из транскрипции слова-паразиты, повторы слов подряд и повторы реплик подряд.
+
+    Повтор реплики — то же предложение без учета регистра и знаков препинания сразу
+    за предыдущим («Алло? Алло? Вы меня слышите?»); та же фраза позже в разговоре —
+    уже другой ответ и остается.
+    '''
+    if not text:
+        return ''
+    text = FILLER_RE.sub('', text)
+    text = STANDALONE_FILLER_RE.sub('', text)
+    text = REPEATED_WORD_RE.sub(r'\1', text)
+
+    previous = None
+    sentences = []
+    for match in SENTENCE_RE.finditer(text):
+        sentence = DANGLING_PUNCTUATION_RE.sub(r'\1', SPACES_RE.sub(' ', match.group()).strip())
+        key = re.sub(r'[^\w ]', '', sentence.lower()).strip()
+        if not key or key == previous:
+            continue
+        previous = key
+        sentences.append(sentence[:1].upper() + sentence[1:])
+    return ' '.join(sentences)
+
+
+def split_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS) -> list:
+    '''Делит текст на куски по границам предложений, каждый не больше chunk_tokens'''
+    chunks, current, current_tokens = [], [], 0
+    for match in SENTENCE_RE.finditer(text):
+        sentence = match.group().strip()
+        tokens = estimate_tokens(sentence) + 1
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(' '.join(current))
+            current, current_tokens = [], 0
+        # Предложение длиннее куска (распознавание без знаков препинания) режется по символам
+        while tokens > chunk_tokens:
+            size = int(chunk_tokens * CHARS_PER_TOKEN)
+            chunks.append(sentence[:size])
+            sentence = sentence[size:]
+            tokens = estimate_tokens(sentence) + 1
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def trim_to_budget(text: str, budget: int) -> str:
+    '''Последнее средство: начало и конец текста в пределах бюджета, середина вырезается'''
+    if estimate_tokens(text) <= budget:
+        return text
+    chars = int(budget * CHARS_PER_TOKEN)
+    head = chars // 3
+    return f'{text[:head]} … {text[len(text) - (chars - head):]}'
+
+
+class PromptTemplate:
+    '''Шаблон промпта одного типа вызова; токены постоянной части посчитаны один раз при импорте'''
+
+    __slots__ = ('name', 'text', 'static_tokens', 'budget')
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.static_tokens = estimate_tokens(re.sub(r'\{\w+\}', '', text))
+        self.budget = MODEL_CONTEXT_TOKENS - COMPLETION_TOKENS - SYSTEM_PROMPT_TOKENS - self.static_tokens
+
+    def render(self, **fields) -> str:
+        return self.text.format(**fields)
+
+
+TEMPLATES = {
+    template.name: template for template in (
+        PromptTemplate('analyze_call', """Проанализируй звонок с клиентом {name} из компании {company}.
+
+Транскрипция разговора:
+{transcript}
+
+Выдели:
+1. Основную цель звонка
+2. Ключевые вопросы клиента
+3. Договоренности и следующие шаги
+4. Настроение клиента (заинтересован/нейтрален/недоволен)
+5. Рекомендации менеджеру"""),
+        PromptTemplate('suggest_action', """Клиент: {name} из компании {company}
+Email: {email}
+Телефон: {phone}
+Статус: {status}
+Балл лида: {score}
+
+Лучшее время для звонка по статистике дозвона (часы по Москве):
+{contact_windows}
+
+Последний разговор:
+{transcript}
+
+На основе истории взаимодействия предложи:
+1. Наиболее подходящее следующее действие (звонок, письмо, встреча)
+2. Когда лучше связаться (опирайся на статистику дозвона выше)
+3. О чем говорить / что предложить
+4. Ключевые моменты для обсуждения"""),
+        PromptTemplate('segment_suggestion', """Клиент: {name} из компании {company}
+Статус: {status}
+Балл лида: {score} из 100
+Лучшее время для звонка по статистике дозвона (часы по Москве): {contact_windows}
+
+Последние звонки:
+{history}
+
+Последний разговор:
+{transcript}
+
+Предложи менеджеру следующий шаг с этим клиентом на сегодня:
+1. Действие (звонок, письмо, встреча) и когда
+2. О чем говорить / что предложить
+Ответь коротко, не больше пяти предложений."""),
+        PromptTemplate('summarize_chunk', """Это часть {part} из {parts} транскрипции телефонного разговора менеджера \
+магазина автозапчастей с клиентом. Кратко перескажи ее: запрошенные товары и цены, вопросы клиента, \
+возражения, договоренности. Не больше пяти предложений.
+
+{transcript}"""),
+    )
+}
+
+
+class Prompt:
+    '''Готовый промпт и его размер: до сжатия транскрипции и после'''
+
+    __slots__ = ('template', 'text', 'tokens', 'raw_tokens', 'summarized_chunks')
+
+    def __init__(self, template: str, text: str, raw_tokens: int, summarized_chunks: int = 0):
+        self.template = template
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.raw_tokens = raw_tokens
+        self.summarized_chunks = summarized_chunks
+
+    def __str__(self) -> str:
+        return self.text
+
+    def report(self) -> dict:
+        return {
+            'template': self.template,
+            'prompt_tokens': self.tokens,
+            'raw_prompt_tokens': self.raw_tokens,
+            'saved_tokens': max(self.raw_tokens - self.tokens, 0),
+            'summarized_chunks': self.summarized_chunks
+        }
+
+
+def summarize_chunks(chunks: list, summarize) -> list:
+    '''Map-шаг: пересказы кусков параллельно, не больше SUMMARY_CONCURRENCY запросов к модели'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    template = TEMPLATES['summarize_chunk']
+    texts = [template.render(part=i + 1, parts=len(chunks), transcript=chunk) for i, chunk in enumerate(chunks)]
+    prompts = [Prompt(template.name, text, estimate_tokens(text)) for text in texts]
+    with ThreadPoolExecutor(max_workers=min(SUMMARY_CONCURRENCY, len(prompts))) as executor:
+        # Контекст копируется здесь, чтобы запросы к модели попали в Trace вызова
+        futures = [executor.submit(contextvars.copy_context().run, summarize, prompt) for prompt in prompts]
+        return [future.result() for future in futures]
+
+
+def fit_transcript(transcript: str, budget: int, summarize=None) -> tuple:
+    '''Транскрипция в пределах бюджета: сжатие, затем map-reduce пересказ, затем обрезка.
+
+    Транскрипция, которая и так помещается в бюджет, уходит в модель дословно.
+    Возвращает (текст, число пересказанных кусков). Если пересказ не удался,
+    промпт все равно собирается из обрезанного текста.
+    '''
+    if estimate_tokens(transcript) <= budget:
+        return transcript, 0
+    text = compact_transcript(transcript)
+    summarized = 0
+    for _ in range(SUMMARY_ROUNDS):
+        if estimate_tokens(text) <= budget or summarize is None:
+            break
+        chunks = split_chunks(text)
+        try:
+            summaries = summarize_chunks(chunks, summarize)
+        except Exception:
+            break
+        summarized += len(chunks)
+        text = '\n'.join(f'Часть {i + 1}. {summary.strip()}' for i, summary in enumerate(summaries))
+    return trim_to_budget(text, budget), summarized
+
+
+def default_summarize(prompt: Prompt) -> str:
+    import yandex_gpt
+    return yandex_gpt.complete(prompt, temperature=0.2, max_tokens=SUMMARY_MAX_TOKENS)
+
+
+def build(template_name: str, transcript: str = None, summarize=default_summarize,
+          transcript_budget: int = None, **fields) -> Prompt:
+    '''Собирает промпт по шаблону; транскрипция ужимается под бюджет, оставшийся после остальных полей.
+
+    transcript_budget дополнительно ограничивает транскрипцию (массовые задания),
+    summarize=None отключает map-reduce пересказ и оставляет только сжатие и обрезку.
+    '''
+    template = TEMPLATES[template_name]
+    fields = {key: '' if value is None else value for key, value in fields.items()}
+    fields_tokens = sum(estimate_tokens(str(value)) for value in fields.values())
+    raw_tokens = template.static_tokens + fields_tokens + estimate_tokens(transcript or '')
+
+    summarized = 0
+    if 'transcript' in template.text:
+        if transcript:
+            budget = template.budget - fields_tokens
+            if transcript_budget is not None:
+                budget = min(budget, transcript_budget)
+            transcript, summarized = fit_transcript(transcript, budget, summarize)
+        fields['transcript'] = transcript or 'Нет транскрипции'
+    return Prompt(template.name, template.render(**fields), raw_tokens, summarized)
@@ -0,0 +1,181 @@
+import re
+import threading
+from collections import OrderedDict
+
+
+STEP_TYPES = ('greeting', 'question', 'objection', 'closing', 'custom')
+COMPILED_CACHE_SIZE = 256
+MAX_STEPS = 1000
+
+# Индекс шага «разговор завершен»
+END = -1
+
+_CONDITION_SEPARATORS = re.compile(r'[|,;/]')
+
+
+class ScenarioError(Exception):
+    pass
+
+
+class CompiledScenario:
+    '''Сценарий, собранный в конечный автомат: шаги пронумерованы, переходы — индексы.
+
+    Состояние разговора — один номер шага (SMALLINT в scenario_runs), поэтому на
+    каждом шаге нет ни разбора JSON, ни поиска шага по id.
+    '''
+
+    __slots__ = ('scenario_id', 'version', 'status', 'step_ids', 'types', 'contents', 'next', 'branches')
+
+    def __init__(self, scenario_id: int, version, status: str, steps: list):
+        index = {step['id']: position for position, step in enumerate(steps)}
+
+        def target(step_id, source):
+            if step_id not in index:
+                raise ScenarioError(f"Step {source} refers to unknown step {step_id}")
+            return index[step_id]
+
+        self.scenario_id = scenario_id
+        self.version = version
+        self.status = status
+        self.step_ids = tuple(step['id'] for step in steps)
+        self.types = tuple(step['type'] for step in steps)
+        self.contents = tuple(step.get('content') or '' for step in steps)
+
+        # Без явного nextStep шаги идут по порядку списка, закрытие сделки завершает разговор
+        self.next = tuple(
+            target(step['nextStep'], step['id']) if step.get('nextStep')
+            else END if step['type'] == 'closing' or position == len(steps) - 1
+            else position + 1
+            for position, step in enumerate(steps)
+        )
+        self.branches = tuple(
+            tuple(
+                (
+                    branch['condition'].strip().lower(),
+                    tuple(
+                        phrase.strip() for phrase in _CONDITION_SEPARATORS.split(branch['condition'].lower())
+                        if phrase.strip()
+                    ),
+                    target(branch['nextStep'], step['id'])
+                )
+                for branch in step.get('branches') or ()
+                if branch.get('condition') and branch.get('nextStep')
+            )
+            for step in steps
+        )
+
+    def __len__(self) -> int:
+        return len(self.step_ids)
+
+    def advance(self, step: int, reply: str = None, condition: str = None) -> int:
+        '''Следующий шаг: явно выбранная ветка, затем ветка по ответу клиента, иначе nextStep'''
+        branches = self.branches[step]
+        if condition:
+            condition = condition.strip().lower()
+            for name, _, next_step in branches:
+                if name == condition:
+                    return next_step
+        if reply:
+            reply = reply.lower()
+            for _, phrases, next_step in branches:
+                for phrase in phrases:
+                    if phrase in reply:
+                        return next_step
+        return self.next[step]
+
+    def describe(self, step: int) -> dict:
+        if step == END:
+            return None
+        return {'id': self.step_ids[step], 'type': self.types[step], 'content': self.contents[step]}
+
+
+def validate_steps(steps) -> list:
+    '''Проверяет структуру шагов из конструктора и возвращает ее без лишних полей'''
+    if not isinstance(steps, list) or not steps:
+        raise ScenarioError('Scenario must have at least one step')
+    if len(steps) > MAX_STEPS:
+        raise ScenarioError(f'Scenario cannot have more than {MAX_STEPS} steps')
+
+    cleaned = []
+    seen = set()
+    for step in steps:
+        if not isinstance(step, dict) or not step.get('id'):
+            raise ScenarioError('Each step must have an id')
+        step_id = str(step['id'])
+        if step_id in seen:
+            raise ScenarioError(f'Duplicate step id {step_id}')
+        seen.add(step_id)
+        if step.get('type') not in STEP_TYPES:
+            raise ScenarioError(f"Step {step_id} has invalid type {step.get('type')}")
+
+        item = {'id': step_id, 'type': step['type'], 'content': str(step.get('content') or '')}
+        if step.get('nextStep'):
+            item['nextStep'] = str(step['nextStep'])
+        branches = step.get('branches')
+        if branches:
+            if not isinstance(branches, list):
+                raise ScenarioError(f'Step {step_id} branches must be a list')
+            item['branches'] = [
+                {'condition': str(branch.get('condition') or ''), 'nextStep': str(branch.get('nextStep') or '')}
+                for branch in branches if isinstance(branch, dict)
+            ]
+        cleaned.append(item)
+
+    # Проверка ссылок: компиляция бросит ScenarioError на неизвестный шаг
+    CompiledScenario(0, None, 'draft', cleaned)
+    return cleaned
+
+
+class CompiledScenarioCache:
+    '''Скомпилированные сценарии в памяти экземпляра, ключ — (id, updated_at).
+
+    Проверка актуальности — один запрос на все нужные сценарии; steps передаются
+    из базы и разбираются только для сценариев, которых нет в кэше или которые изменились.
+    '''
+
+    def __init__(self, size: int = COMPILED_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.compiled = 0
+
+    def get_many(self, cursor, scenario_ids) -> dict:
+        scenario_ids = list(dict.fromkeys(scenario_ids))
+        with self.lock:
+            cached = {sid: self.entries.get(sid) for sid in scenario_ids}
+        known = [cached[sid].version if cached[sid] else None for sid in scenario_ids]
+
+        cursor.execute("""
+            SELECT
+                s.id,
+                s.updated_at,
+                s.status,
+                CASE WHEN s.updated_at IS NOT DISTINCT FROM k.version THEN NULL ELSE s.steps END AS steps
+            FROM unnest(%s::bigint[], %s::timestamp[]) AS k(id, version)
+            JOIN scenarios s ON s.id = k.id
+        """, (scenario_ids, known))
+
+        result = {}
+        with self.lock:
+            for row in cursor.fetchall():
+                entry = cached.get(row['id'])
+                if row['steps'] is not None or entry is None:
+                    entry = CompiledScenario(row['id'], row['updated_at'], row['status'], row['steps'])
+                    self.compiled += 1
+                entry.status = row['status']
+                self.entries[row['id']] = entry
+                self.entries.move_to_end(row['id'])
+                result[row['id']] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return result
+
+    def get(self, cursor, scenario_id: int):
+        return self.get_many(cursor, [scenario_id]).get(scenario_id)
+
+    def invalidate(self, scenario_id: int):
+        with self.lock:
+            self.entries.pop(scenario_id, None)
+
+
+compiled_scenarios = CompiledScenarioCache()
@@ -0,0 +1,247 @@
+import json
+import time
+
+from psycopg2.extras import execute_values
+
+from scenario_engine import END, ScenarioError, compiled_scenarios, validate_steps
+
+
+SCENARIO_STATUSES = ('active', 'draft')
+MAX_RUNS_PER_REQUEST = 1000
+
+
+def serialize_scenario(row: dict) -> dict:
+    '''Строка scenarios в формате конструктора сценариев'''
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'description': row['description'] or '',
+        'steps': row['steps'],
+        'status': row['status'],
+        'created': row['created_at'].date().isoformat() if row['created_at'] else None,
+        'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None
+    }
+
+
+def get_scenarios(cursor):
+    '''Список сценариев, новые сверху'''
+    cursor.execute("""
+        SELECT id, name, description, steps, status, created_at, updated_at
+        FROM scenarios
+        ORDER BY created_at DESC
+    """)
+    return {'scenarios': [serialize_scenario(row) for row in cursor.fetchall()]}
+
+
+def save_scenario(cursor, conn, body):
+    '''Создает или обновляет сценарий и переводит активные разговоры на новые номера шагов'''
+    if not isinstance(body, dict) or not isinstance(body.get('scenario'), dict):
+        return {'error': 'scenario is required'}
+
+    scenario = body['scenario']
+    name = str(scenario.get('name') or '').strip()
+    if not name:
+        return {'error': 'Scenario name is required'}
+    status = scenario.get('status') or 'draft'
+    if status not in SCENARIO_STATUSES:
+        return {'error': f'Invalid status {status}'}
+    try:
+        steps = validate_steps(scenario.get('steps'))
+    except ScenarioError as e:
+        return {'error': str(e)}
+
+    # Конструктор присваивает id = Date.now(); без id ведем себя так же
+    try:
+        scenario_id = int(scenario.get('id') or time.time() * 1000)
+    except (TypeError, ValueError):
+        return {'error': 'Invalid scenario id'}
+
+    cursor.execute("SELECT steps FROM scenarios WHERE id = %s FOR UPDATE", (scenario_id,))
+    previous = cursor.fetchone()
+
+    cursor.execute("""
+        INSERT INTO scenarios (id, name, description, steps, status)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (id) DO UPDATE
+        SET name = EXCLUDED.name,
+            description = EXCLUDED.description,
+            steps = EXCLUDED.steps,
+            status = EXCLUDED.status,
+            updated_at = NOW()
+        RETURNING id, name, description, steps, status, created_at, updated_at
+    """, (scenario_id, name, scenario.get('description') or '', json.dumps(steps, ensure_ascii=False), status))
+    saved = cursor.fetchone()
+
+    remapped = abandoned = 0
+    if previous:
+        # Номер шага в scenario_runs относится к прежней версии: переносим по id шага,
+        # разговоры на удаленных шагах завершаем
+        new_index = {step['id']: position for position, step in enumerate(steps)}
+        mapping = [new_index.get(step.get('id'), END) for step in previous['steps']]
+        cursor.execute("""
+            UPDATE scenario_runs
+            SET step = COALESCE(NULLIF((%(mapping)s::smallint[])[step + 1], -1), step),
+                status = CASE WHEN COALESCE((%(mapping)s::smallint[])[step + 1], -1) >= 0
+                    THEN 'active' ELSE 'abandoned' END,
+                version = %(version)s,
+                updated_at = NOW()
+            WHERE scenario_id = %(scenario_id)s AND status = 'active'
+            RETURNING status
+        """, {'mapping': mapping, 'version': saved['updated_at'], 'scenario_id': scenario_id})
+        for row in cursor.fetchall():
+            if row['status'] == 'active':
+                remapped += 1
+            else:
+                abandoned += 1
+
+    conn.commit()
+    compiled_scenarios.invalidate(scenario_id)
+
+    return {
+        'success': True,
+        'scenario': serialize_scenario(saved),
+        'runs_remapped': remapped,
+        'runs_abandoned': abandoned
+    }
+
+
+def delete_scenario(cursor, conn, body):
+    '''Удаляет сценарий вместе с его разговорами'''
+    scenario_id = body.get('scenario_id') if isinstance(body, dict) else None
+    if not scenario_id:
+        return {'error': 'scenario_id is required'}
+    try:
+        scenario_id = int(scenario_id)
+    except (TypeError, ValueError):
+        return {'error': 'scenario_id must be an integer'}
+
+    cursor.execute("DELETE FROM scenarios WHERE id = %s RETURNING id", (scenario_id,))
+    deleted = cursor.fetchone()
+    conn.commit()
+    compiled_scenarios.invalidate(scenario_id)
+
+    if not deleted:
+        return {'success': False, 'error': 'Scenario not found'}
+    return {'success': True, 'scenario_id': deleted['id']}
+
+
+def run_state(compiled, run: dict) -> dict:
+    return {
+        'run_id': run['id'],
+        'client_id': run.get('client_id'),
+        'status': run['status'],
+        'turns': run['turns'],
+        'step': compiled.describe(run['step']) if run['status'] == 'active' else None
+    }
+
+
+def start_scenario(cursor, conn, body):
+    '''Запускает активный сценарий для пачки клиентов: одна вставка на все разговоры'''
+    if not isinstance(body, dict) or not body.get('scenario_id'):
+        return {'error': 'scenario_id is required'}
+
+    client_ids = body.get('client_ids') or ([body['client_id']] if body.get('client_id') else [])
+    if not client_ids:
+        return {'error': 'client_ids is required'}
+    if len(client_ids) > MAX_RUNS_PER_REQUEST:
+        return {'error': f'At most {MAX_RUNS_PER_REQUEST} clients per request'}
+
+    try:
+        scenario_id = int(body['scenario_id'])
+    except (TypeError, ValueError):
+        return {'error': 'scenario_id must be an integer'}
+
+    try:
+        compiled = compiled_scenarios.get(cursor, scenario_id)
+    except ScenarioError as e:
+        return {'error': f'Scenario is invalid: {e}'}
+    if compiled is None:
+        return {'error': 'Scenario not found'}
+    if compiled.status != 'active':
+        return {'error': 'Scenario is not active'}
+
+    runs = execute_values(cursor, """
+        INSERT INTO scenario_runs (scenario_id, client_id, call_id, version)
+        VALUES %s
+        RETURNING id, client_id, step, turns, status
+    """, [
+        (compiled.scenario_id, client_id, body.get('call_id'), compiled.version)
+        for client_id in client_ids
+    ], template='(%s, %s, %s::integer, %s)', fetch=True)
+    conn.commit()
+
+    return {
+        'success': True,
+        'scenario_id': compiled.scenario_id,
+        'runs': [run_state(compiled, run) for run in runs]
+    }
+
+
+def advance_scenario(cursor, conn, body):
+    '''Переводит пачку разговоров на следующий шаг по ответу клиента или выбранной ветке.
+
+    Тело: {"runs": [{"run_id", "reply"?, "condition"?}]} или один разговор теми же полями.
+    Все разговоры читаются одним запросом, переходы считаются по скомпилированным
+    сценариям в памяти, новые состояния пишутся одним UPDATE.
+    '''
+    if not isinstance(body, dict):
+        return {'error': 'Invalid body format'}
+    moves = body.get('runs') if isinstance(body.get('runs'), list) else [body]
+    moves = [move for move in moves if isinstance(move, dict) and move.get('run_id')]
+    if not moves:
+        return {'error': 'run_id is required'}
+    if len(moves) > MAX_RUNS_PER_REQUEST:
+        return {'error': f'At most {MAX_RUNS_PER_REQUEST} runs per request'}
+    try:
+        run_ids = [int(move['run_id']) for move in moves]
+    except (TypeError, ValueError):
+        return {'error': 'run_id must be an integer'}
+
+    cursor.execute("""
+        SELECT id, scenario_id, client_id, step, turns, status, version
+        FROM scenario_runs
+        WHERE id = ANY(%s)
+        ORDER BY id
+        FOR UPDATE
+    """, (run_ids,))
+    runs = {row['id']: dict(row) for row in cursor.fetchall()}
+
+    try:
+        machines = compiled_scenarios.get_many(cursor, [run['scenario_id'] for run in runs.values()])
+    except ScenarioError as e:
+        conn.rollback()
+        return {'error': f'Scenario is invalid: {e}'}
+
+    results, updates = [], {}
+    for move, run_id in zip(moves, run_ids):
+        run = runs.get(run_id)
+        compiled = machines.get(run['scenario_id']) if run else None
+        if run is None or compiled is None:
+            results.append({'run_id': move['run_id'], 'error': 'Run not found'})
+            continue
+        if run['status'] != 'active':
+            results.append(run_state(compiled, run))
+            continue
+        if run['version'] != compiled.version:
+            results.append({'run_id': run['id'], 'error': 'Scenario changed, reload the run'})
+            continue
+
+        next_step = compiled.advance(run['step'], move.get('reply'), move.get('condition'))
+        run['turns'] += 1
+        if next_step == END:
+            run['status'] = 'completed'
+        else:
+            run['step'] = next_step
+        updates[run['id']] = (run['id'], run['step'], run['turns'], run['status'])
+        results.append(run_state(compiled, run))
+
+    if updates:
+        execute_values(cursor, """
+            UPDATE scenario_runs r
+            SET step = v.step, turns = v.turns, status = v.status, updated_at = NOW()
+            FROM (VALUES %s) AS v(id, step, turns, status)
+            WHERE r.id = v.id
+        """, list(updates.values()), template='(%s::bigint, %s::smallint, %s::smallint, %s)')
+    conn.commit()
+
+    return {'success': True, 'runs': results}
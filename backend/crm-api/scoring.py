@@ -0,0 +1,190 @@
+import time
+
+import outbox
+
+
+LEAD_SCORES_PAGE_SIZE = 50
+LEAD_SCORES_MAX_PAGE_SIZE = 500
+
+# Агрегат по всем звонкам держит в памяти по группе на клиента; с work_mem по умолчанию (4MB)
+# хеш-агрегация на миллионе клиентов уходит на диск и работает вдвое медленнее
+FULL_RECOMPUTE_WORK_MEM = '256MB'
+
+# Длительность хранится строкой "M:SS"; строки другого вида считаем нулевыми
+TALK_SECONDS_SQL = r"""
+    CASE WHEN duration ~ '^\d+:\d{2}$'
+        THEN split_part(duration, ':', 1)::int * 60 + split_part(duration, ':', 2)::int
+        ELSE 0 END
+"""
+
+# Балл 0..100 по признакам строки lead_scores f:
+#   давность последнего звонка — 35, затухание exp(-дней/30);
+#   частота звонков — 20, ln(1 + n) / ln(11), насыщается на 10 звонках;
+#   доля успешных — 25, сглаженная (успешные + 1) / (все + 2), чтобы один звонок не давал 0 или 100;
+#   время разговоров — 10, насыщается на 30 минутах;
+#   вовлеченность в рассылки — 10, (открытия + 2 * клики) / отправленные.
+SCORE_SQL = """
+    round(
+        35 * COALESCE(exp(-GREATEST(EXTRACT(EPOCH FROM NOW() - f.last_call_at), 0) / 2592000.0), 0)
+        + 20 * LEAST(ln(1 + f.calls_total) / ln(11), 1)
+        + 25 * (f.calls_success + 1)::float / (f.calls_total + 2)
+        + 10 * LEAST(f.talk_seconds / 1800.0, 1)
+        + 10 * CASE WHEN f.emails_sent > 0
+            THEN LEAST((f.emails_opened + 2 * f.emails_clicked)::float / f.emails_sent, 1)
+            ELSE 0 END
+    )::smallint
+"""
+
+
+def rebuild_scores(cursor, client_ids: list = None) -> int:
+    '''Пересобирает признаки из звонков и балл одним запросом.
+
+    Без client_ids — по всем клиентам сразу, включая клиентов без звонков. Признаки и балл
+    пишутся вместе, поэтому каждая строка переписывается не больше одного раза и только если
+    что-то изменилось. Счетчики писем ведет email_campaign, здесь они только читаются.
+    С client_ids запрос возвращает client_id и score переписанных строк.
+    '''
+    calls_where = "WHERE client_id = ANY(%(client_ids)s)" if client_ids is not None else ""
+    clients_where = "WHERE cl.id = ANY(%(client_ids)s)" if client_ids is not None else ""
+    returning = "RETURNING client_id, score" if client_ids is not None else ""
+    if client_ids is None:
+        cursor.execute("SELECT set_config('work_mem', %s, true)", (FULL_RECOMPUTE_WORK_MEM,))
+    cursor.execute(f"""
+        INSERT INTO lead_scores (client_id, calls_total, calls_success, talk_seconds, last_call_at, score, scored_at)
+        SELECT f.client_id, f.calls_total, f.calls_success, f.talk_seconds, f.last_call_at, {SCORE_SQL}, NOW()
+        FROM (
+            SELECT
+                cl.id AS client_id,
+                COALESCE(a.calls_total, 0) AS calls_total,
+                COALESCE(a.calls_success, 0) AS calls_success,
+                COALESCE(a.talk_seconds, 0) AS talk_seconds,
+                a.last_call_at,
+                COALESCE(o.emails_sent, 0) AS emails_sent,
+                COALESCE(o.emails_opened, 0) AS emails_opened,
+                COALESCE(o.emails_clicked, 0) AS emails_clicked
+            FROM clients cl
+            LEFT JOIN (
+                SELECT
+                    client_id,
+                    COUNT(*) AS calls_total,
+                    COUNT(*) FILTER (WHERE status = 'success') AS calls_success,
+                    SUM({TALK_SECONDS_SQL}) AS talk_seconds,
+                    MAX(created_at) AS last_call_at
+                FROM calls
+                {calls_where}
+                GROUP BY client_id
+            ) a ON a.client_id = cl.id
+            LEFT JOIN lead_scores o ON o.client_id = cl.id
+            {clients_where}
+        ) f
+        ON CONFLICT (client_id) DO UPDATE
+        SET calls_total = EXCLUDED.calls_total,
+            calls_success = EXCLUDED.calls_success,
+            talk_seconds = EXCLUDED.talk_seconds,
+            last_call_at = EXCLUDED.last_call_at,
+            score = EXCLUDED.score,
+            scored_at = EXCLUDED.scored_at,
+            updated_at = NOW()
+        WHERE (lead_scores.calls_total, lead_scores.calls_success, lead_scores.talk_seconds,
+               lead_scores.last_call_at, lead_scores.score)
+            IS DISTINCT FROM
+              (EXCLUDED.calls_total, EXCLUDED.calls_success, EXCLUDED.talk_seconds,
+               EXCLUDED.last_call_at, EXCLUDED.score)
+        {returning}
+    """, {'client_ids': client_ids})
+    return cursor.rowcount
+
+
+def refresh_scores(cursor) -> int:
+    '''Пересчитывает балл из накопленных признаков (давность звонка со временем затухает,
+    счетчики писем меняет email_campaign); переписываются только строки с изменившимся баллом
+    '''
+    cursor.execute(f"""
+        UPDATE lead_scores f
+        SET score = {SCORE_SQL}, scored_at = NOW()
+        WHERE f.score IS DISTINCT FROM {SCORE_SQL}
+    """)
+    return cursor.rowcount
+
+
+def score_clients(cursor, client_ids: list) -> int:
+    '''Инкрементальный пересчет после новых звонков: признаки и балл только указанных клиентов.
+
+    Коммит остается за вызывающим кодом, чтобы балл менялся в одной транзакции со звонком;
+    новый балл уходит в outbox событием клиента в той же транзакции.
+    '''
+    client_ids = sorted({int(client_id) for client_id in client_ids if client_id})
+    if not client_ids:
+        return 0
+    updated = rebuild_scores(cursor, client_ids)
+    outbox.record(cursor, 'client', 'update', [
+        {'id': row['client_id'], 'score': row['score']} for row in cursor.fetchall()
+    ])
+    return updated
+
+
+def recompute_scores(cursor, conn, body):
+    '''Пересчет баллов по всем клиентам.
+
+    По умолчанию балл считается из уже накопленных признаков, с {"full": true}
+    признаки сначала пересобираются из таблицы calls.
+    '''
+    full = bool(body.get('full')) if isinstance(body, dict) else False
+
+    started = time.perf_counter()
+    updated = rebuild_scores(cursor) if full else refresh_scores(cursor)
+    # Построчных событий массовый пересчет не пишет, для ETag списка клиентов меняется версия таблицы
+    if updated:
+        outbox.bump_version(cursor, 'lead_scores')
+    conn.commit()
+
+    return {
+        'success': True,
+        'full': full,
+        'updated': updated,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+def get_lead_scores(cursor, params):
+    '''Клиенты по убыванию балла вместе с признаками; keyset-пагинация по индексу idx_lead_scores_score'''
+    try:
+        limit = min(max(int(params.get('limit', LEAD_SCORES_PAGE_SIZE)), 1), LEAD_SCORES_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'error': 'limit must be an integer'}
+
+    # Курсор имеет вид "<балл>|<id>"
+    keyset = ""
+    sql_params = {'limit': limit + 1}
+    page_cursor = params.get('cursor')
+    if page_cursor:
+        try:
+            after_score, after_id = (int(part) for part in page_cursor.split('|', 1))
+        except ValueError:
+            return {'error': 'Invalid cursor'}
+        keyset = "AND (score < %(after_score)s OR (score = %(after_score)s AND client_id > %(after_id)s))"
+        sql_params.update(after_score=after_score, after_id=after_id)
+
+    cursor.execute(f"""
+        SELECT
+            c.id, c.name, c.company, c.phone, c.status, f.score, f.scored_at,
+            f.calls_total, f.calls_success, f.talk_seconds, f.last_call_at,
+            f.emails_sent, f.emails_opened, f.emails_clicked
+        FROM (
+            SELECT *
+            FROM lead_scores
+            WHERE score IS NOT NULL {keyset}
+            ORDER BY score DESC NULLS LAST, client_id
+            LIMIT %(limit)s
+        ) f
+        JOIN clients c ON c.id = f.client_id
+        ORDER BY f.score DESC, f.client_id
+    """, sql_params)
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['score']}|{rows[-1]['id']}"
+
+    return {'clients': rows, 'next_cursor': next_cursor}
@@ -0,0 +1,395 @@
+import contextvars
+import hashlib
+import json
+import time
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+import prompts
+import yandex_gpt
+from contact_times import best_windows
+from dialer import parse_segment
+
+
+SUGGESTION_BATCH_SIZE = 20
+MAX_BATCH_SIZE = 100
+SUGGESTION_TIME_BUDGET_SECONDS = 50
+# Аренда задания переживает бюджет на время самого долгого запроса к модели с повторами
+LEASE_MARGIN_SECONDS = 120
+DEFAULT_CALLS_PER_CLIENT = 5
+SUGGESTION_MAX_ATTEMPTS = 3
+MAX_CALLS_PER_CLIENT = 20
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+SUGGESTION_CACHE_HOURS = 72
+TRANSCRIPT_PROMPT_TOKENS = 700
+CONTACT_WINDOWS_IN_PROMPT = 3
+SUGGESTIONS_PAGE_SIZE = 50
+SUGGESTIONS_MAX_PAGE_SIZE = 200
+
+SEGMENT_FILTER_SQL = """
+    (%(statuses)s::text[] IS NULL OR cl.status = ANY(%(statuses)s::text[]))
+    AND (%(last_contact_from)s::timestamp IS NULL OR cl.last_contact >= %(last_contact_from)s::timestamp)
+    AND (%(last_contact_to)s::timestamp IS NULL OR cl.last_contact < %(last_contact_to)s::timestamp)
+    AND (%(user_id)s::integer IS NULL OR cl.user_id = %(user_id)s::integer)
+"""
+
+
+def create_suggestion_job(cursor, conn, body):
+    '''Создает задание на весь сегмент и сразу обрабатывает его в пределах бюджета времени'''
+    if not isinstance(body, dict):
+        return {'error': 'Invalid body format'}
+    try:
+        segment = parse_segment(body.get('segment') or {})
+        calls_per_client = int(body.get('calls_per_client') or DEFAULT_CALLS_PER_CLIENT)
+        concurrency = int(body.get('concurrency') or DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}
+    if not 0 < calls_per_client <= MAX_CALLS_PER_CLIENT:
+        return {'error': f'calls_per_client must be between 1 and {MAX_CALLS_PER_CLIENT}'}
+    if not 0 < concurrency <= MAX_CONCURRENCY:
+        return {'error': f'concurrency must be between 1 and {MAX_CONCURRENCY}'}
+    user_id = body.get('user_id')
+
+    cursor.execute(f"""
+        INSERT INTO suggestion_jobs (user_id, segment, segment_bounds, calls_per_client, concurrency, total, status)
+        SELECT %(user_id)s, %(segment)s, %(segment_bounds)s, %(calls_per_client)s, %(concurrency)s, total,
+            CASE WHEN total = 0 THEN 'completed' ELSE 'running' END
+        FROM (SELECT COUNT(*) AS total FROM clients cl WHERE {SEGMENT_FILTER_SQL}) segment
+        RETURNING id, total, status
+    """, {
+        'user_id': user_id,
+        'segment': json.dumps(body.get('segment') or {}, ensure_ascii=False),
+        'segment_bounds': dump_segment_bounds(segment),
+        'calls_per_client': calls_per_client,
+        'concurrency': concurrency,
+        **segment
+    })
+    job = cursor.fetchone()
+    conn.commit()
+
+    result = {'success': True, 'job_id': job['id'], 'total': job['total'], 'status': job['status']}
+    if job['status'] == 'running':
+        result.update(process_job(cursor, conn, job['id'], body))
+    return result
+
+
+def dump_segment_bounds(segment: dict) -> str:
+    '''Разобранный сегмент с вычисленными датами: продолжения задания обходят тот же набор клиентов'''
+    return json.dumps({
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in segment.items()
+    }, ensure_ascii=False)
+
+
+def load_segment_bounds(job: dict) -> dict:
+    '''Границы сегмента, зафиксированные при создании задания; у старых заданий — разбор segment'''
+    bounds = job.get('segment_bounds')
+    if not bounds:
+        return parse_segment(job['segment'])
+    segment = dict(bounds)
+    for key in ('last_contact_from', 'last_contact_to'):
+        if segment.get(key):
+            segment[key] = datetime.fromisoformat(segment[key])
+    return segment
+
+
+def run_suggestion_job(cursor, conn, body):
+    '''Продолжает задание с места остановки; повторные вызовы доводят его до конца'''
+    job_id = body.get('job_id') if isinstance(body, dict) else None
+    if not job_id:
+        return {'error': 'job_id is required'}
+    return {'success': True, 'job_id': int(job_id), **process_job(cursor, conn, int(job_id), body)}
+
+
+def process_job(cursor, conn, job_id: int, body: dict) -> dict:
+    from concurrent.futures import ThreadPoolExecutor
+
+    budget = min(float(body.get('time_budget') or SUGGESTION_TIME_BUDGET_SECONDS), SUGGESTION_TIME_BUDGET_SECONDS)
+    batch_size = min(int(body.get('batch_size') or SUGGESTION_BATCH_SIZE), MAX_BATCH_SIZE)
+    deadline = time.monotonic() + budget
+
+    cursor.execute("""
+        UPDATE suggestion_jobs
+        SET leased_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+        WHERE id = %s AND status = 'running' AND (leased_until IS NULL OR leased_until < NOW())
+        RETURNING id, user_id, segment, segment_bounds, calls_per_client, concurrency, last_client_id
+    """, (budget + LEASE_MARGIN_SECONDS, job_id))
+    job = cursor.fetchone()
+    conn.commit()
+    if not job:
+        cursor.execute("SELECT status FROM suggestion_jobs WHERE id = %s", (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return {'error': 'Job not found'}
+        if row['status'] != 'running':
+            return {'status': row['status'], 'processed': 0}
+        return {'error': 'Job is being processed by another worker'}
+
+    job = dict(job)
+    segment = load_segment_bounds(job)
+    totals = {'processed': 0, 'retried': 0, 'done': 0, 'failed': 0, 'cached': 0, 'batches': 0}
+    status = 'running'
+    # После основного прохода неудачные подсказки повторяются, каждая не чаще раза за вызов
+    retry_after = None
+
+    with ThreadPoolExecutor(max_workers=job['concurrency']) as executor:
+        while time.monotonic() < deadline:
+            if retry_after is None:
+                clients = fetch_batch(cursor, job, segment, batch_size)
+                if not clients:
+                    retry_after = 0
+                    continue
+            else:
+                clients = fetch_batch(cursor, job, segment, batch_size, retry_after=retry_after)
+                if not clients:
+                    if not has_retryable_failures(cursor, job_id):
+                        status = 'completed'
+                    break
+                retry_after = clients[-1]['id']
+            retried = len(clients) if retry_after is not None else 0
+            outcome = suggest_batch(cursor, job_id, clients, executor)
+            if not retried:
+                job['last_client_id'] = clients[-1]['id']
+            cursor.execute("""
+                UPDATE suggestion_jobs
+                SET last_client_id = %s, done = done + %s, failed = failed + %s - %s, cached = cached + %s,
+                    updated_at = NOW()
+                WHERE id = %s
+            """, (job['last_client_id'], outcome['done'], outcome['failed'], retried, outcome['cached'], job_id))
+            conn.commit()
+            totals['processed'] += len(clients)
+            totals['retried'] += retried
+            totals['batches'] += 1
+            for key in ('done', 'failed', 'cached'):
+                totals[key] += outcome[key]
+
+    cursor.execute("""
+        UPDATE suggestion_jobs
+        SET status = %s, leased_until = NULL, updated_at = NOW()
+        WHERE id = %s
+    """, (status, job_id))
+    conn.commit()
+    return {'status': status, **totals}
+
+
+def has_retryable_failures(cursor, job_id: int) -> bool:
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM client_suggestions
+            WHERE job_id = %s AND status = 'failed' AND attempts < %s
+        ) AS pending
+    """, (job_id, SUGGESTION_MAX_ATTEMPTS))
+    return cursor.fetchone()['pending']
+
+
+def fetch_batch(cursor, job: dict, segment: dict, batch_size: int, retry_after: int = None) -> list:
+    '''Следующая пачка клиентов сегмента с последними звонками — один запрос с оконной функцией.
+
+    С retry_after вместо сегмента берутся клиенты задания с неудачной подсказкой и
+    оставшимися попытками, по возрастанию id после retry_after.
+    '''
+    if retry_after is None:
+        source = f"""
+            FROM clients cl
+            LEFT JOIN lead_scores s ON s.client_id = cl.id
+            WHERE cl.id > %(after)s AND {SEGMENT_FILTER_SQL}
+        """
+    else:
+        source = """
+            FROM client_suggestions f
+            JOIN clients cl ON cl.id = f.client_id
+            LEFT JOIN lead_scores s ON s.client_id = cl.id
+            WHERE f.job_id = %(job_id)s AND f.status = 'failed' AND f.attempts < %(max_attempts)s
+            AND cl.id > %(after)s
+        """
+    cursor.execute(f"""
+        WITH batch AS (
+            SELECT cl.id, cl.name, cl.company, cl.status, COALESCE(s.score, 0) AS score
+            {source}
+            ORDER BY cl.id
+            LIMIT %(limit)s
+        ), recent AS (
+            SELECT
+                c.client_id, c.result, c.duration, c.transcript, c.created_at,
+                row_number() OVER (PARTITION BY c.client_id ORDER BY c.created_at DESC, c.id DESC) AS rn
+            FROM calls c
+            WHERE c.client_id IN (SELECT id FROM batch)
+        )
+        SELECT b.id, b.name, b.company, b.status, b.score, r.result, r.duration, r.transcript, r.created_at, r.rn
+        FROM batch b
+        LEFT JOIN recent r ON r.client_id = b.id AND r.rn <= %(calls)s
+        ORDER BY b.id, r.rn
+    """, {'after': job['last_client_id'] if retry_after is None else retry_after, 'limit': batch_size,
+          'calls': job['calls_per_client'], 'user_id': job['user_id'], 'job_id': job['id'],
+          'max_attempts': SUGGESTION_MAX_ATTEMPTS, **segment})
+
+    clients = []
+    for row in cursor.fetchall():
+        if not clients or clients[-1]['id'] != row['id']:
+            clients.append({key: row[key] for key in ('id', 'name', 'company', 'status', 'score')})
+            clients[-1]['calls'] = []
+        if row['rn'] is not None:
+            clients[-1]['calls'].append(row)
+    return clients
+
+
+def load_contact_windows(cursor, clients: list) -> dict:
+    '''Лучшие часы звонка для всей пачки: статистика клиентов и их сегментов одним запросом'''
+    cursor.execute("""
+        SELECT client_id, NULL AS segment, hour_of_week, attempts, successes
+        FROM client_contact_hours
+        WHERE client_id = ANY(%(client_ids)s)
+        UNION ALL
+        SELECT NULL, segment, hour_of_week, attempts, successes
+        FROM segment_contact_hours
+        WHERE segment = ANY(%(segments)s)
+    """, {
+        'client_ids': [client['id'] for client in clients],
+        'segments': sorted({client['status'] for client in clients})
+    })
+    by_client, by_segment = {}, {}
+    for row in cursor.fetchall():
+        if row['client_id'] is not None:
+            by_client.setdefault(row['client_id'], []).append(row)
+        else:
+            by_segment.setdefault(row['segment'], []).append(row)
+
+    return {
+        client['id']: best_windows(by_client.get(client['id'], []), by_segment.get(client['status'], []),
+                                   CONTACT_WINDOWS_IN_PROMPT)
+        for client in clients
+    }
+
+
+def client_prompt(client: dict, windows: list):
+    '''Промпт для одного клиента пачки; без дат относительно «сегодня», чтобы совпадать между прогонами.
+
+    Транскрипция только сжимается и обрезается: пересказ через модель на каждого клиента
+    сегмента стоил бы дороже самой подсказки.
+    '''
+    history = '\n'.join(
+        f"- {call['created_at'].strftime('%d.%m.%Y')}: {call['result']} (длительность: {call['duration']})"
+        for call in client['calls']
+    ) or 'Звонков не было'
+    last_transcript = next((call['transcript'] for call in client['calls'] if call['transcript']), None)
+
+    return prompts.build(
+        'segment_suggestion',
+        transcript=last_transcript,
+        summarize=None,
+        transcript_budget=TRANSCRIPT_PROMPT_TOKENS,
+        name=client['name'],
+        company=client['company'] or 'не указана',
+        status=client['status'],
+        score=client['score'],
+        contact_windows=', '.join(window['label'] for window in windows) or 'нет статистики',
+        history=history
+    )
+
+
+def prompt_hash(prompt) -> str:
+    return hashlib.sha256(f'{yandex_gpt.MODEL_URI}\n{yandex_gpt.SYSTEM_PROMPT}\n{prompt}'.encode('utf-8')).hexdigest()
+
+
+def suggest_batch(cursor, job_id: int, clients: list, executor) -> dict:
+    '''Промпты пачки, ответы из кэша по хэшу промпта, остальное — параллельно в модель'''
+    windows = load_contact_windows(cursor, clients)
+    batch_prompts = {}
+    for client in clients:
+        prompt = client_prompt(client, windows[client['id']])
+        client['prompt_hash'] = prompt_hash(prompt)
+        batch_prompts.setdefault(client['prompt_hash'], prompt)
+
+    cursor.execute("""
+        SELECT DISTINCT ON (prompt_hash) prompt_hash, suggestion
+        FROM client_suggestions
+        WHERE prompt_hash = ANY(%s) AND status = 'done'
+            AND created_at > NOW() - make_interval(hours => %s)
+        ORDER BY prompt_hash, created_at DESC
+    """, (list(batch_prompts), SUGGESTION_CACHE_HOURS))
+    cached = {row['prompt_hash']: row['suggestion'] for row in cursor.fetchall()}
+
+    def suggest(prompt):
+        try:
+            return yandex_gpt.complete(prompt, temperature=0.3, max_tokens=500), None
+        except Exception as e:
+            return None, str(e)
+
+    # Контекст копируется здесь, чтобы запросы к модели попали в Trace вызова
+    pending = [digest for digest in batch_prompts if digest not in cached]
+    futures = {digest: executor.submit(contextvars.copy_context().run, suggest, batch_prompts[digest]) for digest in pending}
+    answers = {digest: future.result() for digest, future in futures.items()}
+
+    outcome = {'done': 0, 'failed': 0, 'cached': 0}
+    rows = []
+    for client in clients:
+        digest = client['prompt_hash']
+        if digest in cached:
+            suggestion, error, from_cache = cached[digest], None, True
+            outcome['cached'] += 1
+        else:
+            (suggestion, error), from_cache = answers[digest], False
+        outcome['failed' if error else 'done'] += 1
+        rows.append((job_id, client['id'], client['score'], digest, suggestion, 'failed' if error else 'done', error, from_cache))
+
+    execute_values(cursor, """
+        INSERT INTO client_suggestions (job_id, client_id, score, prompt_hash, suggestion, status, error, cached)
+        VALUES %s
+        ON CONFLICT (job_id, client_id) DO UPDATE
+        SET score = EXCLUDED.score, prompt_hash = EXCLUDED.prompt_hash, suggestion = EXCLUDED.suggestion,
+            status = EXCLUDED.status, error = EXCLUDED.error, cached = EXCLUDED.cached,
+            attempts = client_suggestions.attempts + 1, created_at = NOW()
+    """, rows)
+    return outcome
+
+
+def get_suggestions(cursor, params):
+    '''Прогресс задания и страница подсказок по убыванию балла лида (keyset по индексу задания)'''
+    try:
+        job_id = int(params.get('job_id') or 0)
+        limit = min(max(int(params.get('limit', SUGGESTIONS_PAGE_SIZE)), 1), SUGGESTIONS_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'error': 'job_id and limit must be integers'}
+    if not job_id:
+        return {'error': 'job_id is required'}
+
+    cursor.execute("""
+        SELECT id, status, segment, total, done, failed, cached, created_at, updated_at
+        FROM suggestion_jobs
+        WHERE id = %s
+    """, (job_id,))
+    job = cursor.fetchone()
+    if not job:
+        return {'error': 'Job not found'}
+
+    # Курсор имеет вид "<балл>|<client_id>"
+    keyset = ""
+    sql_params = {'job_id': job_id, 'limit': limit + 1}
+    page_cursor = params.get('cursor')
+    if page_cursor:
+        try:
+            after_score, after_id = (int(part) for part in page_cursor.split('|', 1))
+        except ValueError:
+            return {'error': 'Invalid cursor'}
+        keyset = "AND (s.score < %(after_score)s OR (s.score = %(after_score)s AND s.client_id > %(after_id)s))"
+        sql_params.update(after_score=after_score, after_id=after_id)
+
+    cursor.execute(f"""
+        SELECT
+            s.client_id, c.name, c.company, c.phone, c.status AS client_status, s.score,
+            s.suggestion, s.status, s.error, s.cached, s.created_at
+        FROM client_suggestions s
+        JOIN clients c ON c.id = s.client_id
+        WHERE s.job_id = %(job_id)s {keyset}
+        ORDER BY s.score DESC, s.client_id
+        LIMIT %(limit)s
+    """, sql_params)
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['score']}|{rows[-1]['client_id']}"
+    return {'job': job, 'suggestions': rows, 'next_cursor': next_cursor}
@@ -0,0 +1,341 @@
+import contextvars
+import os
+import struct
+import threading
+import time
+import zlib
+
+import http_client
+
+
+# Синхронное распознавание SpeechKit принимает не больше 30 секунд и 1 МБ аудио
+CHUNK_MAX_SECONDS = 29
+CHUNK_MAX_BYTES = 1000 * 1024
+RECOGNIZE_CONCURRENCY = 4
+RECOGNIZE_TIMEOUT_SECONDS = 60
+DOWNLOAD_TIMEOUT_SECONDS = 30
+OPUS_SAMPLE_RATE = 48000
+TRANSCRIPT_WAIT_SECONDS = 45
+TRANSCRIPT_POLL_SECONDS = 0.5
+TRANSCRIPT_STALE_CLAIM_MINUTES = 10
+# Поток, ждущий распознавания той же записи в этом экземпляре, ждет не дольше захвата
+# в таблице и самого распознавания вместе
+TRANSCRIPT_LEADER_WAIT_SECONDS = 120
+
+PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+GRANULE_UNKNOWN = -1
+FLAG_CONTINUED = 0x01
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+
+_REVERSED_BITS = bytes(int(f'{byte:08b}'[::-1], 2) for byte in range(256))
+
+
+class TranscriptionError(Exception):
+    pass
+
+
+def ogg_crc(data: bytes) -> int:
+    '''CRC-32 страницы Ogg (полином 0x04C11DB7 без отражения), посчитанный через zlib.
+
+    zlib считает отраженный вариант того же полинома: переворачиваем биты входа и результата
+    и снимаем начальное и конечное XOR 0xFFFFFFFF.
+    '''
+    crc = zlib.crc32(data.translate(_REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f'{crc:032b}'[::-1], 2)
+
+
+class OggPage:
+    __slots__ = ('flags', 'granule', 'serial', 'sequence', 'lacing', 'data')
+
+    def __init__(self, flags, granule, serial, sequence, lacing, data):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.sequence = sequence
+        self.lacing = lacing
+        self.data = data
+
+    @property
+    def size(self) -> int:
+        return PAGE_HEADER.size + len(self.lacing) + len(self.data)
+
+    @property
+    def packets_completed(self) -> int:
+        return sum(1 for value in self.lacing if value < 255)
+
+    def encode(self, flags: int, granule: int, sequence: int) -> bytes:
+        header = PAGE_HEADER.pack(b'OggS', 0, flags, granule, self.serial, sequence, 0, len(self.lacing))
+        page = header + self.lacing + self.data
+        return page[:22] + struct.pack('<I', ogg_crc(page)) + page[26:]
+
+
+def read_pages(file):
+    '''Читает страницы Ogg из файла по одной, не загружая файл целиком'''
+    while True:
+        header = file.read(PAGE_HEADER.size)
+        if not header:
+            return
+        if len(header) < PAGE_HEADER.size:
+            raise TranscriptionError('Truncated Ogg page header')
+        capture, version, flags, granule, serial, sequence, _, segments = PAGE_HEADER.unpack(header)
+        if capture != b'OggS' or version != 0:
+            raise TranscriptionError('Invalid Ogg page')
+        lacing = file.read(segments)
+        data = file.read(sum(lacing))
+        yield OggPage(flags, granule, serial, sequence, lacing, data)
+
+
+def split_ogg_opus(file, max_seconds: float = CHUNK_MAX_SECONDS, max_bytes: int = CHUNK_MAX_BYTES):
+    '''Режет запись Ogg Opus на самостоятельные файлы, каждый в пределах лимитов распознавания.
+
+    Каждый фрагмент начинается с заголовков OpusHead/OpusTags исходного потока и
+    заканчивается на границе пакета. Номера страниц, granule position и флаг EOS
+    переписываются, чтобы фрагмент был корректным потоком. В памяти держится
+    только текущий фрагмент.
+    '''
+    pages = read_pages(file)
+
+    headers = []
+    completed = 0
+    for page in pages:
+        headers.append(page)
+        completed += page.packets_completed
+        if completed >= 2:
+            break
+    if completed < 2 or not headers[0].data.startswith(b'OpusHead'):
+        raise TranscriptionError('Recording is not an Ogg Opus stream')
+
+    pre_skip = struct.unpack_from('<H', headers[0].data, 10)[0]
+    header_bytes = b''.join(
+        page.encode(page.flags & ~FLAG_EOS, page.granule, index) for index, page in enumerate(headers)
+    )
+    max_samples = int(max_seconds * OPUS_SAMPLE_RATE)
+
+    def build(chunk, base):
+        encoded = [header_bytes]
+        for index, page in enumerate(chunk):
+            flags = page.flags & ~(FLAG_BOS | FLAG_EOS)
+            if index == len(chunk) - 1:
+                flags |= FLAG_EOS
+            granule = page.granule if page.granule == GRANULE_UNKNOWN else page.granule - base
+            encoded.append(page.encode(flags, granule, len(headers) + index))
+        return b''.join(encoded)
+
+    chunk, chunk_bytes = [], len(header_bytes)
+    base = 0
+    last_granule = 0
+    for page in pages:
+        granule = last_granule if page.granule == GRANULE_UNKNOWN else page.granule
+        over_limit = chunk_bytes + page.size > max_bytes or granule - base - pre_skip > max_samples
+        if chunk and over_limit and not page.flags & FLAG_CONTINUED:
+            yield build(chunk, base)
+            # Следующий фрагмент декодер начнет с пропуска pre_skip сэмплов, как и исходный поток
+            base = last_granule - pre_skip
+            chunk, chunk_bytes = [], len(header_bytes)
+        chunk.append(page)
+        chunk_bytes += page.size
+        last_granule = granule
+
+    if chunk:
+        yield build(chunk, base)
+
+
+def recognize_chunk(audio: bytes, api_key: str, folder_id: str, audio_format: str = 'oggopus') -> str:
+    '''Распознает один фрагмент через синхронный stt:recognize'''
+    import urllib.parse
+
+    stt_api_url = os.environ.get('YANDEX_STT_URL', 'https://stt.api.cloud.yandex.net')
+    params = urllib.parse.urlencode({
+        'lang': 'ru-RU',
+        'folderId': folder_id,
+        'format': audio_format
+    })
+    response = http_client.request(
+        'POST',
+        f'{stt_api_url}/speech/v1/stt:recognize?{params}',
+        body=audio,
+        headers={'Authorization': f'Api-Key {api_key}', 'Content-Type': 'audio/ogg'},
+        target='speechkit',
+        timeout=RECOGNIZE_TIMEOUT_SECONDS,
+        retries=2
+    )
+    return response.json().get('result', '')
+
+
+def recognize_chunks(chunks, recognize, concurrency: int = RECOGNIZE_CONCURRENCY) -> str:
+    '''Распознает фрагменты параллельно и склеивает текст в исходном порядке.
+
+    Новый фрагмент читается из генератора, только когда освобождается слот,
+    поэтому в памяти одновременно не больше concurrency фрагментов.
+    '''
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    texts = {}
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, chunk in enumerate(chunks):
+            if len(pending) >= concurrency:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    texts[pending.pop(future)] = future.result()
+            # Контекст копируется здесь, чтобы вызовы SpeechKit попали в Trace вызова
+            pending[executor.submit(contextvars.copy_context().run, recognize, chunk)] = index
+        for future, index in pending.items():
+            texts[index] = future.result()
+
+    return ' '.join(text.strip() for _, text in sorted(texts.items()) if text and text.strip())
+
+
+def recognize_file(file, api_key: str, folder_id: str) -> str:
+    '''Распознает скачанную запись: Ogg Opus фрагментами, остальное одним запросом'''
+
+    def recognize(chunk):
+        return recognize_chunk(chunk, api_key, folder_id)
+
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+
+    if file.read(4) != b'OggS':
+        # Не Ogg: короткую запись отправляем как раньше одним запросом, длинную разрезать нельзя
+        if size > CHUNK_MAX_BYTES:
+            raise TranscriptionError('Recording is too long for recognition and is not Ogg Opus')
+        file.seek(0)
+        return recognize(file.read())
+
+    file.seek(0)
+    return recognize_chunks(split_ogg_opus(file), recognize)
+
+
+def download_recording(recording_url: str, file) -> str:
+    '''Скачивает запись в файл потоком и возвращает SHA-256 содержимого'''
+    import hashlib
+
+    http_client.request('GET', recording_url, target='mango_recording',
+                        timeout=DOWNLOAD_TIMEOUT_SECONDS, retries=2, sink=file)
+    file.seek(0)
+    return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def transcribe_recording(recording_url: str, api_key: str, folder_id: str) -> str:
+    '''Скачивает запись во временный файл и распознает ее фрагментами.
+
+    Память не зависит от длины звонка: запись пишется на диск потоком,
+    а в памяти одновременно находится не больше RECOGNIZE_CONCURRENCY фрагментов.
+    '''
+    import tempfile
+
+    with tempfile.TemporaryFile() as file:
+        download_recording(recording_url, file)
+        return recognize_file(file, api_key, folder_id)
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def transcribe_cached(connect, recording_url: str, api_key: str, folder_id: str) -> str:
+    '''Транскрипция с кэшем в таблице transcripts по URL записи и SHA-256 аудио.
+
+    Повторный запрос той же записи (дубли события Disconnected, повторный анализ)
+    не обращается к SpeechKit. Параллельные запросы одной записи распознаются один раз:
+    внутри экземпляра функции ждут общий результат, между экземплярами — строку
+    transcripts в статусе pending, захваченную первым запросом.
+
+    Захват и кэш живут в отдельном подключении из connect() в режиме autocommit:
+    транзакцию вызывающего (вебхук со звонком, баллом и событием outbox) модуль не
+    коммитит и не откатывает.
+    '''
+    with _inflight_lock:
+        waiter = _inflight.get(recording_url)
+        if waiter is None:
+            owner = _inflight[recording_url] = _InFlight()
+    if waiter is not None:
+        if not waiter.done.wait(TRANSCRIPT_LEADER_WAIT_SECONDS):
+            # Распознавание в соседнем потоке зависло: не ждем его до таймаута функции
+            return transcribe_recording(recording_url, api_key, folder_id)
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.result
+
+    try:
+        conn = connect()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                owner.result = _transcribe_through_table(cursor, recording_url, api_key, folder_id)
+        finally:
+            conn.close()
+        return owner.result
+    except Exception as e:
+        owner.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[recording_url]
+        owner.done.set()
+
+
+def _transcribe_through_table(cursor, recording_url: str, api_key: str, folder_id: str) -> str:
+    import tempfile
+
+    deadline = time.monotonic() + TRANSCRIPT_WAIT_SECONDS
+    while True:
+        cursor.execute("""
+            SELECT status, transcript FROM transcripts WHERE recording_url = %s
+        """, (recording_url,))
+        row = cursor.fetchone()
+        if row and row['status'] == 'done':
+            return row['transcript']
+
+        cursor.execute(f"""
+            INSERT INTO transcripts (recording_url)
+            VALUES (%s)
+            ON CONFLICT (recording_url) DO UPDATE
+            SET status = 'pending', claimed_at = NOW(), updated_at = NOW()
+            WHERE transcripts.status = 'failed'
+            OR (transcripts.status = 'pending'
+                AND transcripts.claimed_at < NOW() - INTERVAL '{TRANSCRIPT_STALE_CLAIM_MINUTES} minutes')
+            RETURNING id
+        """, (recording_url,))
+        claimed = cursor.fetchone()
+
+        if claimed is not None:
+            break
+        if time.monotonic() >= deadline:
+            # Захват держит другой экземпляр дольше ожидаемого: распознаем без записи в кэш
+            return transcribe_recording(recording_url, api_key, folder_id)
+        time.sleep(TRANSCRIPT_POLL_SECONDS)
+
+    transcript_id = claimed['id']
+    try:
+        with tempfile.TemporaryFile() as file:
+            content_hash = download_recording(recording_url, file)
+
+            # Та же запись могла прийти под другим URL (ссылки MANGO подписаны и меняются)
+            cursor.execute("""
+                SELECT transcript FROM transcripts
+                WHERE content_hash = %s AND status = 'done'
+                LIMIT 1
+            """, (content_hash,))
+            row = cursor.fetchone()
+            transcript = row['transcript'] if row else recognize_file(file, api_key, folder_id)
+    except Exception:
+        cursor.execute("""
+            UPDATE transcripts SET status = 'failed', updated_at = NOW() WHERE id = %s
+        """, (transcript_id,))
+        raise
+
+    cursor.execute("""
+        UPDATE transcripts
+        SET status = 'done', content_hash = %s, transcript = %s, updated_at = NOW()
+        WHERE id = %s
+    """, (content_hash, transcript, transcript_id))
+    return transcript
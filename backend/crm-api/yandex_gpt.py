@@ -0,0 +1,70 @@
+import os
+
+import http_client
+from instrumentation import record_usage
+
+
+MODEL_URI = 'gpt://b1gjbflgkc6kmaki44db/yandexgpt/rc'
+SYSTEM_PROMPT = (
+    'Ты — ИИ-помощник для CRM системы компании по продаже автозапчастей. '
+    'Помогаешь менеджерам анализировать звонки и планировать работу с клиентами.'
+)
+
+
+class GPTNotConfigured(Exception):
+    pass
+
+
+class GPTError(Exception):
+    pass
+
+
+def complete(prompt, temperature: float = 0.7, max_tokens: int = 2000) -> str:
+    '''Один запрос к YandexGPT; ошибки поднимаются исключениями, чтобы вызывающий код мог их не кэшировать.
+
+    prompt — строка или prompts.Prompt; для Prompt оценка токенов до и после сжатия
+    и фактический расход из ответа модели попадают в Trace вызова.
+    '''
+    yandex_api_key = os.environ.get('YANDEX_API_KEY')
+    yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID')
+    if not yandex_api_key or not yandex_folder_id:
+        raise GPTNotConfigured('YANDEX_API_KEY and YANDEX_FOLDER_ID are not set')
+
+    gpt_api_url = os.environ.get('YANDEX_GPT_URL', 'https://llm.api.cloud.yandex.net')
+    request_data = {
+        'modelUri': MODEL_URI,
+        'completionOptions': {
+            'stream': False,
+            'temperature': temperature,
+            'maxTokens': max_tokens
+        },
+        'messages': [
+            {'role': 'system', 'text': SYSTEM_PROMPT},
+            {'role': 'user', 'text': str(prompt)}
+        ]
+    }
+    headers = {
+        'Authorization': f'Api-Key {yandex_api_key}',
+        'x-folder-id': yandex_folder_id
+    }
+
+    result = http_client.post_json(
+        f'{gpt_api_url}/foundationModels/v1/completion', request_data, headers,
+        target='yandexgpt', timeout=30, retries=2
+    ).json()
+
+    usage = result.get('result', {}).get('usage', {})
+    record_usage(
+        f"yandexgpt.{getattr(prompt, 'template', 'raw')}",
+        requests=1,
+        prompt_tokens=getattr(prompt, 'tokens', 0),
+        raw_prompt_tokens=getattr(prompt, 'raw_tokens', 0),
+        input_tokens=int(usage.get('inputTextTokens') or 0),
+        completion_tokens=int(usage.get('completionTokens') or 0)
+    )
+
+    # Текст ответа в структуре YandexGPT
+    alternatives = result.get('result', {}).get('alternatives', [])
+    if not alternatives:
+        raise GPTError('Ошибка получения ответа от агента')
+    return alternatives[0].get('message', {}).get('text', 'Ответ не получен')
@@ -36,6 +36,7 @@ def handler(event: dict, context) -> dict:
         smtp_port = int(os.environ.get('SMTP_PORT', '587'))
         smtp_user = os.environ.get('SMTP_USER')
         smtp_password = os.environ.get('SMTP_PASSWORD')
+        smtp_starttls = os.environ.get('SMTP_STARTTLS', 'true').lower() != 'false'
         
         if not all([smtp_host, smtp_user, smtp_password]):
             return {
@@ -145,7 +146,8 @@ def handler(event: dict, context) -> dict:
             msg.attach(part2)
             
             with smtplib.SMTP(smtp_host, smtp_port) as server:
-                server.starttls()
+                if smtp_starttls:
+                    server.starttls()
                 server.login(smtp_user, smtp_password)
                 server.send_message(msg)
             
@@ -281,7 +283,8 @@ def handler(event: dict, context) -> dict:
             msg.attach(part2)
             
             with smtplib.SMTP(smtp_host, smtp_port) as server:
-                server.starttls()
+                if smtp_starttls:
+                    server.starttls()
                 server.login(smtp_user, smtp_password)
                 server.send_message(msg)
             
@@ -383,7 +386,8 @@ def handler(event: dict, context) -> dict:
             msg.attach(part2)
             
             with smtplib.SMTP(smtp_host, smtp_port) as server:
-                server.starttls()
+                if smtp_starttls:
+                    server.starttls()
                 server.login(smtp_user, smtp_password)
                 server.send_message(msg)
             
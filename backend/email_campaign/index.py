@@ -3,6 +3,102 @@ import os
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from metering import QuotaExceeded, consume, refund
+
+
+def bump_campaigns_version(cursor):
+    '''Меняет версию кампаний в data_versions: по ней crm-api отдает ETag статистики'''
+    cursor.execute("""
+        INSERT INTO data_versions (name, version) VALUES ('email_campaigns', 1)
+        ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1, updated_at = NOW()
+    """)
+
+
+def start_campaign(user_id, subject: str):
+    '''Списывает рассылку из месячной квоты тарифа и создает запись кампании.
+
+    Возвращает id кампании либо None, если учет использования не настроен.
+    '''
+    dsn = os.environ.get('DATABASE_URL')
+    if not user_id or not dsn:
+        return None
+    
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    
+    conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    try:
+        cursor = conn.cursor()
+        consume(cursor, user_id, 'email_campaigns')
+        cursor.execute("""
+            INSERT INTO email_campaigns (name, status, user_id)
+            VALUES (%s, 'active', %s)
+            RETURNING id
+        """, (subject[:255], user_id))
+        campaign_id = cursor.fetchone()['id']
+        bump_campaigns_version(cursor)
+        conn.commit()
+        return campaign_id
+    finally:
+        conn.close()
+
+
+def finish_campaign(campaign_id, sent_emails: list):
+    '''Записывает итог рассылки в кампанию и счетчики писем в признаки скоринга лидов'''
+    if not campaign_id:
+        return
+    
+    import psycopg2
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE email_campaigns
+            SET sent = %s, status = 'completed', updated_at = NOW()
+            WHERE id = %s
+        """, (len(sent_emails), campaign_id))
+        bump_campaigns_version(cursor)
+        
+        # Получатели сопоставляются с клиентами по уникальному email без учета регистра
+        # (индекс uq_clients_email по lower(email)) одним запросом
+        if sent_emails:
+            cursor.execute("""
+                INSERT INTO lead_scores (client_id, emails_sent, last_email_at)
+                SELECT id, 1, NOW() FROM clients WHERE lower(email) = ANY(%s) AND email <> ''
+                ON CONFLICT (client_id) DO UPDATE
+                SET emails_sent = lead_scores.emails_sent + 1,
+                    last_email_at = NOW(),
+                    updated_at = NOW()
+            """, ([email.strip().lower() for email in sent_emails],))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def cancel_campaign(campaign_id):
+    '''Рассылка не ушла ни одному получателю: кампания удаляется, списание возвращается в квоту'''
+    if not campaign_id:
+        return
+    
+    import psycopg2
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM email_campaigns
+            WHERE id = %s
+            RETURNING user_id, to_char(created_at, 'YYYY-MM')
+        """, (campaign_id,))
+        campaign = cursor.fetchone()
+        if campaign:
+            refund(cursor, campaign[0], 'email_campaigns', period=campaign[1])
+            bump_campaigns_version(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
 
 def handler(event: dict, context) -> dict:
     '''API для отправки email рассылок клиентам с уведомлением на zakaz6377@yandex.ru'''
@@ -49,42 +145,62 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
+            try:
+                campaign_id = start_campaign(body.get('user_id'), subject)
+            except QuotaExceeded as e:
+                return {
+                    'statusCode': 403,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps(e.as_result()),
+                    'isBase64Encoded': False
+                }
+            
             results = []
             success_count = 0
             failed_count = 0
             
-            server = smtplib.SMTP(smtp_host, smtp_port, timeout=15)
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            
-            for recipient in recipients:
-                try:
-                    msg = MIMEMultipart('alternative')
-                    msg['Subject'] = subject
-                    msg['From'] = smtp_username
-                    msg['To'] = recipient['email']
-                    
-                    html = f"<html><body><p>Здравствуйте, {recipient['name']}!</p><div>{message.replace('\n', '<br>')}</div></body></html>"
-                    msg.attach(MIMEText(html, 'html'))
-                    server.send_message(msg)
-                    
-                    results.append({'email': recipient['email'], 'name': recipient['name'], 'status': 'sent'})
-                    success_count += 1
-                except Exception as e:
-                    results.append({'email': recipient['email'], 'name': recipient['name'], 'status': 'failed', 'error': str(e)})
-                    failed_count += 1
-            
-            report_msg = MIMEMultipart('alternative')
-            report_msg['Subject'] = f'Отчет: {subject}'
-            report_msg['From'] = smtp_username
-            report_msg['To'] = 'zakaz6377@yandex.ru'
-            
-            rows = ''.join([f"<tr><td>{r['name']}</td><td>{r['email']}</td><td>{'✅' if r['status'] == 'sent' else '❌'}</td></tr>" for r in results])
-            report_html = f"<html><body><h2>Отчет о рассылке</h2><p>Отправлено: {success_count}, Ошибок: {failed_count}</p><table border='1'><tr><th>Имя</th><th>Email</th><th>Статус</th></tr>{rows}</table></body></html>"
-            
-            report_msg.attach(MIMEText(report_html, 'html'))
-            server.send_message(report_msg)
-            server.quit()
+            # Квота списана до отправки: что бы ни случилось с SMTP, кампания получает итог.
+            # Если не ушло ни одного письма, кампания удаляется и списание возвращается
+            try:
+                server = smtplib.SMTP(smtp_host, smtp_port, timeout=15)
+                if os.environ.get('SMTP_STARTTLS', 'true').lower() != 'false':
+                    server.starttls()
+                server.login(smtp_username, smtp_password)
+                
+                for recipient in recipients:
+                    try:
+                        msg = MIMEMultipart('alternative')
+                        msg['Subject'] = subject
+                        msg['From'] = smtp_username
+                        msg['To'] = recipient['email']
+                        
+                        html = f"<html><body><p>Здравствуйте, {recipient['name']}!</p><div>{message.replace('\n', '<br>')}</div></body></html>"
+                        msg.attach(MIMEText(html, 'html'))
+                        server.send_message(msg)
+                        
+                        results.append({'email': recipient['email'], 'name': recipient['name'], 'status': 'sent'})
+                        success_count += 1
+                    except Exception as e:
+                        results.append({'email': recipient['email'], 'name': recipient['name'], 'status': 'failed', 'error': str(e)})
+                        failed_count += 1
+                
+                report_msg = MIMEMultipart('alternative')
+                report_msg['Subject'] = f'Отчет: {subject}'
+                report_msg['From'] = smtp_username
+                report_msg['To'] = 'zakaz6377@yandex.ru'
+                
+                rows = ''.join([f"<tr><td>{r['name']}</td><td>{r['email']}</td><td>{'✅' if r['status'] == 'sent' else '❌'}</td></tr>" for r in results])
+                report_html = f"<html><body><h2>Отчет о рассылке</h2><p>Отправлено: {success_count}, Ошибок: {failed_count}</p><table border='1'><tr><th>Имя</th><th>Email</th><th>Статус</th></tr>{rows}</table></body></html>"
+                
+                report_msg.attach(MIMEText(report_html, 'html'))
+                server.send_message(report_msg)
+                server.quit()
+            finally:
+                sent_emails = [r['email'] for r in results if r['status'] == 'sent']
+                if sent_emails:
+                    finish_campaign(campaign_id, sent_emails)
+                else:
+                    cancel_campaign(campaign_id)
             
             return {
                 'statusCode': 200,
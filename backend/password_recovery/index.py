@@ -56,7 +56,8 @@ def handler(event: dict, context) -> dict:
                     }
                 
                 server = smtplib.SMTP(smtp_host, smtp_port, timeout=15)
-                server.starttls()
+                if os.environ.get('SMTP_STARTTLS', 'true').lower() != 'false':
+                    server.starttls()
                 server.login(smtp_username, smtp_password)
                 
                 msg = MIMEMultipart('alternative')
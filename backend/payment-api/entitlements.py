@@ -0,0 +1,122 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+PLAN_LIMITS_TTL_SECONDS = 300
+ENTITLEMENT_TTL_SECONDS = 30
+ENTITLEMENT_CACHE_SIZE = 5000
+
+PLAN_COLUMNS = (
+    'plan_type',
+    'max_clients',
+    'max_calls_per_month',
+    'max_email_campaigns',
+    'ai_analysis_enabled',
+    'ai_suggestions_enabled',
+    'priority_support',
+    'price_monthly',
+    'price_yearly'
+)
+
+# Признак промаха: без курсора ответ из памяти получить не удалось
+MISS = object()
+
+
+class PlanLimitsCache:
+    '''Тарифы в памяти экземпляра функции.
+
+    Таблица перечитывается не чаще раза в ttl секунд; версия — хэш содержимого
+    plan_limits и меняется только при реальном изменении тарифов.
+    '''
+
+    def __init__(self, ttl: float = PLAN_LIMITS_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.plans = None
+        self.version = None
+        self.loaded_at = 0.0
+
+    def is_fresh(self) -> bool:
+        return self.plans is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def get_all(self, cursor=None):
+        '''Словарь plan_type -> лимиты в порядке возрастания цены либо MISS'''
+        if self.is_fresh():
+            return self.plans
+        if cursor is None:
+            return MISS
+
+        cursor.execute(f"""
+            SELECT {', '.join(PLAN_COLUMNS)}
+            FROM plan_limits
+            ORDER BY price_monthly ASC
+        """)
+        plans = OrderedDict((row['plan_type'], dict(row)) for row in cursor.fetchall())
+        version = hashlib.sha1(
+            json.dumps(list(plans.values()), sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()[:16]
+
+        with self.lock:
+            self.plans = plans
+            self.version = version
+            self.loaded_at = time.monotonic()
+        return plans
+
+    def get(self, plan_type: str, cursor=None):
+        '''Лимиты одного тарифа, None для неизвестного тарифа либо MISS'''
+        plans = self.get_all(cursor)
+        if plans is MISS:
+            return MISS
+        return plans.get(plan_type)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = 0.0
+
+
+class EntitlementCache:
+    '''Активная подписка пользователя (или ее отсутствие) с коротким TTL и LRU-вытеснением'''
+
+    def __init__(self, ttl: float = ENTITLEMENT_TTL_SECONDS, size: int = ENTITLEMENT_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        key = str(user_id)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return MISS
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, subscription):
+        with self.lock:
+            self.entries[str(user_id)] = (time.monotonic() + self.ttl, subscription)
+            self.entries.move_to_end(str(user_id))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(str(user_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+plan_limits_cache = PlanLimitsCache()
+entitlement_cache = EntitlementCache()
@@ -0,0 +1,267 @@
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from instrumentation import outbound_call, register_stats
+
+
+DEFAULT_TIMEOUT = float(os.environ.get('HTTP_CLIENT_TIMEOUT', '30'))
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_IDLE_PER_HOST = int(os.environ.get('HTTP_CLIENT_MAX_IDLE', '8'))
+IDLE_TTL_SECONDS = 50
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 5.0
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+
+
+class HTTPError(Exception):
+    '''Ответ с кодом 4xx/5xx; тело ответа доступно в body'''
+
+    def __init__(self, status: int, body: bytes, url: str):
+        self.status = status
+        self.body = body
+        self.url = url
+        super().__init__(f'HTTP {status} from {urlsplit(url).netloc}')
+
+    def text(self) -> str:
+        return self.body.decode('utf-8', 'replace')
+
+
+class CircuitOpenError(Exception):
+    '''Хост временно исключен после серии отказов'''
+
+
+class Response:
+    def __init__(self, status: int, headers: dict, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self) -> str:
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+class CircuitBreaker:
+    '''Размыкается после BREAKER_FAILURE_THRESHOLD отказов подряд; через BREAKER_RESET_SECONDS пропускает пробный запрос'''
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= BREAKER_RESET_SECONDS else 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record(self, ok: bool):
+        self.probing = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+
+class HostPool:
+    '''Keep-alive соединения с одним хостом, переживающие вызовы в рамках экземпляра функции'''
+
+    def __init__(self, scheme: str, host: str, port):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.breaker = CircuitBreaker()
+        self.stats = {'requests': 0, 'connections': 0, 'reused': 0, 'retries': 0, 'errors': 0, 'rejected': 0}
+
+    def acquire(self, timeout: float):
+        now = time.monotonic()
+        while self.idle:
+            conn, released_at = self.idle.pop()
+            if now - released_at < IDLE_TTL_SECONDS:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+        return self.connect(timeout), False
+
+    def connect(self, timeout: float):
+        import http.client
+
+        self.stats['connections'] += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=_ssl_context())
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def release(self, conn):
+        if len(self.idle) < MAX_IDLE_PER_HOST:
+            self.idle.append((conn, time.monotonic()))
+        else:
+            conn.close()
+
+
+_pools = {}
+_lock = threading.Lock()
+_ssl = None
+
+
+def _ssl_context():
+    global _ssl
+    if _ssl is None:
+        import ssl
+        _ssl = ssl.create_default_context()
+    return _ssl
+
+
+def _pool(scheme: str, netloc: str) -> HostPool:
+    key = (scheme, netloc)
+    pool = _pools.get(key)
+    if pool is None:
+        host, _, port = netloc.rpartition(':') if ':' in netloc else (netloc, '', '')
+        pool = _pools.setdefault(key, HostPool(scheme, host, int(port) if port else None))
+    return pool
+
+
+def backoff_delay(attempt: int) -> float:
+    '''Экспоненциальная задержка с полным джиттером'''
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def request(method: str, url: str, body: bytes = None, headers: dict = None, target: str = None,
+            timeout: float = None, retries: int = 0, sink=None) -> Response:
+    '''Выполняет HTTP-запрос через пул соединений хоста.
+
+    retries — число повторов при сетевых ошибках и ответах 429/502/503/504;
+    для неидемпотентных запросов оставляйте 0. Запрос, упавший на переиспользованном
+    соединении до получения ответа (сервер закрыл простаивающее соединение), повторяется
+    на новом соединении не больше одного раза и только если метод идемпотентный или
+    retries > 0; такой повтор входит в число попыток.
+
+    Если передан sink (файл, открытый на запись в бинарном режиме), успешный ответ
+    пишется в него блоками по STREAM_CHUNK_SIZE, а Response.body остается пустым.
+    '''
+    import http.client
+
+    parts = urlsplit(url)
+    pool = _pool(parts.scheme, parts.netloc)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    timeout = timeout or DEFAULT_TIMEOUT
+
+    with outbound_call(target or parts.netloc):
+        attempt = 0
+        replayed = False
+        while True:
+            with _lock:
+                if not pool.breaker.allow():
+                    pool.stats['rejected'] += 1
+                    raise CircuitOpenError(f'Circuit open for {parts.netloc}')
+                pool.stats['requests'] += 1
+                # После повтора на закрытом соединении соседние простаивающие, скорее всего, тоже закрыты
+                conn, reused = (pool.connect(timeout), False) if replayed else pool.acquire(timeout)
+                if reused:
+                    pool.stats['reused'] += 1
+
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                raw = conn.getresponse()
+                if sink is not None and raw.status < 400:
+                    response = Response(raw.status, dict(raw.getheaders()), b'')
+                    _drain(raw, sink)
+                else:
+                    response = Response(raw.status, dict(raw.getheaders()), raw.read())
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused and (retries > 0 or method.upper() in IDEMPOTENT_METHODS):
+                    # Простаивавшее соединение закрыто сервером: один повтор на новом соединении
+                    attempt += 1
+                    replayed = True
+                    with _lock:
+                        pool.breaker.probing = False
+                        pool.stats['retries'] += 1
+                    continue
+                error = e
+                response = None
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                error = e
+                response = None
+
+            failed = response is None or response.status >= 500
+            with _lock:
+                pool.breaker.record(not failed)
+                if response is not None and not raw.will_close:
+                    pool.release(conn)
+                elif response is not None:
+                    conn.close()
+                if failed:
+                    pool.stats['errors'] += 1
+
+            retryable = response is None or response.status in RETRY_STATUSES
+            if retryable and attempt < retries:
+                attempt += 1
+                with _lock:
+                    pool.stats['retries'] += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if response is None:
+                raise error
+            if response.status >= 400:
+                raise HTTPError(response.status, response.body, url)
+            return response
+
+
+def _drain(raw, sink):
+    '''Переписывает тело ответа в sink; повтор после обрыва начинает файл заново'''
+    sink.seek(0)
+    sink.truncate()
+    while True:
+        block = raw.read(STREAM_CHUNK_SIZE)
+        if not block:
+            break
+        sink.write(block)
+    sink.flush()
+
+
+def post_json(url: str, payload, headers: dict = None, **kwargs) -> Response:
+    '''POST с JSON-телом'''
+    all_headers = {'Content-Type': 'application/json'}
+    all_headers.update(headers or {})
+    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return request('POST', url, body=data, headers=all_headers, **kwargs)
+
+
+def pool_stats() -> dict:
+    '''Накопленная статистика пулов по хостам за время жизни экземпляра'''
+    with _lock:
+        return {
+            f'{scheme}://{netloc}': {**pool.stats, 'idle': len(pool.idle), 'circuit': pool.breaker.state}
+            for (scheme, netloc), pool in _pools.items()
+        }
+
+
+register_stats('http_pool', pool_stats)
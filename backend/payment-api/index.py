@@ -1,13 +1,24 @@
+import contextvars
+import hashlib
 import json
 import os
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import serialization
+import compression
 from datetime import datetime, timedelta
-import urllib.request
-import urllib.parse
-import uuid
-import hashlib
-import hmac
+from psycopg2.extras import execute_values
+from instrumentation import TracedCursor, instrumented
+from entitlements import MISS, plan_limits_cache, entitlement_cache
+import metering
+import outbox
+from renewals import RENEWAL_BATCH_SIZE, claim_due_renewals, record_outcomes, run_renewals
+
+
+NOTIFY_BATCH_SIZE = 200
+NOTIFY_CONCURRENCY = 8
+NOTIFY_MAX_ATTEMPTS = 3
+NOTIFY_TIME_BUDGET_SECONDS = 50
 
 
 def get_db_connection():
@@ -15,9 +26,10 @@ def get_db_connection():
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
         raise Exception('DATABASE_URL environment variable is not set')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    return psycopg2.connect(dsn, cursor_factory=TracedCursor)
 
 
+@instrumented('payment-api')
 def handler(event: dict, context) -> dict:
     '''API для обработки платежей через ЮKassa: создание платежей, обработка вебхуков, управление подписками'''
     
@@ -29,7 +41,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -37,11 +49,29 @@ def handler(event: dict, context) -> dict:
         }
     
     try:
+        params = event.get('queryStringParameters', {}) or {}
+        path = params.get('path', 'plans')
+        
+        # ETag тарифов и подписки — версии кэшей экземпляра; совпадение с If-None-Match
+        # отвечается 304 без сборки и сериализации ответа
+        etag = resource_etag(None, path, params) if method == 'GET' else None
+        if etag and etag is not MISS and etag_matches(event, etag):
+            return not_modified_response(etag)
+        
+        # Тарифы, подписка и проверка доступа чаще всего отвечаются из памяти экземпляра без подключения к БД
+        cached = answer_from_memory(method, path, params, event)
+        if cached is not MISS:
+            return compression.compress_response(success_response(cached, None if etag is MISS else etag), event)
+        
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        params = event.get('queryStringParameters', {}) or {}
-        path = params.get('path', 'plans')
+        if etag is MISS:
+            etag = resource_etag(cursor, path, params)
+            if etag and etag_matches(event, etag):
+                cursor.close()
+                conn.close()
+                return not_modified_response(etag)
         
         if method == 'GET':
             if path == 'plans':
@@ -52,6 +82,11 @@ def handler(event: dict, context) -> dict:
             elif path == 'payment_history':
                 user_id = params.get('user_id')
                 result = get_payment_history(cursor, user_id)
+            elif path == 'usage':
+                user_id = params.get('user_id')
+                result = get_usage(cursor, user_id)
+            elif path == 'changes':
+                result = get_changes(cursor, params)
             else:
                 result = {'error': 'Unknown path'}
         
@@ -71,8 +106,12 @@ def handler(event: dict, context) -> dict:
                 result = check_expiring_subscriptions(cursor, conn)
             elif path == 'renew_subscription':
                 result = renew_subscription(cursor, conn, body)
+            elif path == 'run_renewals':
+                result = run_auto_renewals(cursor, conn, body)
             elif path == 'update_auto_renew':
                 result = update_auto_renew(cursor, conn, body)
+            elif path == 'reconcile_usage':
+                result = reconcile_usage(cursor, conn, body)
             else:
                 result = {'error': 'Unknown path'}
         
@@ -82,34 +121,93 @@ def handler(event: dict, context) -> dict:
         cursor.close()
         conn.close()
         
-        return success_response(result)
+        return compression.compress_response(success_response(result, etag), event)
     
     except Exception as e:
         return error_response(str(e))
 
 
-def get_plans(cursor):
-    '''Получает список доступных тарифных планов'''
+def answer_from_memory(method, path, params, event):
+    '''Ответ только из кэшей экземпляра; MISS, если без БД не обойтись'''
+    
+    if method == 'GET' and path == 'plans':
+        return get_plans(None)
+    if method == 'GET' and path == 'subscription':
+        return get_user_subscription(None, params.get('user_id'))
+    if method == 'POST' and path == 'check_access':
+        body_str = event.get('body', '{}')
+        return check_feature_access(None, json.loads(body_str) if body_str else {})
+    return MISS
+
+
+def resource_etag(cursor, path, params):
+    '''ETag ответа GET по версиям кэшей, без сборки тела; None — путь без ETag, MISS — нужна БД'''
+    
+    if path == 'plans':
+        if plan_limits_cache.get_all(cursor) is MISS:
+            return MISS
+        return f'W/"plans-{plan_limits_cache.version}"'
+    
+    if path == 'subscription' and params.get('user_id'):
+        subscription = get_entitlement(cursor, params['user_id'])
+        if subscription is MISS:
+            return MISS
+        # Лимиты тарифа покрывает версия тарифов, от подписки берутся только ее собственные поля
+        fields = (
+            (subscription['id'], subscription['status'], subscription['start_date'],
+             subscription['end_date'], subscription['auto_renew'])
+            if subscription else None
+        )
+        stamp = hashlib.sha1(repr(fields).encode('utf-8')).hexdigest()[:16]
+        return f'W/"subscription-{plan_limits_cache.version}-{stamp}"'
+    
+    return None
+
+
+def get_active_subscription(cursor, user_id):
+    '''Активная подписка пользователя через кэш; при cursor=None промах возвращается как MISS'''
+    
+    subscription = entitlement_cache.get(user_id)
+    if subscription is not MISS or cursor is None:
+        return subscription
     
     cursor.execute("""
-        SELECT 
-            plan_type, 
-            max_clients, 
-            max_calls_per_month, 
-            max_email_campaigns,
-            ai_analysis_enabled,
-            ai_suggestions_enabled,
-            priority_support,
-            price_monthly,
-            price_yearly
-        FROM plan_limits
-        ORDER BY price_monthly ASC
-    """)
+        SELECT id, plan_type, status, start_date, end_date, auto_renew
+        FROM subscriptions
+        WHERE user_id = %s AND status = 'active'
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, (user_id,))
     
-    plans = cursor.fetchall()
+    row = cursor.fetchone()
+    subscription = dict(row) if row else None
+    entitlement_cache.put(user_id, subscription)
+    return subscription
+
+
+def get_entitlement(cursor, user_id):
+    '''Активная подписка вместе с лимитами ее тарифа, None без подписки либо MISS'''
+    
+    subscription = get_active_subscription(cursor, user_id)
+    if subscription is MISS or subscription is None:
+        return subscription
+    
+    plan = plan_limits_cache.get(subscription['plan_type'], cursor)
+    if plan is MISS or plan is None:
+        return plan
+    
+    return {**subscription, **plan}
+
+
+def get_plans(cursor):
+    '''Получает список доступных тарифных планов'''
+    
+    plans = plan_limits_cache.get_all(cursor)
+    if plans is MISS:
+        return MISS
     
     return {
-        'plans': [dict(p) for p in plans]
+        'plans': list(plans.values())
     }
 
 
@@ -119,30 +217,9 @@ def get_user_subscription(cursor, user_id):
     if not user_id:
         return {'error': 'user_id is required'}
     
-    cursor.execute("""
-        SELECT 
-            s.id,
-            s.plan_type,
-            s.status,
-            s.start_date,
-            s.end_date,
-            s.auto_renew,
-            pl.max_clients,
-            pl.max_calls_per_month,
-            pl.max_email_campaigns,
-            pl.ai_analysis_enabled,
-            pl.ai_suggestions_enabled,
-            pl.priority_support,
-            pl.price_monthly,
-            pl.price_yearly
-        FROM subscriptions s
-        JOIN plan_limits pl ON s.plan_type = pl.plan_type
-        WHERE s.user_id = %s AND s.status = 'active'
-        ORDER BY s.created_at DESC
-        LIMIT 1
-    """, (user_id,))
-    
-    subscription = cursor.fetchone()
+    subscription = get_entitlement(cursor, user_id)
+    if subscription is MISS:
+        return MISS
     
     if not subscription:
         return {
@@ -150,14 +227,9 @@ def get_user_subscription(cursor, user_id):
             'message': 'No active subscription'
         }
     
-    sub_dict = dict(subscription)
-    if sub_dict.get('start_date'):
-        sub_dict['start_date'] = sub_dict['start_date'].isoformat()
-    if sub_dict.get('end_date'):
-        sub_dict['end_date'] = sub_dict['end_date'].isoformat()
-    
+    # Даты сериализует success_response; словарь из кэша не копируется и не меняется
     return {
-        'subscription': sub_dict
+        'subscription': subscription
     }
 
 
@@ -183,17 +255,26 @@ def get_payment_history(cursor, user_id):
         LIMIT 50
     """, (user_id,))
     
-    payments = cursor.fetchall()
-    
-    for payment in payments:
-        if payment['created_at']:
-            payment['created_at'] = payment['created_at'].isoformat()
-    
     return {
-        'payments': [dict(p) for p in payments]
+        'payments': cursor.fetchall()
     }
 
 
+def get_changes(cursor, params):
+    '''Изменения платежей и подписок пользователя после курсора'''
+    
+    user_id = params.get('user_id')
+    if not user_id:
+        return {'error': 'user_id is required'}
+    
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return {'error': 'user_id must be an integer'}
+    
+    return outbox.get_changes(cursor, params, ('payment', 'subscription'), user_id=user_id)
+
+
 def create_payment(cursor, conn, body):
     '''Создает платеж через ЮKassa'''
     
@@ -204,13 +285,7 @@ def create_payment(cursor, conn, body):
     if not all([user_id, plan_type]):
         return {'error': 'user_id and plan_type are required'}
     
-    cursor.execute("""
-        SELECT price_monthly, price_yearly
-        FROM plan_limits
-        WHERE plan_type = %s
-    """, (plan_type,))
-    
-    plan = cursor.fetchone()
+    plan = plan_limits_cache.get(plan_type, cursor)
     if not plan:
         return {'error': 'Plan not found'}
     
@@ -223,14 +298,16 @@ def create_payment(cursor, conn, body):
         cursor.execute("""
             INSERT INTO payments (user_id, amount, currency, status, metadata)
             VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
+            RETURNING id, user_id, amount, currency, payment_method, status, created_at
         """, (user_id, amount, 'RUB', 'pending', json.dumps({
             'plan_type': plan_type,
             'billing_period': billing_period,
             'demo_mode': True
         })))
         
-        payment_id = cursor.fetchone()['id']
+        payment = dict(cursor.fetchone())
+        payment_id = payment['id']
+        outbox.record(cursor, 'payment', 'insert', [payment])
         conn.commit()
         
         return {
@@ -240,6 +317,9 @@ def create_payment(cursor, conn, body):
             'message': 'Для реальных платежей настройте YOOKASSA_SHOP_ID и YOOKASSA_SECRET_KEY'
         }
     
+    import uuid
+    from http_client import HTTPError
+    
     idempotence_key = str(uuid.uuid4())
     
     payment_data = {
@@ -261,58 +341,42 @@ def create_payment(cursor, conn, body):
     }
     
     try:
-        url = 'https://api.yookassa.ru/v3/payments'
+        result = request_yookassa_payment(payment_data, idempotence_key)
         
-        data = json.dumps(payment_data, ensure_ascii=False).encode('utf-8')
-        
-        auth_string = f'{yookassa_shop_id}:{yookassa_secret_key}'
-        auth_bytes = auth_string.encode('utf-8')
-        import base64
-        auth_header = 'Basic ' + base64.b64encode(auth_bytes).decode('utf-8')
+        cursor.execute("""
+            INSERT INTO payments (
+                user_id, amount, currency, payment_method, 
+                payment_system, external_payment_id, status, metadata
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id, user_id, amount, currency, payment_method, status, created_at
+        """, (
+            user_id, amount, 'RUB', result.get('payment_method', {}).get('type'),
+            'yookassa', result.get('id'), result.get('status'), 
+            json.dumps({
+                'plan_type': plan_type,
+                'billing_period': billing_period,
+                'yookassa_response': result
+            })
+        ))
         
-        headers = {
-            'Content-Type': 'application/json',
-            'Idempotence-Key': idempotence_key,
-            'Authorization': auth_header
-        }
+        payment = dict(cursor.fetchone())
+        payment_id = payment['id']
+        outbox.record(cursor, 'payment', 'insert', [payment])
+        conn.commit()
         
-        request = urllib.request.Request(url, data=data, headers=headers, method='POST')
+        confirmation_url = result.get('confirmation', {}).get('confirmation_url')
         
-        with urllib.request.urlopen(request, timeout=30) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            
-            cursor.execute("""
-                INSERT INTO payments (
-                    user_id, amount, currency, payment_method, 
-                    payment_system, external_payment_id, status, metadata
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                user_id, amount, 'RUB', result.get('payment_method', {}).get('type'),
-                'yookassa', result.get('id'), result.get('status'), 
-                json.dumps({
-                    'plan_type': plan_type,
-                    'billing_period': billing_period,
-                    'yookassa_response': result
-                })
-            ))
-            
-            payment_id = cursor.fetchone()['id']
-            conn.commit()
-            
-            confirmation_url = result.get('confirmation', {}).get('confirmation_url')
-            
-            return {
-                'success': True,
-                'payment_id': payment_id,
-                'external_payment_id': result.get('id'),
-                'confirmation_url': confirmation_url,
-                'status': result.get('status')
-            }
+        return {
+            'success': True,
+            'payment_id': payment_id,
+            'external_payment_id': result.get('id'),
+            'confirmation_url': confirmation_url,
+            'status': result.get('status')
+        }
     
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
+    except HTTPError as e:
+        error_body = e.text()
         return {
             'success': False,
             'error': f'YooKassa error: {error_body}'
@@ -326,7 +390,13 @@ def create_payment(cursor, conn, body):
 
 
 def handle_yookassa_webhook(cursor, conn, body, headers):
-    '''Обрабатывает вебхук от ЮKassa о статусе платежа'''
+    '''Обрабатывает вебхук от ЮKassa о статусе платежа.
+
+    Строка платежа блокируется, а подписка создается только если платеж еще
+    не привязан к подписке, поэтому повторные и параллельные доставки одного
+    уведомления не создают лишних подписок. Все изменения вместе с событиями
+    outbox — один запрос.
+    '''
     
     event_type = body.get('event')
     payment_object = body.get('object', {})
@@ -337,54 +407,86 @@ def handle_yookassa_webhook(cursor, conn, body, headers):
     external_payment_id = payment_object.get('id')
     payment_status = payment_object.get('status')
     
-    cursor.execute("""
-        SELECT id, user_id, metadata
-        FROM payments
-        WHERE external_payment_id = %s
-    """, (external_payment_id,))
+    cursor.execute(f"""
+        WITH target AS (
+            SELECT id, user_id, metadata, subscription_id
+            FROM payments
+            WHERE external_payment_id = %(external_payment_id)s
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE
+        ),
+        pending AS (
+            SELECT * FROM target
+            WHERE %(payment_status)s = 'succeeded' AND subscription_id IS NULL
+        ),
+        deactivated AS (
+            UPDATE subscriptions s
+            SET status = 'inactive', updated_at = NOW()
+            FROM pending
+            WHERE s.user_id = pending.user_id AND s.status = 'active'
+            RETURNING s.id, s.user_id, s.status
+        ),
+        created AS (
+            INSERT INTO subscriptions (user_id, plan_type, status, start_date, end_date, auto_renew)
+            SELECT
+                user_id,
+                metadata->>'plan_type',
+                'active',
+                NOW(),
+                NOW() + CASE WHEN metadata->>'billing_period' = 'yearly' THEN INTERVAL '365 days' ELSE INTERVAL '30 days' END,
+                TRUE
+            FROM pending
+            RETURNING id, user_id, plan_type, status, start_date, end_date, auto_renew
+        ),
+        updated AS (
+            UPDATE payments p
+            SET status = %(payment_status)s,
+                subscription_id = COALESCE((SELECT id FROM created), p.subscription_id),
+                updated_at = NOW()
+            FROM target
+            WHERE p.id = target.id
+            AND (p.status IS DISTINCT FROM %(payment_status)s OR EXISTS (SELECT 1 FROM created))
+            RETURNING p.id, p.user_id, p.status
+        ),
+        events AS (
+            {outbox.INSERT_EVENTS_SQL}
+            SELECT txid_current(), 'subscription', 'update', id, user_id, jsonb_build_object('status', status)
+            FROM deactivated
+            UNION ALL
+            SELECT txid_current(), 'subscription', 'insert', id, user_id, jsonb_build_object(
+                'plan_type', plan_type, 'status', status, 'start_date', start_date,
+                'end_date', end_date, 'auto_renew', auto_renew
+            )
+            FROM created
+            UNION ALL
+            SELECT txid_current(), 'payment', 'update', id, user_id, jsonb_strip_nulls(jsonb_build_object(
+                'status', status, 'plan_type', (SELECT plan_type FROM created)
+            ))
+            FROM updated
+        )
+        SELECT
+            target.id AS payment_id,
+            target.user_id,
+            (SELECT id FROM created) AS subscription_id,
+            EXISTS (SELECT 1 FROM updated) AS changed
+        FROM target
+    """, {'external_payment_id': external_payment_id, 'payment_status': payment_status})
     
     payment_record = cursor.fetchone()
+    conn.commit()
     
     if not payment_record:
         return {'success': False, 'error': 'Payment not found'}
     
-    cursor.execute("""
-        UPDATE payments
-        SET status = %s, updated_at = NOW()
-        WHERE id = %s
-    """, (payment_status, payment_record['id']))
-    
-    if payment_status == 'succeeded':
-        metadata = payment_record['metadata']
-        plan_type = metadata.get('plan_type')
-        billing_period = metadata.get('billing_period', 'monthly')
-        user_id = payment_record['user_id']
-        
-        cursor.execute("""
-            UPDATE subscriptions
-            SET status = 'inactive'
-            WHERE user_id = %s AND status = 'active'
-        """, (user_id,))
-        
-        end_date = datetime.now() + timedelta(days=365 if billing_period == 'yearly' else 30)
-        
-        cursor.execute("""
-            INSERT INTO subscriptions (
-                user_id, plan_type, status, start_date, end_date, auto_renew
-            )
-            VALUES (%s, %s, %s, NOW(), %s, TRUE)
-            RETURNING id
-        """, (user_id, plan_type, 'active', end_date))
-        
-        subscription_id = cursor.fetchone()['id']
-        
-        cursor.execute("""
-            UPDATE payments
-            SET subscription_id = %s
-            WHERE id = %s
-        """, (subscription_id, payment_record['id']))
+    if not payment_record['changed']:
+        return {
+            'success': True,
+            'message': 'Webhook already processed',
+            'payment_status': payment_status
+        }
     
-    conn.commit()
+    entitlement_cache.invalidate(payment_record['user_id'])
     
     return {
         'success': True,
@@ -405,9 +507,12 @@ def cancel_subscription(cursor, conn, body):
         UPDATE subscriptions
         SET status = 'cancelled', auto_renew = FALSE, updated_at = NOW()
         WHERE user_id = %s AND status = 'active'
+        RETURNING id, user_id, status, auto_renew
     """, (user_id,))
     
+    outbox.record(cursor, 'subscription', 'update', [dict(row) for row in cursor.fetchall()])
     conn.commit()
+    entitlement_cache.invalidate(user_id)
     
     return {
         'success': True,
@@ -424,22 +529,9 @@ def check_feature_access(cursor, body):
     if not all([user_id, feature]):
         return {'error': 'user_id and feature are required'}
     
-    cursor.execute("""
-        SELECT 
-            s.plan_type,
-            pl.ai_analysis_enabled,
-            pl.ai_suggestions_enabled,
-            pl.max_clients,
-            pl.max_calls_per_month,
-            pl.max_email_campaigns
-        FROM subscriptions s
-        JOIN plan_limits pl ON s.plan_type = pl.plan_type
-        WHERE s.user_id = %s AND s.status = 'active'
-        ORDER BY s.created_at DESC
-        LIMIT 1
-    """, (user_id,))
-    
-    subscription = cursor.fetchone()
+    subscription = get_entitlement(cursor, user_id)
+    if subscription is MISS:
+        return MISS
     
     if not subscription:
         return {
@@ -461,119 +553,280 @@ def check_feature_access(cursor, body):
             'upgrade_required': not has_access
         }
     
+    if feature in metering.METRICS:
+        limit = subscription.get(metering.METRICS[feature][0])
+        if metering.is_unlimited(limit):
+            return {
+                'access': True,
+                'plan_type': subscription['plan_type'],
+                'limit': None
+            }
+        if cursor is None:
+            return MISS
+        
+        used = metering.read_usage(cursor, user_id, (feature,)).get(feature, 0)
+        has_access = used < limit
+        return {
+            'access': has_access,
+            'plan_type': subscription['plan_type'],
+            'used': used,
+            'limit': limit,
+            'upgrade_required': not has_access
+        }
+    
     return {
         'access': True,
         'plan_type': subscription['plan_type']
     }
 
 
-def success_response(data):
-    '''Формирует успешный ответ'''
+def get_usage(cursor, user_id):
+    '''Текущее использование лимитов тарифа пользователем'''
+    
+    if not user_id:
+        return {'error': 'user_id is required'}
+    
+    subscription = get_entitlement(cursor, user_id)
+    used = metering.read_usage(cursor, user_id)
+    
+    usage = {}
+    for metric, (limit_column, _) in metering.METRICS.items():
+        limit = subscription.get(limit_column) if subscription else 0
+        unlimited = metering.is_unlimited(limit)
+        usage[metric] = {
+            'used': used.get(metric, 0),
+            'limit': None if unlimited else limit,
+            'remaining': None if unlimited else max(limit - used.get(metric, 0), 0),
+            'period': metering.current_period(metric)
+        }
+    
+    return {
+        'plan_type': subscription['plan_type'] if subscription else None,
+        'usage': usage
+    }
+
+
+def reconcile_usage(cursor, conn, body):
+    '''Пересчитывает счетчики использования по исходным таблицам (для планировщика)'''
+    
+    stats = metering.reconcile(cursor, body.get('user_id'))
+    conn.commit()
+    
+    return {
+        'success': True,
+        **stats
+    }
+
+
+def success_response(data, etag=None):
+    '''Формирует успешный ответ; ETag добавляется только к ответу без ошибки'''
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    if etag and not (isinstance(data, dict) and 'error' in data):
+        headers['ETag'] = etag
+        headers['Access-Control-Expose-Headers'] = 'ETag'
     return {
         'statusCode': 200,
+        'headers': headers,
+        'body': serialization.dumps(data),
+        'isBase64Encoded': False
+    }
+
+
+def etag_matches(event, etag):
+    '''Сравнивает ETag с If-None-Match запроса (слабое сравнение, допускается список и *)'''
+    headers = event.get('headers') or {}
+    header = next((value for key, value in headers.items() if key.lower() == 'if-none-match'), None)
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in tags)
+
+
+def not_modified_response(etag):
+    '''Ответ 304 без тела: данные у клиента актуальны'''
+    return {
+        'statusCode': 304,
         'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'ETag': etag,
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'ETag'
         },
-        'body': json.dumps(data, ensure_ascii=False, default=str),
+        'body': '',
         'isBase64Encoded': False
     }
 
 
 def check_expiring_subscriptions(cursor, conn):
-    '''Проверяет подписки, истекающие в течение 7 дней, и отправляет уведомления'''
-    
-    cursor.execute("""
-        SELECT 
-            s.id,
-            s.user_id,
-            s.plan_type,
-            s.end_date,
-            s.auto_renew,
-            u.email,
-            u.full_name
-        FROM subscriptions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.status = 'active' 
-        AND s.end_date <= NOW() + INTERVAL '7 days'
-        AND s.end_date > NOW()
-    """)
-    
-    expiring = cursor.fetchall()
-    notifications_sent = 0
-    
-    for sub in expiring:
-        days_left = (sub['end_date'] - datetime.now()).days
-        
-        send_expiration_notification(
-            email=sub['email'],
-            name=sub['full_name'] or 'Пользователь',
-            plan_type=sub['plan_type'],
-            days_left=days_left,
-            auto_renew=sub['auto_renew']
-        )
-        notifications_sent += 1
+    '''Уведомляет об истечении подписок за 7, 3 и 1 день и переводит истекшие в expired.
+
+    Подписки забираются пачками: строка в subscription_notifications служит
+    отметкой о захвате, поэтому повторный или параллельный запуск не шлет
+    дубликаты. Письма отправляются пулом из NOTIFY_CONCURRENCY потоков.
+    '''
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    # Время запуска берется из БД: с ним сравнивается updated_at = NOW() захваченных строк
+    cursor.execute("SELECT NOW() AS run_started")
+    run_started = cursor.fetchone()['run_started']
+    deadline = time.monotonic() + NOTIFY_TIME_BUDGET_SECONDS
+    claimed_total = 0
+    sent_total = 0
+    batches = 0
+    
+    with ThreadPoolExecutor(max_workers=NOTIFY_CONCURRENCY) as executor:
+        while time.monotonic() < deadline:
+            batch = claim_expiring_batch(cursor, conn, run_started)
+            if not batch:
+                break
+            
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    send_expiration_notification,
+                    email=sub['email'],
+                    name=sub['full_name'] or 'Пользователь',
+                    plan_type=sub['plan_type'],
+                    days_left=sub['days_left'],
+                    auto_renew=sub['auto_renew']
+                )
+                for sub in batch
+            ]
+            outcomes = [
+                (sub['subscription_id'], sub['threshold_days'], 'sent' if future.result() else 'failed')
+                for sub, future in zip(batch, futures)
+            ]
+            
+            execute_values(cursor, """
+                UPDATE subscription_notifications n
+                SET status = v.status,
+                    sent_at = CASE WHEN v.status = 'sent' THEN NOW() END,
+                    updated_at = NOW()
+                FROM (VALUES %s) AS v(subscription_id, threshold_days, status)
+                WHERE n.subscription_id = v.subscription_id AND n.threshold_days = v.threshold_days
+            """, outcomes)
+            conn.commit()
+            
+            batches += 1
+            claimed_total += len(batch)
+            sent_total += sum(1 for outcome in outcomes if outcome[2] == 'sent')
     
     cursor.execute("""
         UPDATE subscriptions
         SET status = 'expired'
         WHERE status = 'active' AND end_date < NOW()
+        RETURNING id, user_id, status
     """)
-    expired_count = cursor.rowcount
+    expired = [dict(row) for row in cursor.fetchall()]
+    expired_users = [row['user_id'] for row in expired]
+    expired_count = len(expired_users)
+    outbox.record(cursor, 'subscription', 'update', expired)
     conn.commit()
+    entitlement_cache.invalidate(*expired_users)
     
     return {
         'success': True,
-        'expiring_count': len(expiring),
-        'notifications_sent': notifications_sent,
+        'expiring_count': claimed_total,
+        'notifications_sent': sent_total,
+        'notifications_failed': claimed_total - sent_total,
+        'batches': batches,
         'expired_count': expired_count
     }
 
 
-def renew_subscription(cursor, conn, body):
-    '''Автоматически продлевает подписку пользователя'''
+def claim_expiring_batch(cursor, conn, run_started):
+    '''Захватывает до NOTIFY_BATCH_SIZE подписок, которым пора отправить уведомление.
+
+    Порог — наименьший из 7/3/1 дней, в который попадает end_date. Уже
+    отправленные уведомления не повторяются; неудачные и зависшие захваты
+    повторяются не чаще раза за запуск и не более NOTIFY_MAX_ATTEMPTS раз.
+    '''
+    
+    retryable = """
+        n.status <> 'sent'
+        AND n.attempts < %(max_attempts)s
+        AND n.updated_at < %(run_started)s
+        AND (n.status = 'failed' OR n.updated_at < NOW() - INTERVAL '15 minutes')
+    """
+    
+    cursor.execute(f"""
+        WITH candidates AS (
+            SELECT
+                s.id,
+                CASE
+                    WHEN s.end_date <= NOW() + INTERVAL '1 day' THEN 1
+                    WHEN s.end_date <= NOW() + INTERVAL '3 days' THEN 3
+                    ELSE 7
+                END AS threshold_days
+            FROM subscriptions s
+            WHERE s.status = 'active'
+            AND s.end_date > NOW()
+            AND s.end_date <= NOW() + INTERVAL '7 days'
+        ),
+        due AS (
+            SELECT c.id, c.threshold_days
+            FROM candidates c
+            LEFT JOIN subscription_notifications n
+                ON n.subscription_id = c.id AND n.threshold_days = c.threshold_days
+            WHERE n.subscription_id IS NULL OR ({retryable})
+            ORDER BY c.id
+            LIMIT %(batch_size)s
+        ),
+        claimed AS (
+            INSERT INTO subscription_notifications AS n (subscription_id, threshold_days)
+            SELECT id, threshold_days FROM due
+            ON CONFLICT (subscription_id, threshold_days) DO UPDATE
+            SET status = 'pending', attempts = n.attempts + 1, updated_at = NOW()
+            WHERE {retryable}
+            RETURNING subscription_id, threshold_days
+        )
+        SELECT
+            c.subscription_id,
+            c.threshold_days,
+            s.plan_type,
+            s.auto_renew,
+            EXTRACT(DAY FROM s.end_date - NOW())::integer AS days_left,
+            u.email,
+            u.full_name
+        FROM claimed c
+        JOIN subscriptions s ON s.id = c.subscription_id
+        JOIN users u ON u.id = s.user_id
+    """, {'batch_size': NOTIFY_BATCH_SIZE, 'max_attempts': NOTIFY_MAX_ATTEMPTS, 'run_started': run_started})
     
-    user_id = body.get('user_id')
+    batch = cursor.fetchall()
+    conn.commit()
+    return batch
+
+
+def request_yookassa_payment(payment_data: dict, idempotence_key: str) -> dict:
+    '''Создает платеж в ЮKassa и возвращает ответ API'''
     
-    if not user_id:
-        return {'error': 'user_id is required'}
+    import base64
+    import http_client
     
-    cursor.execute("""
-        SELECT 
-            s.*,
-            pl.price_monthly,
-            pl.price_yearly
-        FROM subscriptions s
-        JOIN plan_limits pl ON s.plan_type = pl.plan_type
-        WHERE s.user_id = %s 
-        AND s.status = 'active'
-        AND s.auto_renew = TRUE
-        AND s.end_date <= NOW() + INTERVAL '3 days'
-        ORDER BY s.created_at DESC
-        LIMIT 1
-    """, (user_id,))
+    yookassa_api_url = os.environ.get('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+    auth_string = f"{os.environ.get('YOOKASSA_SHOP_ID')}:{os.environ.get('YOOKASSA_SECRET_KEY')}"
     
-    subscription = cursor.fetchone()
+    headers = {
+        'Idempotence-Key': idempotence_key,
+        'Authorization': 'Basic ' + base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+    }
     
-    if not subscription:
-        return {
-            'success': False,
-            'message': 'No subscription found for auto-renewal'
-        }
+    # Повторы безопасны: ЮKassa возвращает тот же платеж для того же Idempotence-Key
+    response = http_client.post_json(
+        f'{yookassa_api_url}/payments', payment_data, headers, target='yookassa', timeout=30, retries=2
+    )
+    return response.json()
+
+
+def build_renewal_payment(subscription: dict, plan: dict):
+    '''Сумма, период и тело платежа ЮKassa для продления подписки'''
     
     billing_period = 'yearly' if (subscription['end_date'] - subscription['start_date']).days > 200 else 'monthly'
-    amount = float(subscription['price_yearly']) if billing_period == 'yearly' else float(subscription['price_monthly'])
-    
-    yookassa_shop_id = os.environ.get('YOOKASSA_SHOP_ID')
-    yookassa_secret_key = os.environ.get('YOOKASSA_SECRET_KEY')
-    
-    if not yookassa_shop_id or not yookassa_secret_key:
-        return {
-            'success': False,
-            'message': 'YooKassa credentials not configured'
-        }
-    
-    idempotence_key = str(uuid.uuid4())
+    amount = float(plan['price_yearly']) if billing_period == 'yearly' else float(plan['price_monthly'])
     
     payment_data = {
         'amount': {
@@ -587,64 +840,119 @@ def renew_subscription(cursor, conn, body):
         'capture': True,
         'description': f'Автопродление подписки {subscription["plan_type"]} ({billing_period})',
         'metadata': {
-            'user_id': str(user_id),
+            'user_id': str(subscription['user_id']),
             'plan_type': subscription['plan_type'],
             'billing_period': billing_period,
             'auto_renewal': 'true'
         }
     }
     
-    try:
-        url = 'https://api.yookassa.ru/v3/payments'
-        data = json.dumps(payment_data, ensure_ascii=False).encode('utf-8')
-        
-        auth_string = f'{yookassa_shop_id}:{yookassa_secret_key}'
-        import base64
-        auth_header = 'Basic ' + base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Idempotence-Key': idempotence_key,
-            'Authorization': auth_header
+    return amount, billing_period, payment_data
+
+
+def yookassa_configured() -> bool:
+    return bool(os.environ.get('YOOKASSA_SHOP_ID') and os.environ.get('YOOKASSA_SECRET_KEY'))
+
+
+def create_renewal_payment(subscription: dict, plan: dict) -> dict:
+    '''Создает в ЮKassa платеж продления захваченного периода и возвращает исход попытки для record_outcomes'''
+    
+    if not plan:
+        return {'status': 'failed', 'error': 'Plan not found'}
+    
+    amount, billing_period, payment_data = build_renewal_payment(subscription, plan)
+    payment_data['metadata']['subscription_id'] = str(subscription['id'])
+    result = request_yookassa_payment(payment_data, subscription['idempotence_key'])
+    
+    return {
+        'status': 'created',
+        'amount': amount,
+        'external_payment_id': result.get('id'),
+        'payment_status': result.get('status'),
+        'payment_method': result.get('payment_method', {}).get('type'),
+        'confirmation_url': result.get('confirmation', {}).get('confirmation_url'),
+        'metadata': {
+            'plan_type': subscription['plan_type'],
+            'billing_period': billing_period,
+            'auto_renewal': True,
+            'yookassa_response': result
+        }
+    }
+
+
+def renew_subscription(cursor, conn, body):
+    '''Автоматически продлевает подписку пользователя.
+
+    Период захватывается строкой renewal_attempts так же, как в массовом прогоне,
+    поэтому ручной вызов и воркеры не создают два платежа за один период.
+    '''
+    
+    user_id = body.get('user_id')
+    
+    if not user_id:
+        return {'error': 'user_id is required'}
+    
+    if not yookassa_configured():
+        return {
+            'success': False,
+            'message': 'YooKassa credentials not configured'
+        }
+    
+    claimed = claim_due_renewals(cursor, conn, f'renew_subscription:{user_id}', 1, user_id=user_id)
+    
+    if not claimed:
+        return {
+            'success': False,
+            'message': 'No subscription found for auto-renewal'
         }
-        
-        request = urllib.request.Request(url, data=data, headers=headers, method='POST')
-        
-        with urllib.request.urlopen(request, timeout=30) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            
-            cursor.execute("""
-                INSERT INTO payments (
-                    user_id, amount, currency, payment_method, 
-                    payment_system, external_payment_id, status, metadata
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                user_id, amount, 'RUB', result.get('payment_method', {}).get('type'),
-                'yookassa', result.get('id'), result.get('status'), 
-                json.dumps({
-                    'plan_type': subscription['plan_type'],
-                    'billing_period': billing_period,
-                    'auto_renewal': True,
-                    'yookassa_response': result
-                })
-            ))
-            
-            conn.commit()
-            
-            return {
-                'success': True,
-                'payment_id': result.get('id'),
-                'confirmation_url': result.get('confirmation', {}).get('confirmation_url'),
-                'message': 'Auto-renewal payment created'
-            }
     
+    subscription = claimed[0]
+    
+    try:
+        outcome = create_renewal_payment(subscription, plan_limits_cache.get(subscription['plan_type'], cursor))
     except Exception as e:
+        outcome = {'status': 'failed', 'error': str(e)}
+    
+    record_outcomes(cursor, conn, [{
+        'attempt_id': subscription['attempt_id'],
+        'subscription_id': subscription['id'],
+        'user_id': subscription['user_id'],
+        **outcome
+    }])
+    entitlement_cache.invalidate(user_id)
+    
+    if outcome['status'] != 'created':
         return {
             'success': False,
-            'error': str(e)
+            'error': outcome['error']
         }
+    
+    return {
+        'success': True,
+        'payment_id': outcome['external_payment_id'],
+        'confirmation_url': outcome['confirmation_url'],
+        'message': 'Auto-renewal payment created'
+    }
+
+
+def run_auto_renewals(cursor, conn, body):
+    '''Массовое автопродление для планировщика: безопасно запускать на нескольких воркерах'''
+    
+    if not yookassa_configured():
+        return {
+            'success': False,
+            'message': 'YooKassa credentials not configured'
+        }
+    
+    import socket
+    
+    plans = plan_limits_cache.get_all(cursor)
+    worker = body.get('worker') or f'{socket.gethostname()}:{os.getpid()}'
+    
+    def renew_one(subscription):
+        return create_renewal_payment(subscription, plans.get(subscription['plan_type']))
+    
+    return run_renewals(cursor, conn, renew_one, worker, int(body.get('batch_size', RENEWAL_BATCH_SIZE)))
 
 
 def update_auto_renew(cursor, conn, body):
@@ -660,9 +968,12 @@ def update_auto_renew(cursor, conn, body):
         UPDATE subscriptions
         SET auto_renew = %s, updated_at = NOW()
         WHERE user_id = %s AND status = 'active'
+        RETURNING id, user_id, auto_renew
     """, (auto_renew, user_id))
     
+    outbox.record(cursor, 'subscription', 'update', [dict(row) for row in cursor.fetchall()])
     conn.commit()
+    entitlement_cache.invalidate(user_id)
     
     return {
         'success': True,
@@ -679,6 +990,8 @@ def send_expiration_notification(email: str, name: str, plan_type: str, days_lef
         if not email_sender_url:
             return False
         
+        import http_client
+        
         plan_names = {
             'starter': 'Стартовый',
             'professional': 'Профессиональный',
@@ -732,18 +1045,8 @@ def send_expiration_notification(email: str, name: str, plan_type: str, days_lef
             'name': name
         }
         
-        data = json.dumps(email_payload, ensure_ascii=False).encode('utf-8')
-        headers = {'Content-Type': 'application/json'}
-        
-        request = urllib.request.Request(
-            email_sender_url,
-            data=data,
-            headers=headers,
-            method='POST'
-        )
-        
-        with urllib.request.urlopen(request, timeout=10) as response:
-            return True
+        http_client.post_json(email_sender_url, email_payload, target='email_sender', timeout=10)
+        return True
     
     except Exception as e:
         print(f'Email notification error: {str(e)}')
@@ -758,6 +1061,6 @@ def error_response(error_message):
             'Content-Type': 'application/json',
             'Access-Control-Allow-Origin': '*'
         },
-        'body': json.dumps({'error': error_message}, ensure_ascii=False),
+        'body': serialization.dumps({'error': error_message}),
         'isBase64Encoded': False
     }
\ No newline at end of file
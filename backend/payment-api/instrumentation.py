@@ -0,0 +1,241 @@
+import contextvars
+import functools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2.extras import RealDictCursor
+
+
+MAX_LOGGED_STATEMENTS = 20
+MAX_STATEMENT_LENGTH = 160
+
+# Строковые литералы и комментарии -- (комментарий может содержать апостроф)
+_LITERAL_RE = re.compile(r"(?:\b[EeBbXxNn])?'(?:[^']|'')*'|--[^\n]*")
+_NUMBER_RE = re.compile(r'(?<![\w.$])\d+(?:\.\d+)?\b')
+_VALUES_RE = re.compile(r'\bVALUES\s*(?=\()', re.IGNORECASE)
+
+_current_trace = contextvars.ContextVar('invocation_trace', default=None)
+_stats_providers = {}
+
+
+def is_enabled() -> bool:
+    '''Инструментирование включено по умолчанию, INSTRUMENTATION=off отключает его'''
+    return os.environ.get('INSTRUMENTATION', 'on').lower() not in ('off', 'false', '0')
+
+
+def server_timing_enabled() -> bool:
+    return os.environ.get('SERVER_TIMING', 'false').lower() in ('on', 'true', '1')
+
+
+def _skip_group(sql: str, start: int) -> int:
+    '''Позиция после скобочной группы, открытой в start'''
+    depth = 0
+    for i in range(start, len(sql)):
+        if sql[i] == '(':
+            depth += 1
+        elif sql[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(sql)
+
+
+def normalize_sql(sql) -> str:
+    '''Ключ запроса в трейсе без данных: литералы заменяются на ?, список VALUES — на (...).
+
+    execute_values передает в execute уже подставленные значения, и без нормализации
+    в лог попадали бы персональные данные, а каждый пакет давал бы отдельную строку статистики.
+    '''
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _LITERAL_RE.sub(lambda match: '' if match.group().startswith('--') else '?', str(sql))
+    sql = _NUMBER_RE.sub('?', sql)
+
+    parts = []
+    position = 0
+    for match in _VALUES_RE.finditer(sql):
+        if match.start() < position:
+            continue
+        end = _skip_group(sql, match.end())
+        # Следующие кортежи того же списка: ", (...)"
+        while True:
+            following = re.match(r'\s*,\s*\(', sql[end:])
+            if not following:
+                break
+            end = _skip_group(sql, end + following.end() - 1)
+        parts.append(sql[position:match.start()] + 'VALUES (...)')
+        position = end
+    parts.append(sql[position:])
+    return ' '.join(''.join(parts).split())[:MAX_STATEMENT_LENGTH]
+
+
+class Trace:
+    '''Счетчики и длительности SQL-запросов и внешних вызовов в рамках одного вызова функции'''
+
+    def __init__(self, function: str, method: str, path: str):
+        self.function = function
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.outbound = {}
+        self.usage = {}
+
+    def record_sql(self, sql, elapsed_ms: float):
+        key = normalize_sql(sql)
+        with self.lock:
+            entry = self.statements.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed_ms
+
+    def record_outbound(self, target: str, elapsed_ms: float, failed: bool = False):
+        with self.lock:
+            entry = self.outbound.setdefault(target, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += elapsed_ms
+            entry[2] += int(failed)
+
+    def record_usage(self, name: str, counters: dict):
+        with self.lock:
+            entry = self.usage.setdefault(name, {})
+            for key, value in counters.items():
+                entry[key] = entry.get(key, 0) + value
+
+    def summary(self, status: int) -> dict:
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+            outbound = dict(self.outbound)
+            usage = {name: dict(counters) for name, counters in self.usage.items()}
+        return {
+            'type': 'invocation_trace',
+            'function': self.function,
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'db': {
+                'count': sum(count for _, (count, _) in statements),
+                'ms': round(sum(ms for _, (_, ms) in statements), 2),
+                'statements': [
+                    {'sql': sql, 'count': count, 'ms': round(ms, 2)}
+                    for sql, (count, ms) in statements[:MAX_LOGGED_STATEMENTS]
+                ]
+            },
+            'outbound': {
+                target: {'count': count, 'ms': round(ms, 2), 'errors': errors}
+                for target, (count, ms, errors) in outbound.items()
+            },
+            'usage': usage,
+            **{name: provider() for name, provider in _stats_providers.items()}
+        }
+
+    def server_timing(self, summary: dict) -> str:
+        parts = [f"db;dur={summary['db']['ms']};desc=\"{summary['db']['count']} queries\""]
+        for target, stats in summary['outbound'].items():
+            parts.append(f"{target};dur={stats['ms']};desc=\"{stats['count']} calls\"")
+        parts.append(f"total;dur={summary['total_ms']}")
+        return ', '.join(parts)
+
+
+def register_stats(name: str, provider):
+    '''Добавляет в итог вызова снимок состояния модуля, живущего дольше вызова (пулы, кэши)'''
+    _stats_providers[name] = provider
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class TracedCursor(RealDictCursor):
+    '''RealDictCursor, который учитывает время каждого запроса в текущем Trace'''
+
+    def execute(self, query, vars=None):
+        trace = _current_trace.get()
+        if trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            trace.record_sql(query, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, query, vars_list):
+        trace = _current_trace.get()
+        if trace is None:
+            return super().executemany(query, vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            trace.record_sql(query, (time.perf_counter() - started) * 1000)
+
+    def copy_expert(self, sql, file, size=8192):
+        trace = _current_trace.get()
+        if trace is None:
+            return super().copy_expert(sql, file, size)
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            trace.record_sql(sql, (time.perf_counter() - started) * 1000)
+
+
+@contextmanager
+def outbound_call(target: str):
+    '''Учитывает длительность внешнего вызова (HTTP, SMTP) под именем target'''
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        trace.record_outbound(target, (time.perf_counter() - started) * 1000, failed)
+
+
+def record_usage(name: str, **counters):
+    '''Добавляет счетчики расхода (например, токены модели) в Trace текущего вызова'''
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record_usage(name, counters)
+
+
+def instrumented(function: str):
+    '''Декоратор handler: открывает Trace на время вызова и пишет итог в лог одной JSON-строкой'''
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            if not is_enabled():
+                return handler(event, context)
+
+            params = event.get('queryStringParameters') or {}
+            trace = Trace(function, event.get('httpMethod', 'GET'), params.get('path') or params.get('action') or '')
+            token = _current_trace.set(trace)
+            try:
+                response = handler(event, context)
+            finally:
+                _current_trace.reset(token)
+
+            summary = trace.summary(response.get('statusCode', 200) if isinstance(response, dict) else 200)
+            print(json.dumps(summary, ensure_ascii=False))
+
+            if server_timing_enabled() and isinstance(response, dict):
+                headers = response.setdefault('headers', {})
+                headers['Server-Timing'] = trace.server_timing(summary)
+                headers['Access-Control-Expose-Headers'] = ', '.join(
+                    filter(None, [headers.get('Access-Control-Expose-Headers'), 'Server-Timing'])
+                )
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,161 @@
+from datetime import datetime
+
+
+# Метрика -> (колонка лимита в plan_limits, период счетчика)
+METRICS = {
+    'calls': ('max_calls_per_month', 'month'),
+    'clients': ('max_clients', 'total'),
+    'email_campaigns': ('max_email_campaigns', 'month')
+}
+
+
+class QuotaExceeded(Exception):
+    '''Списание превысило бы лимит тарифа либо у пользователя нет активной подписки'''
+
+    def __init__(self, metric: str, used=None, limit=None):
+        self.metric = metric
+        self.used = used
+        self.limit = limit
+        if limit is None:
+            super().__init__('No active subscription')
+        else:
+            super().__init__(f'{metric} limit reached ({used}/{limit})')
+
+    def as_result(self) -> dict:
+        return {
+            'error': str(self),
+            'quota_exceeded': True,
+            'metric': self.metric,
+            'used': self.used,
+            'limit': self.limit,
+            'upgrade_required': True
+        }
+
+
+def is_unlimited(limit) -> bool:
+    '''NULL и отрицательные значения в plan_limits означают отсутствие лимита'''
+    return limit is None or limit < 0
+
+
+def current_period(metric: str, now: datetime = None) -> str:
+    if METRICS[metric][1] == 'total':
+        return 'total'
+    return (now or datetime.now()).strftime('%Y-%m')
+
+
+def consume(cursor, user_id, metric: str, amount: int = 1) -> int:
+    '''Атомарно списывает amount из квоты одним запросом и возвращает новое значение счетчика.
+
+    Проверка лимита и инкремент выполняются под блокировкой строки счетчика,
+    поэтому параллельные списания не превышают лимит. Вызывающий код делает
+    commit вместе со своей записью (звонок, клиенты, рассылка).
+    '''
+    limit_column = METRICS[metric][0]
+    cursor.execute(f"""
+        WITH quota AS (
+            SELECT pl.{limit_column} AS quota_limit
+            FROM subscriptions s
+            JOIN plan_limits pl ON pl.plan_type = s.plan_type
+            WHERE s.user_id = %(user_id)s AND s.status = 'active'
+            ORDER BY s.created_at DESC
+            LIMIT 1
+        ),
+        charged AS (
+            INSERT INTO usage_counters (user_id, metric, period, used)
+            SELECT %(user_id)s::integer, %(metric)s, %(period)s, %(amount)s
+            FROM quota
+            WHERE quota_limit IS NULL OR quota_limit < 0 OR %(amount)s <= quota_limit
+            ON CONFLICT (user_id, metric, period) DO UPDATE
+            SET used = usage_counters.used + EXCLUDED.used, updated_at = NOW()
+            WHERE (
+                SELECT quota_limit IS NULL OR quota_limit < 0 OR usage_counters.used + EXCLUDED.used <= quota_limit
+                FROM quota
+            )
+            RETURNING used
+        )
+        SELECT
+            EXISTS (SELECT 1 FROM quota) AS subscribed,
+            (SELECT quota_limit FROM quota) AS quota_limit,
+            (SELECT used FROM charged) AS used
+    """, {'user_id': user_id, 'metric': metric, 'period': current_period(metric), 'amount': amount})
+
+    row = cursor.fetchone()
+    if not row['subscribed']:
+        raise QuotaExceeded(metric)
+    if row['used'] is None:
+        raise QuotaExceeded(metric, read_usage(cursor, user_id, (metric,)).get(metric, 0), row['quota_limit'])
+    return row['used']
+
+
+def refund(cursor, user_id, metric: str, amount: int = 1, period: str = None) -> None:
+    '''Возвращает в квоту списание, за которым действие так и не состоялось (рассылка не ушла).
+
+    period — период исходного списания, по умолчанию текущий; счетчик не уходит ниже нуля.
+    '''
+    cursor.execute("""
+        UPDATE usage_counters
+        SET used = GREATEST(used - %s, 0), updated_at = NOW()
+        WHERE user_id = %s AND metric = %s AND period = %s
+    """, (amount, user_id, metric, period or current_period(metric)))
+
+
+def read_usage(cursor, user_id, metrics=tuple(METRICS)) -> dict:
+    '''Текущие значения счетчиков пользователя: чтение по первичному ключу'''
+    keys = [(metric, current_period(metric)) for metric in metrics]
+    cursor.execute("""
+        SELECT metric, used
+        FROM usage_counters
+        WHERE user_id = %s AND (metric, period) IN %s
+    """, (user_id, tuple(keys)))
+    return {row['metric']: row['used'] for row in cursor.fetchall()}
+
+
+def reconcile(cursor, user_id=None) -> dict:
+    '''Пересчитывает счетчики по исходным таблицам (calls, clients, email_campaigns).
+
+    Таблица счетчиков блокируется от списаний на время пересчета, чтобы
+    незакоммиченные списания не потерялись при перезаписи.
+    '''
+    cursor.execute("LOCK TABLE usage_counters IN SHARE ROW EXCLUSIVE MODE")
+    cursor.execute("""
+        WITH source AS (
+            SELECT user_id, 'calls' AS metric, to_char(created_at, 'YYYY-MM') AS period, COUNT(*)::integer AS used
+            FROM calls
+            WHERE user_id IS NOT NULL AND (%(user_id)s IS NULL OR user_id = %(user_id)s)
+            GROUP BY user_id, to_char(created_at, 'YYYY-MM')
+            UNION ALL
+            SELECT user_id, 'clients', 'total', COUNT(*)::integer
+            FROM clients
+            WHERE user_id IS NOT NULL AND (%(user_id)s IS NULL OR user_id = %(user_id)s)
+            GROUP BY user_id
+            UNION ALL
+            SELECT user_id, 'email_campaigns', to_char(created_at, 'YYYY-MM'), COUNT(*)::integer
+            FROM email_campaigns
+            WHERE user_id IS NOT NULL AND (%(user_id)s IS NULL OR user_id = %(user_id)s)
+            GROUP BY user_id, to_char(created_at, 'YYYY-MM')
+        ),
+        corrected AS (
+            INSERT INTO usage_counters (user_id, metric, period, used)
+            SELECT user_id, metric, period, used FROM source
+            ON CONFLICT (user_id, metric, period) DO UPDATE
+            SET used = EXCLUDED.used, updated_at = NOW()
+            WHERE usage_counters.used <> EXCLUDED.used
+            RETURNING 1
+        ),
+        zeroed AS (
+            UPDATE usage_counters uc
+            SET used = 0, updated_at = NOW()
+            WHERE uc.used <> 0
+            AND (%(user_id)s IS NULL OR uc.user_id = %(user_id)s)
+            AND NOT EXISTS (
+                SELECT 1 FROM source s
+                WHERE s.user_id = uc.user_id AND s.metric = uc.metric AND s.period = uc.period
+            )
+            RETURNING 1
+        )
+        SELECT
+            (SELECT COUNT(*) FROM source) AS counters,
+            (SELECT COUNT(*) FROM corrected) AS corrected,
+            (SELECT COUNT(*) FROM zeroed) AS zeroed
+    """, {'user_id': user_id})
+    return dict(cursor.fetchone())
@@ -0,0 +1,162 @@
+import json
+
+from psycopg2.extras import Json, execute_values
+
+
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+
+# Начало вставки событий; запросы из одного CTE дописывают к нему SELECT по своему RETURNING
+INSERT_EVENTS_SQL = "INSERT INTO change_events (txid, entity, op, entity_id, user_id, data)"
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, default=_json_default)
+
+
+def record(cursor, entity: str, op: str, rows: list) -> int:
+    '''Добавляет события об изменении строк одним запросом в текущую транзакцию.
+
+    rows — словари с id строки, необязательным user_id владельца и изменившимися полями;
+    остальные ключи попадают в data события. Коммит остается за вызывающим кодом,
+    поэтому событие появляется ровно тогда, когда видно само изменение.
+    '''
+    if not rows:
+        return 0
+    execute_values(cursor, f"{INSERT_EVENTS_SQL} VALUES %s", [
+        (
+            entity, op, row['id'], row.get('user_id'),
+            Json({key: value for key, value in row.items() if key not in ('id', 'user_id')}, dumps=_dumps)
+        )
+        for row in rows
+    ], template='(txid_current(), %s, %s, %s, %s::integer, %s)')
+    return len(rows)
+
+
+def get_changes(cursor, params, entities: tuple, user_id=None):
+    '''Изменения после курсора: только дельты вместо повторной загрузки списков.
+
+    Курсор имеет вид "<txid>|<id>". Запрос без курсора возвращает текущий горизонт:
+    клиент запоминает его, загружает списки целиком и дальше запрашивает только изменения
+    (события между горизонтом и загрузкой придут повторно, применять их нужно как upsert).
+    Отдаются события только завершенных транзакций; пока открыта транзакция старше
+    горизонта, более новые события ждут ее, но не теряются.
+    '''
+    try:
+        limit = min(max(int(params.get('limit', CHANGES_PAGE_SIZE)), 1), CHANGES_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'error': 'limit must be an integer'}
+
+    requested = params.get('entities')
+    if requested:
+        requested = [entity.strip() for entity in requested.split(',') if entity.strip()]
+        if not requested or any(entity not in entities for entity in requested):
+            return {'error': f"entities must be a comma-separated subset of: {', '.join(entities)}"}
+    else:
+        requested = list(entities)
+
+    page_cursor = params.get('cursor')
+    if page_cursor:
+        try:
+            after_txid, after_id = (int(part) for part in page_cursor.split('|', 1))
+        except ValueError:
+            return {'error': 'Invalid cursor'}
+    else:
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horizon")
+        return {'changes': [], 'next_cursor': f"{cursor.fetchone()['horizon']}|0", 'has_more': False}
+
+    # Горизонт и страница читаются одним запросом в одном снимке
+    owner = "AND e.user_id = %(user_id)s" if user_id is not None else ""
+    cursor.execute(f"""
+        WITH h AS (SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horizon)
+        SELECT h.horizon, e.*
+        FROM h
+        LEFT JOIN LATERAL (
+            SELECT e.txid, e.id, e.entity, e.op, e.entity_id, e.data, e.created_at
+            FROM change_events e
+            WHERE (e.txid, e.id) > (%(after_txid)s, %(after_id)s)
+                AND e.txid < h.horizon
+                AND e.entity = ANY(%(entities)s)
+                {owner}
+            ORDER BY e.txid, e.id
+            LIMIT %(limit)s
+        ) e ON TRUE
+    """, {
+        'after_txid': after_txid, 'after_id': after_id, 'entities': requested,
+        'user_id': user_id, 'limit': limit
+    })
+    page = cursor.fetchall()
+    horizon = page[0]['horizon']
+    rows = [row for row in page if row['id'] is not None]
+    has_more = len(rows) == limit
+
+    if has_more:
+        next_cursor = f"{rows[-1]['txid']}|{rows[-1]['id']}"
+    elif horizon > after_txid:
+        # Страница неполная: все события до горизонта отданы, курсор сдвигается к нему,
+        # чтобы следующий запрос не просматривал снова чужие сущности и других пользователей
+        next_cursor = f"{horizon}|0"
+    else:
+        next_cursor = page_cursor
+
+    return {
+        'changes': [
+            {
+                'entity': row['entity'],
+                'id': row['entity_id'],
+                'op': row['op'],
+                'data': row['data'],
+                'at': row['created_at']
+            }
+            for row in rows
+        ],
+        'next_cursor': next_cursor,
+        'has_more': has_more
+    }
+
+
+def bump_version(cursor, name: str):
+    '''Увеличивает счетчик версии data_versions в текущей транзакции (массовые изменения без событий)'''
+    cursor.execute("""
+        INSERT INTO data_versions (name, version) VALUES (%s, 1)
+        ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1, updated_at = NOW()
+    """, (name,))
+
+
+def version_stamp(cursor, entities: tuple, tables: tuple = (), user_id=None) -> str:
+    '''Версия данных без чтения самих данных: события outbox и счетчики таблиц.
+
+    Последнее событие транзакций старше горизонта, как в get_changes, ловит события,
+    закоммиченные позже соседей с большим id. Горизонт стоит, пока открыта долгая
+    транзакция (вебхук с GPT и почтой, обзвон), поэтому к нему добавляются число и
+    последний id видимых событий выше горизонта: событие, ставшее видимым, меняет
+    версию сразу. Один запрос по индексам idx_change_events_txid и idx_change_events_user.
+    '''
+    owner = "AND e.user_id = %(user_id)s" if user_id is not None else ""
+    cursor.execute(f"""
+        WITH h AS (SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horizon)
+        SELECT
+            (
+                SELECT e.txid || '.' || e.id
+                FROM change_events e, h
+                WHERE e.txid < h.horizon AND e.entity = ANY(%(entities)s) {owner}
+                ORDER BY e.txid DESC, e.id DESC
+                LIMIT 1
+            ) AS last_event,
+            (
+                SELECT COUNT(*) || '.' || COALESCE(MAX(e.id), 0)
+                FROM change_events e, h
+                WHERE e.txid >= h.horizon AND e.entity = ANY(%(entities)s) {owner}
+            ) AS recent_events,
+            (
+                SELECT string_agg(version::text, '.' ORDER BY name)
+                FROM data_versions
+                WHERE name = ANY(%(tables)s)
+            ) AS tables
+    """, {'entities': list(entities), 'tables': list(tables), 'user_id': user_id})
+    row = cursor.fetchone()
+    return '-'.join(part for part in (row['last_event'] or '0', row['recent_events'], row['tables']) if part)
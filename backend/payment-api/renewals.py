@@ -0,0 +1,210 @@
+import contextvars
+import json
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+import outbox
+
+
+RENEWAL_BATCH_SIZE = 100
+RENEWAL_CONCURRENCY = 4
+RENEWAL_RATE_PER_SECOND = 5
+RENEWAL_MAX_ATTEMPTS = 3
+RENEWAL_WINDOW_DAYS = 3
+RENEWAL_STALE_CLAIM_MINUTES = 15
+RENEWAL_RETRY_DELAY_MINUTES = 5
+RENEWAL_TIME_BUDGET_SECONDS = 50
+OUTCOME_REPORT_LIMIT = 100
+
+
+class RateLimiter:
+    '''Равномерно распределяет вызовы: не более rate в секунду на все потоки воркера'''
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def claim_due_renewals(cursor, conn, worker: str, batch_size: int = RENEWAL_BATCH_SIZE, user_id=None) -> list:
+    '''Захватывает подписки, которые пора продлить, и возвращает их вместе с тарифом.
+
+    Строки subscriptions блокируются с SKIP LOCKED, поэтому параллельные
+    воркеры разбирают разные подписки; после commit захват держит строка
+    renewal_attempts. Неудачные попытки повторяются не раньше чем через
+    RENEWAL_RETRY_DELAY_MINUTES, зависшие захваты — через RENEWAL_STALE_CLAIM_MINUTES.
+    С user_id захватывается только подписка этого пользователя (ручное продление).
+    '''
+    owner = "AND s.user_id = %(user_id)s" if user_id is not None else ""
+    retryable = f"""
+        renewal_attempts.status <> 'created'
+        AND renewal_attempts.attempts < {RENEWAL_MAX_ATTEMPTS}
+        AND (
+            (renewal_attempts.status = 'failed'
+                AND renewal_attempts.updated_at < NOW() - INTERVAL '{RENEWAL_RETRY_DELAY_MINUTES} minutes')
+            OR renewal_attempts.claimed_at < NOW() - INTERVAL '{RENEWAL_STALE_CLAIM_MINUTES} minutes'
+        )
+    """
+
+    cursor.execute(f"""
+        WITH due AS (
+            SELECT s.id, s.end_date
+            FROM subscriptions s
+            WHERE s.status = 'active'
+            AND s.auto_renew = TRUE
+            AND s.end_date <= NOW() + INTERVAL '{RENEWAL_WINDOW_DAYS} days'
+            {owner}
+            AND NOT EXISTS (
+                SELECT 1 FROM renewal_attempts
+                WHERE renewal_attempts.subscription_id = s.id
+                AND renewal_attempts.period_end = s.end_date
+                AND NOT ({retryable})
+            )
+            ORDER BY s.end_date
+            LIMIT %(batch_size)s
+            FOR UPDATE OF s SKIP LOCKED
+        ),
+        claimed AS (
+            INSERT INTO renewal_attempts (subscription_id, period_end, idempotence_key, claimed_by)
+            SELECT id, end_date, 'renew-' || id || '-' || to_char(end_date, 'YYYYMMDDHH24MISS'), %(worker)s
+            FROM due
+            ON CONFLICT (subscription_id, period_end) DO UPDATE
+            SET status = 'claimed',
+                attempts = renewal_attempts.attempts + 1,
+                claimed_by = EXCLUDED.claimed_by,
+                claimed_at = NOW(),
+                error = NULL,
+                updated_at = NOW()
+            WHERE {retryable}
+            RETURNING id AS attempt_id, subscription_id, idempotence_key
+        )
+        SELECT
+            c.attempt_id,
+            c.idempotence_key,
+            s.id,
+            s.user_id,
+            s.plan_type,
+            s.start_date,
+            s.end_date
+        FROM claimed c
+        JOIN subscriptions s ON s.id = c.subscription_id
+    """, {'batch_size': batch_size, 'worker': worker, 'user_id': user_id})
+
+    claimed = [dict(row) for row in cursor.fetchall()]
+    conn.commit()
+    return claimed
+
+
+def record_outcomes(cursor, conn, outcomes: list):
+    '''Записывает платежи, их события outbox и исходы попыток пачкой: три запроса на всю пачку'''
+    created = [outcome for outcome in outcomes if outcome['status'] == 'created']
+
+    payment_ids = {}
+    if created:
+        rows = execute_values(cursor, """
+            INSERT INTO payments (
+                user_id, amount, currency, payment_method,
+                payment_system, external_payment_id, status, metadata
+            )
+            VALUES %s
+            RETURNING id, user_id, amount, currency, payment_method, status, created_at, external_payment_id
+        """, [
+            (
+                outcome['user_id'], outcome['amount'], 'RUB', outcome['payment_method'],
+                'yookassa', outcome['external_payment_id'], outcome['payment_status'],
+                json.dumps(outcome['metadata'])
+            )
+            for outcome in created
+        ], fetch=True)
+        payment_ids = {row['external_payment_id']: row['id'] for row in rows}
+        outbox.record(cursor, 'payment', 'insert', [
+            {key: value for key, value in row.items() if key != 'external_payment_id'} for row in rows
+        ])
+
+    execute_values(cursor, """
+        UPDATE renewal_attempts r
+        SET status = v.status,
+            payment_id = v.payment_id,
+            external_payment_id = v.external_payment_id,
+            error = v.error,
+            updated_at = NOW()
+        FROM (VALUES %s) AS v(attempt_id, status, payment_id, external_payment_id, error)
+        WHERE r.id = v.attempt_id
+    """, [
+        (
+            outcome['attempt_id'], outcome['status'],
+            payment_ids.get(outcome.get('external_payment_id')),
+            outcome.get('external_payment_id'), outcome.get('error')
+        )
+        for outcome in outcomes
+    ], template='(%s, %s, %s::integer, %s, %s)')
+    conn.commit()
+
+
+def run_renewals(cursor, conn, renew_one, worker: str, batch_size: int = RENEWAL_BATCH_SIZE) -> dict:
+    '''Прогон автопродления: захват пачки, параллельное создание платежей, запись исходов.
+
+    renew_one(subscription) создает платеж в ЮKassa и возвращает исход попытки.
+    Лимит RENEWAL_RATE_PER_SECOND действует на один воркер.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    limiter = RateLimiter(RENEWAL_RATE_PER_SECOND)
+    deadline = time.monotonic() + RENEWAL_TIME_BUDGET_SECONDS
+
+    def attempt(subscription):
+        limiter.acquire()
+        try:
+            outcome = renew_one(subscription)
+        except Exception as e:
+            outcome = {'status': 'failed', 'error': str(e)}
+        return {
+            'attempt_id': subscription['attempt_id'],
+            'subscription_id': subscription['id'],
+            'user_id': subscription['user_id'],
+            **outcome
+        }
+
+    report = []
+    totals = {'claimed': 0, 'created': 0, 'failed': 0, 'batches': 0}
+
+    with ThreadPoolExecutor(max_workers=RENEWAL_CONCURRENCY) as executor:
+        while time.monotonic() < deadline:
+            batch = claim_due_renewals(cursor, conn, worker, batch_size)
+            if not batch:
+                break
+
+            # Контекст копируется в вызывающем потоке, чтобы вызовы ЮKassa попали в Trace вызова
+            futures = [
+                executor.submit(contextvars.copy_context().run, attempt, subscription)
+                for subscription in batch
+            ]
+            outcomes = [future.result() for future in futures]
+            record_outcomes(cursor, conn, outcomes)
+
+            totals['batches'] += 1
+            totals['claimed'] += len(batch)
+            for outcome in outcomes:
+                totals[outcome['status']] += 1
+                if len(report) < OUTCOME_REPORT_LIMIT:
+                    report.append({
+                        key: outcome.get(key)
+                        for key in ('subscription_id', 'user_id', 'status', 'external_payment_id', 'error')
+                    })
+
+    return {
+        'success': True,
+        **totals,
+        'outcomes': report,
+        'outcomes_truncated': totals['claimed'] > len(report)
+    }
@@ -0,0 +1,45 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    '''Типы, которых нет в JSON: даты в ISO 8601, Decimal и прочее строкой (как прежний default=str)'''
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, memoryview):
+        return value.tobytes().decode('utf-8', 'replace')
+    return str(value)
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+
+
+def dumps_bytes_python(data) -> bytes:
+    '''Запасной путь без orjson: стандартный json, значения в том же формате'''
+    return _encoder.encode(data).encode('utf-8')
+
+
+def dumps_bytes_orjson(data) -> bytes:
+    '''Строки результата (RealDictRow — подкласс dict), datetime и date orjson пишет сам,
+    через _default проходят только Decimal и редкие типы
+    '''
+    return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+dumps_bytes = dumps_bytes_orjson if orjson is not None else dumps_bytes_python
+
+
+def dumps(data) -> str:
+    '''JSON тела ответа одним проходом: строки курсора, даты и Decimal сериализуются без подготовки.
+
+    С orjson — быстрый путь на C, без него — стандартный json с тем же форматом значений.
+    '''
+    return dumps_bytes(data).decode('utf-8')
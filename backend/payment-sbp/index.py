@@ -1,36 +1,88 @@
 import json
 import os
-import hashlib
 import base64
+import urllib.parse
 from datetime import datetime
+from functools import lru_cache
 import psycopg2
-import qrcode
-from io import BytesIO
 
 RECIPIENT_PHONE = '89277486868'
 RECIPIENT_BANK = 'Sberbank'
+QR_CACHE_SIZE = 256
+QR_MASK_PATTERN = 2
+PAYMENT_SBP_URL = 'https://functions.poehali.dev/2ef13e90-2d73-467b-b7b7-aeb711fedb33'
 
-def generate_sbp_qr(amount: float, payment_id: str, description: str = '') -> str:
-    '''Генерация QR-кода для оплаты через СБП'''
-    sbp_url = f"https://qr.nspk.ru/proxyapp?type=02&bank=100000000004&sum={amount}&cur=RUB&payeeId={RECIPIENT_PHONE}&purpose={description}&paymentId={payment_id}"
+def build_sbp_url(payment_id: str, amount: float, description: str = '') -> str:
+    '''Ссылка СБП для QR-кода; paymentId попадает в перевод, по нему confirm_payment сверяет оплату'''
+    purpose = urllib.parse.quote(description or '')
+    return (
+        f"https://qr.nspk.ru/proxyapp?type=02&bank=100000000004&sum={amount}&cur=RUB&payeeId={RECIPIENT_PHONE}"
+        f"&purpose={purpose}&paymentId={urllib.parse.quote(payment_id)}"
+    )
+
+def make_qr(data: str, box_size: int = 10):
+    '''QR-код с фиксированной маской: перебор 8 масок занимает большую часть времени генерации'''
+    # qrcode (и PIL для PNG) загружаются только при отрисовке, а не на холодном старте
+    import qrcode
     
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
+        box_size=box_size,
         border=4,
+        mask_pattern=QR_MASK_PATTERN,
     )
-    qr.add_data(sbp_url)
+    qr.add_data(data)
     qr.make(fit=True)
+    return qr
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def render_sbp_qr_svg(payment_id: str, amount: float, description: str = '') -> str:
+    '''Компактный SVG: каждая серия темных модулей строки рисуется одним отрезком с относительными координатами.
+
+    Кэш по платежу: картинку одного платежа клиент запрашивает повторно (SVG и PNG, перезагрузка страницы).
+    '''
+    matrix = make_qr(build_sbp_url(payment_id, amount, description)).get_matrix()
+    size = len(matrix)
+    path = []
+    pen_x, pen_y = 0, 0.5
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < size and row[x]:
+                x += 1
+            path.append(f'm{start - pen_x} {y + 0.5 - pen_y:g}h{x - start}')
+            pen_x, pen_y = x, y + 0.5
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/><path stroke="#000" d="M0 0.5{"".join(path)}"/></svg>'
+    )
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def render_sbp_qr_png(payment_id: str, amount: float, description: str = '', box_size: int = 4) -> bytes:
+    '''Монохромный PNG для клиентов без поддержки SVG'''
+    from io import BytesIO
     
+    qr = make_qr(build_sbp_url(payment_id, amount, description), box_size=box_size)
     img = qr.make_image(fill_color="black", back_color="white")
     
     buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    
-    img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return f"data:image/png;base64,{img_base64}"
+    img.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+def generate_sbp_qr(payment_id: str, amount: float, description: str = '') -> str:
+    '''QR-код для оплаты через СБП в виде data URI (SVG)'''
+    svg = render_sbp_qr_svg(payment_id, amount, description)
+    return 'data:image/svg+xml;base64,' + base64.b64encode(svg.encode('utf-8')).decode('utf-8')
+
+def qr_image_url(payment_id: str) -> str:
+    '''Адрес, по которому функция отдает картинку QR-кода платежа'''
+    base_url = os.environ.get('PAYMENT_SBP_URL', PAYMENT_SBP_URL)
+    return f"{base_url}?action=qr&payment_id={urllib.parse.quote(payment_id)}"
 
 def handler(event: dict, context) -> dict:
     '''API для оплаты через СБП Сбербанка с генерацией QR-кода'''
@@ -101,33 +153,41 @@ def handler(event: dict, context) -> dict:
                 
                 payment_id = f"AVT-{user_id}-{int(datetime.now().timestamp())}"
                 
-                qr_code_data = generate_sbp_qr(amount, payment_id, description)
+                qr_code_url = qr_image_url(payment_id)
                 
                 cursor.execute(
                     f"""INSERT INTO {schema}.payments 
                     (user_id, amount, currency, payment_method, phone_number, status, qr_code_url, payment_id, description, created_at)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                     RETURNING id""",
-                    (user_id, amount, 'RUB', 'SBP', RECIPIENT_PHONE, 'pending', qr_code_data, payment_id, description, datetime.now())
+                    (user_id, amount, 'RUB', 'SBP', RECIPIENT_PHONE, 'pending', qr_code_url, payment_id, description, datetime.now())
                 )
                 payment_db_id = cursor.fetchone()[0]
                 conn.commit()
                 
+                response_data = {
+                    'success': True,
+                    'payment_id': payment_id,
+                    'payment_db_id': payment_db_id,
+                    'amount': amount,
+                    'currency': 'RUB',
+                    'recipient_phone': RECIPIENT_PHONE,
+                    'recipient_bank': RECIPIENT_BANK,
+                    'qr_code_url': qr_code_url,
+                    'status': 'pending',
+                    'description': description
+                }
+                
+                # Встроенный QR остается в ответе, как раньше; SVG рисуется по запросу и кешируется по платежу,
+                # поэтому картинка по qr_code_url на том же экземпляре не рисуется заново.
+                # {"inline_qr": false} отключает его, если клиент грузит картинку по qr_code_url
+                if body.get('inline_qr', True):
+                    response_data['qr_code'] = generate_sbp_qr(payment_id, amount, description)
+                
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'payment_id': payment_id,
-                        'payment_db_id': payment_db_id,
-                        'amount': amount,
-                        'currency': 'RUB',
-                        'recipient_phone': RECIPIENT_PHONE,
-                        'recipient_bank': RECIPIENT_BANK,
-                        'qr_code': qr_code_data,
-                        'status': 'pending',
-                        'description': description
-                    }),
+                    'body': json.dumps(response_data),
                     'isBase64Encoded': False
                 }
             
@@ -168,6 +228,51 @@ def handler(event: dict, context) -> dict:
             query_params = event.get('queryStringParameters', {}) or {}
             action = query_params.get('action', 'get_payments')
             
+            if action == 'qr':
+                payment_id = query_params.get('payment_id')
+                image_format = query_params.get('format', 'svg')
+                
+                if not payment_id or image_format not in ('svg', 'png'):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Требуется payment_id, format: svg или png'}),
+                        'isBase64Encoded': False
+                    }
+                
+                cursor.execute(
+                    f"SELECT amount, description FROM {schema}.payments WHERE payment_id = %s",
+                    (payment_id,)
+                )
+                payment = cursor.fetchone()
+                
+                if not payment:
+                    return {
+                        'statusCode': 404,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Платеж не найден'}),
+                        'isBase64Encoded': False
+                    }
+                
+                amount, description = float(payment[0]), payment[1] or ''
+                # Картинка платежа не меняется: адрес содержит payment_id, поэтому ее можно кешировать надолго
+                cache_headers = {'Access-Control-Allow-Origin': '*', 'Cache-Control': 'public, max-age=86400, immutable'}
+                
+                if image_format == 'png':
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'image/png', **cache_headers},
+                        'body': base64.b64encode(render_sbp_qr_png(payment_id, amount, description)).decode('utf-8'),
+                        'isBase64Encoded': True
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'image/svg+xml', **cache_headers},
+                    'body': render_sbp_qr_svg(payment_id, amount, description),
+                    'isBase64Encoded': False
+                }
+            
             if action == 'get_payments':
                 headers = event.get('headers', {})
                 auth_header = headers.get('X-Authorization', headers.get('authorization', ''))
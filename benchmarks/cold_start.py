@@ -0,0 +1,139 @@
+'''Бенчмарк холодного старта: импорт index.py и первый вызов handler в свежем интерпретаторе.
+
+Каждый замер — отдельный процесс, как у нового экземпляра облачной функции:
+
+    python -m benchmarks.cold_start --runs 15
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/avt_bench python -m benchmarks.cold_start --db
+
+Без --db первый вызов — OPTIONS (только импорт и маршрутизация). С --db вызывается
+легкий GET-путь функции на уже наполненной схеме бенчмарков (см. benchmarks.handlers).
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import harness
+
+FUNCTIONS = ('crm-api', 'payment-api', 'payment-sbp', 'auth', 'email-sender')
+
+# Модули, которые заметно удлиняют импорт и не нужны на большинстве путей
+HEAVY_MODULES = (
+    'ssl', 'http.client', 'urllib.request', 'uuid', 'csv',
+    'qrcode', 'PIL', 'PIL.Image', 'smtplib', 'email.mime.text'
+)
+
+DB_EVENTS = {
+    'crm-api': lambda: harness.make_event('GET', {'path': 'stats'}),
+    'payment-api': lambda: harness.make_event('GET', {'path': 'plans'}),
+    'payment-sbp': lambda: harness.make_event('GET', {'action': 'get_payments'}, headers={
+        'X-Session-Token': 'bench_token_1'
+    }),
+}
+
+
+def probe(function: str, use_db: bool) -> dict:
+    '''Выполняется в дочернем процессе: один холодный импорт и два вызова подряд'''
+    started = time.perf_counter()
+    module = harness.load_function(function)
+    import_ms = (time.perf_counter() - started) * 1000
+
+    if use_db and function in DB_EVENTS:
+        build_event = DB_EVENTS[function]
+    else:
+        build_event = lambda: harness.make_event('OPTIONS')
+
+    _, first_ms = harness.timed(module.handler, build_event(), None)
+    _, second_ms = harness.timed(module.handler, build_event(), None)
+
+    return {
+        'import_ms': import_ms,
+        'first_call_ms': first_ms,
+        'second_call_ms': second_ms,
+        'heavy_modules': sorted(name for name in HEAVY_MODULES if name in sys.modules),
+        'modules_loaded': len(sys.modules)
+    }
+
+
+def run_probe(function: str, use_db: bool, env: dict) -> dict:
+    command = [sys.executable, '-m', 'benchmarks.cold_start', '--probe', function]
+    if use_db:
+        command.append('--db')
+
+    started = time.perf_counter()
+    completed = subprocess.run(command, cwd=harness.REPO_ROOT, env=env, capture_output=True, text=True)
+    process_ms = (time.perf_counter() - started) * 1000
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'probe failed')
+
+    # Обработчики пишут в stdout свои логи (invocation_trace), результат замера — последняя строка
+    sample = json.loads(completed.stdout.strip().splitlines()[-1])
+    sample['process_ms'] = process_ms
+    return sample
+
+
+def aggregate(samples: list) -> dict:
+    result = {'runs': len(samples)}
+    for metric in ('import_ms', 'first_call_ms', 'second_call_ms', 'process_ms'):
+        values = sorted(sample[metric] for sample in samples)
+        result[f'{metric}_p50'] = round(statistics.median(values), 3)
+        result[f'{metric}_max'] = round(values[-1], 3)
+    result['modules_loaded'] = samples[-1]['modules_loaded']
+    result['heavy_modules'] = samples[-1]['heavy_modules']
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк холодного старта облачных функций')
+    parser.add_argument('--runs', type=int, default=10, help='Сколько свежих процессов на функцию')
+    parser.add_argument('--db', action='store_true',
+                        help='Первый вызов идет в БД (нужен BENCH_DATABASE_URL и наполненная схема)')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--only', action='append', help='Замерить только эти функции')
+    parser.add_argument('--probe', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='Путь к JSON с результатами')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args(argv)
+
+    if args.probe:
+        print(json.dumps(probe(args.probe, args.db)))
+        return
+
+    env = dict(os.environ, INSTRUMENTATION='off')
+    if args.db:
+        if not args.dsn:
+            parser.error('для --db укажите --dsn или BENCH_DATABASE_URL')
+        from benchmarks.seed import bench_dsn
+        env['DATABASE_URL'] = bench_dsn(args.dsn)
+        env['MAIN_DB_SCHEMA'] = 't_p3568014_customer_engagement_'
+
+    results = {}
+    for function in args.only or FUNCTIONS:
+        try:
+            # Первый прогон прогревает файловый кэш и __pycache__, в статистику не идет
+            run_probe(function, args.db, env)
+            samples = [run_probe(function, args.db, env) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f'{function:<16} пропущен: {e}', file=sys.stderr)
+            continue
+        results[function] = stats = aggregate(samples)
+        print(f"{function:<16} import p50={stats['import_ms_p50']:.1f}ms  "
+              f"first call p50={stats['first_call_ms_p50']:.1f}ms  "
+              f"process p50={stats['process_ms_p50']:.1f}ms  "
+              f"heavy={','.join(stats['heavy_modules']) or '-'}", file=sys.stderr)
+
+    config = {'runs': args.runs, 'db': args.db}
+    path = harness.write_results('cold_start', results, config, args.output)
+    print(f'Результаты: {path}', file=sys.stderr)
+    if args.compare:
+        print(harness.compare_results(
+            results, args.compare, metrics=('import_ms_p50', 'first_call_ms_p50', 'process_ms_p50')
+        ), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
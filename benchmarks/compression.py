@@ -0,0 +1,154 @@
+'''Бенчмарк сжатия ответов списков: байты и время CPU для уровней gzip и brotli.
+
+    python -m benchmarks.compression --calls 2000 --clients 10000
+
+Тела ответов собираются так же, как в get_calls и get_clients (serialization.dumps_bytes),
+из синтетических строк; словарь транскрипций — русские слова из исходников backend,
+чтобы степень сжатия была ближе к живому тексту, чем у повторяющейся заглушки.
+'''
+
+import argparse
+import base64
+import os
+import random
+import re
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from benchmarks import harness
+
+
+def russian_vocabulary() -> list:
+    words = set()
+    for root, _, files in os.walk(harness.BACKEND_DIR):
+        for name in files:
+            if name.endswith('.py'):
+                with open(os.path.join(root, name), encoding='utf-8') as f:
+                    words.update(word.lower() for word in re.findall(r'[А-Яа-яЁё]{3,}', f.read()))
+    return sorted(words)
+
+
+def make_bodies(calls: int, clients: int, transcript_words: int) -> dict:
+    import serialization
+    from psycopg2.extras import RealDictRow
+
+    rng = random.Random(7)
+    vocabulary = russian_vocabulary()
+    started = datetime(2026, 1, 1, 9, 0, 0)
+
+    call_rows = [
+        RealDictRow({
+            'id': i + 1,
+            'client_id': rng.randint(1, clients),
+            'status': rng.choice(('success', 'failed', 'pending')),
+            'duration': f'{rng.randint(0, 20)}:{rng.randint(0, 59):02d}',
+            'result': rng.choice(('Звонок завершен', 'Не дозвонились', 'Разговор состоялся')),
+            'created_at': started + timedelta(seconds=rng.randint(0, 10 ** 7)),
+            'recording_url': f'https://records.example/{rng.getrandbits(64):016x}.mp3',
+            'transcript': ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(0, transcript_words * 2))),
+            'notes': None,
+            'client_name': f'Клиент {rng.randint(1, clients)}',
+            'client_phone': f'+7999{rng.randint(0, 10 ** 7):07d}'
+        })
+        for i in range(calls)
+    ]
+    client_rows = [
+        RealDictRow({
+            'id': i + 1,
+            'name': f'Клиент {i}',
+            'email': f'client{i}@example.ru',
+            'phone': f'+7999{rng.randint(0, 10 ** 7):07d}',
+            'status': rng.choice(('hot', 'warm', 'cold')),
+            'last_contact': started + timedelta(seconds=rng.randint(0, 10 ** 7)),
+            'created_at': started + timedelta(seconds=rng.randint(0, 10 ** 7)),
+            'score': rng.randint(0, 100)
+        })
+        for i in range(clients)
+    ]
+    return {
+        'calls': serialization.dumps_bytes({'calls': call_rows}),
+        'clients': serialization.dumps_bytes({'clients': client_rows})
+    }
+
+
+def gzip_compress(level: int):
+    def run(data: bytes) -> bytes:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    return run
+
+
+def brotli_compress(quality: int):
+    import brotli
+
+    def run(data: bytes) -> bytes:
+        return brotli.compress(data, quality=quality, mode=brotli.MODE_TEXT)
+    return run
+
+
+def measure(fn, data: bytes, iterations: int) -> dict:
+    latencies = []
+    compressed = b''
+    wall_seconds = 0.0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        compressed = fn(data)
+        # base64 для isBase64Encoded — часть цены сжатого ответа
+        base64.b64encode(compressed)
+        elapsed = time.perf_counter() - started
+        wall_seconds += elapsed
+        latencies.append(elapsed * 1000)
+    summary = harness.summarize(latencies, wall_seconds, {
+        'input_bytes': len(data),
+        'output_bytes': len(compressed),
+        'ratio': round(len(data) / len(compressed), 2),
+        'mb_per_second': round(len(data) / 2 ** 20 / (wall_seconds / iterations), 1)
+    })
+    summary.pop('throughput_rps')
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк сжатия ответов списков')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--transcript-words', type=int, default=120,
+                        help='Среднее число слов в транскрипции звонка')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    harness.load_function('crm-api')
+    import compression
+
+    bodies = make_bodies(args.calls, args.clients, args.transcript_words)
+
+    methods = {f'gzip-{level}': gzip_compress(level) for level in (1, 3, 5, 6, 9)}
+    if compression.brotli is not None:
+        methods.update({f'br-{quality}': brotli_compress(quality) for quality in (1, 3, 4, 5, 6, 9, 11)})
+    else:
+        print('brotli не установлен, замеряется только gzip', file=sys.stderr)
+
+    results = {}
+    for dataset, data in bodies.items():
+        for name, fn in methods.items():
+            # brotli 11 на мегабайтах работает секундами, для него хватает пары замеров
+            iterations = 2 if name == 'br-11' else args.iterations
+            scenario = f'{dataset}/{name}'
+            results[scenario] = stats = measure(fn, data, iterations)
+            print(f"{scenario:<20} p50={stats['p50_ms']:>9.2f}ms  {stats['input_bytes']:>9} → "
+                  f"{stats['output_bytes']:>8} B  x{stats['ratio']:<6} {stats['mb_per_second']:>7.1f} MB/s",
+                  file=sys.stderr)
+
+    config = {
+        'calls': args.calls, 'clients': args.clients, 'transcript_words': args.transcript_words,
+        'iterations': args.iterations, 'gzip_level': compression.GZIP_LEVEL,
+        'brotli_quality': compression.BROTLI_QUALITY
+    }
+    print(f"Результаты: {harness.write_results('compression', results, config, args.output)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,535 @@
+'''Локальные заглушки MANGO OFFICE, SpeechKit, YandexGPT, YooKassa, email-sender и SMTP для нагрузочных тестов.
+
+Каждый сервис слушает свой порт на 127.0.0.1 и поддерживает настраиваемую задержку,
+долю ошибок и ограничение пропускной способности (сверх лимита отвечает 429 / SMTP 451).
+
+Запуск отдельно:
+    python -m benchmarks.fakes --latency-ms 80 --error-rate 0.02 --max-rps 50
+
+Команда печатает переменные окружения, которые переключают функции на заглушки.
+Из кода: start_fakes(...) возвращает FakeCluster с готовым словарем env.
+'''
+
+import argparse
+import base64
+import json
+import random
+import socketserver
+import struct
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import dataclass, field, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICES = ('mango', 'speechkit', 'yandexgpt', 'yookassa', 'email-sender', 'smtp')
+
+FAKE_TRANSCRIPT = (
+    'Здравствуйте, интересуют тормозные колодки и масляный фильтр. '
+    'У конкурента цена ниже, можете дать скидку на оптовый заказ? '
+    'Договорились, отправьте счет, перезвоните завтра.'
+)
+
+
+@dataclass
+class Behavior:
+    '''Поведение заглушки: задержка ответа, доля ошибок и лимит запросов в секунду'''
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    max_rps: float = 0.0
+    seed: int = None
+    rng: random.Random = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.rng is None:
+            self.rng = random.Random(self.seed)
+
+    def delay(self):
+        latency = self.latency_ms
+        if self.jitter_ms:
+            latency += self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and self.rng.random() < self.error_rate
+
+
+class TokenBucket:
+    '''Потокобезопасное ведро токенов для ограничения пропускной способности'''
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class ServiceStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0, 'throttled': 0}
+
+    def incr(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+# --- HTTP-сервисы -----------------------------------------------------------
+
+def mango_callback(request, body: bytes):
+    return 200, {'result': 1000, 'command_id': request.form().get('json', '')[:64]}
+
+
+# --- Синтетический Ogg Opus ---------------------------------------------------
+
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+OPUS_FRAME_SAMPLES = 960  # 20 мс при 48 кГц
+OPUS_PRE_SKIP = 312
+OPUS_FRAMES_PER_PAGE = 50
+STT_MAX_SECONDS = 30
+STT_MAX_BYTES = 1024 * 1024
+_REVERSED_BITS = bytes(int(f'{byte:08b}'[::-1], 2) for byte in range(256))
+_recordings = {}
+
+
+def ogg_crc(data: bytes) -> int:
+    crc = zlib.crc32(data.translate(_REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f'{crc:032b}'[::-1], 2)
+
+
+def ogg_page(packets: list, flags: int, granule: int, sequence: int, serial: int = 0x5eed) -> bytes:
+    lacing = bytearray()
+    for packet in packets:
+        lacing += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+    page = OGG_PAGE_HEADER.pack(b'OggS', 0, flags, granule, serial, sequence, 0, len(lacing)) + bytes(lacing) + b''.join(packets)
+    return page[:22] + struct.pack('<I', ogg_crc(page)) + page[26:]
+
+
+def synthetic_recording(seconds: int, frame_bytes: int = 80) -> bytes:
+    '''Корректный поток Ogg Opus из пустых кадров по 20 мс; номер кадра зашит в начало пакета'''
+    if seconds in _recordings:
+        return _recordings[seconds]
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, OPUS_PRE_SKIP, 16000, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 4) + b'fake' + struct.pack('<I', 0)
+    pages = [ogg_page([head], 0x02, 0, 0), ogg_page([tags], 0, 0, 1)]
+    frames = seconds * 1000 // 20
+    for start in range(0, frames, OPUS_FRAMES_PER_PAGE):
+        count = min(OPUS_FRAMES_PER_PAGE, frames - start)
+        packets = [b'\xfc' + struct.pack('>I', start + i) + b'\0' * (frame_bytes - 5) for i in range(count)]
+        flags = 0x04 if start + count >= frames else 0
+        granule = OPUS_PRE_SKIP + (start + count) * OPUS_FRAME_SAMPLES
+        pages.append(ogg_page(packets, flags, granule, len(pages)))
+    _recordings[seconds] = data = b''.join(pages)
+    return data
+
+
+def inspect_recording(data: bytes) -> dict:
+    '''Проверяет поток так же строго, как распознаватель: CRC, порядок страниц, длительность'''
+    offset, sequence, granule, first_frame = 0, 0, 0, None
+    while offset < len(data):
+        capture, _, flags, page_granule, _, page_sequence, crc, segments = OGG_PAGE_HEADER.unpack_from(data, offset)
+        lacing = data[offset + 27:offset + 27 + segments]
+        size = 27 + segments + sum(lacing)
+        page = data[offset:offset + size]
+        if capture != b'OggS' or page_sequence != sequence or ogg_crc(page[:22] + b'\0' * 4 + page[26:]) != crc:
+            return {'error': f'invalid page {sequence}'}
+        if sequence >= 2 and first_frame is None and lacing:
+            first_frame = struct.unpack_from('>I', page, 27 + segments + 1)[0]
+        if page_granule != -1:
+            granule = page_granule
+        offset += size
+        sequence += 1
+    return {'seconds': (granule - OPUS_PRE_SKIP) / 48000, 'first_frame': first_frame}
+
+
+def speechkit_recognize(request, body: bytes):
+    if body[:4] != b'OggS':
+        return 200, {'result': FAKE_TRANSCRIPT}
+    if len(body) > STT_MAX_BYTES:
+        return 400, {'error_code': 'BAD_REQUEST', 'error_message': 'audio exceeds 1 MB'}
+    info = inspect_recording(body)
+    if 'error' in info:
+        return 400, {'error_code': 'BAD_REQUEST', 'error_message': info['error']}
+    if info['seconds'] > STT_MAX_SECONDS:
+        return 400, {'error_code': 'BAD_REQUEST', 'error_message': 'audio exceeds 30 seconds'}
+    # Метка смещения позволяет проверить порядок склейки фрагментов
+    offset = (info['first_frame'] or 0) * 20 // 1000
+    return 200, {'result': f'[{offset}s] {FAKE_TRANSCRIPT}'}
+
+
+def recording(request, body: bytes):
+    # Длительность задается ?seconds=, либо размер ?kb= (80-байтные кадры: 4 КБ на секунду)
+    query = request.query()
+    seconds = int(query['seconds']) if 'seconds' in query else max(1, int(query.get('kb', '64')) // 4)
+    return 200, synthetic_recording(seconds)
+
+
+def yandexgpt_completion(request, body: bytes):
+    payload = json.loads(body or b'{}')
+    prompt = payload.get('messages', [{}])[-1].get('text', '')
+    return 200, {
+        'result': {
+            'alternatives': [{
+                'message': {'role': 'assistant', 'text': f'1. Цель звонка: уточнение заказа ({len(prompt)} симв.)'},
+                'status': 'ALTERNATIVE_STATUS_FINAL'
+            }],
+            'usage': {'inputTextTokens': str(len(prompt) // 4), 'completionTokens': '32'},
+            'modelVersion': 'fake'
+        }
+    }
+
+
+def yookassa_create_payment(request, body: bytes):
+    payload = json.loads(body or b'{}')
+    key = request.headers.get('Idempotence-Key')
+    cache = request.server.idempotence_cache
+    with request.server.idempotence_lock:
+        if key and key in cache:
+            return 200, cache[key]
+        payment_id = str(uuid.uuid4())
+        result = {
+            'id': payment_id,
+            'status': 'pending',
+            'paid': False,
+            'amount': payload.get('amount'),
+            'confirmation': {
+                'type': 'redirect',
+                'confirmation_url': f'https://yoomoney.fake/checkout/payments/v2/contract?orderId={payment_id}'
+            },
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            'description': payload.get('description'),
+            'metadata': payload.get('metadata', {}),
+            'payment_method': {'type': 'bank_card', 'id': payment_id, 'saved': False}
+        }
+        if key:
+            cache[key] = result
+    return 200, result
+
+
+def email_sender(request, body: bytes):
+    return 200, {'success': True, 'message': 'Email успешно отправлен'}
+
+
+HTTP_ROUTES = {
+    'mango': {('POST', '/vpbx/commands/callback'): mango_callback},
+    'speechkit': {
+        ('POST', '/speech/v1/stt:recognize'): speechkit_recognize,
+        ('GET', '/recordings/'): recording
+    },
+    'yandexgpt': {('POST', '/foundationModels/v1/completion'): yandexgpt_completion},
+    'yookassa': {('POST', '/v3/payments'): yookassa_create_payment},
+    'email-sender': {('POST', '/'): email_sender}
+}
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def query(self) -> dict:
+        from urllib.parse import urlsplit, parse_qsl
+        return dict(parse_qsl(urlsplit(self.path).query))
+
+    def form(self) -> dict:
+        from urllib.parse import parse_qsl
+        return dict(parse_qsl(self._body.decode('utf-8', 'replace')))
+
+    def _route(self, method: str):
+        path = self.path.split('?', 1)[0]
+        for (route_method, route_path), fn in self.server.routes.items():
+            if route_method != method:
+                continue
+            if path == route_path or (route_path != '/' and route_path.endswith('/') and path.startswith(route_path)):
+                return fn
+        return None
+
+    def _send(self, status: int, payload):
+        if isinstance(payload, (bytes, bytearray)):
+            data, content_type = bytes(payload), 'application/octet-stream'
+        else:
+            data, content_type = json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._body = self.rfile.read(length) if length else b''
+
+        if self.path == '/__stats':
+            return self._send(200, self.server.stats.snapshot())
+
+        stats, behavior = self.server.stats, self.server.behavior
+        stats.incr('requests')
+
+        if not self.server.bucket.acquire():
+            stats.incr('throttled')
+            return self._send(429, {'type': 'error', 'code': 'too_many_requests'})
+
+        behavior.delay()
+
+        if behavior.should_fail():
+            stats.incr('errors')
+            return self._send(503, {'type': 'error', 'code': 'internal_server_error', 'message': 'fake failure'})
+
+        fn = self._route(method)
+        if fn is None:
+            return self._send(404, {'error': 'not found'})
+        status, payload = fn(self, self._body)
+        self._send(status, payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: str, behavior: Behavior, port: int = 0):
+        super().__init__(('127.0.0.1', port), FakeRequestHandler)
+        self.service = service
+        self.routes = HTTP_ROUTES[service]
+        self.behavior = behavior
+        self.bucket = TokenBucket(behavior.max_rps)
+        self.stats = ServiceStats()
+        self.idempotence_cache = {}
+        self.idempotence_lock = threading.Lock()
+
+
+# --- SMTP --------------------------------------------------------------------
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    '''Минимальный SMTP без TLS: EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, RSET, NOOP, QUIT'''
+
+    def reply(self, line: str):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        self.reply('220 fake-smtp ESMTP ready')
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            command = raw.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb in ('EHLO', 'HELO'):
+                if verb == 'EHLO':
+                    self.reply('250-fake-smtp')
+                    self.reply('250-AUTH PLAIN LOGIN')
+                    self.reply('250 8BITMIME')
+                else:
+                    self.reply('250 fake-smtp')
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    # smtplib отправляет логин в первой строке, пароль по запросу
+                    self.reply('334 ' + base64.b64encode(b'Password:').decode())
+                    self.rfile.readline()
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                server.stats.incr('requests')
+                if not server.bucket.acquire():
+                    server.stats.incr('throttled')
+                    self.reply('451 4.7.1 Rate limit exceeded')
+                    continue
+                server.behavior.delay()
+                if server.behavior.should_fail():
+                    server.stats.incr('errors')
+                    self.reply('451 4.3.0 Fake failure')
+                    continue
+                self.reply('250 2.0.0 Queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, behavior: Behavior, port: int = 0):
+        super().__init__(('127.0.0.1', port), FakeSMTPHandler)
+        self.service = 'smtp'
+        self.behavior = behavior
+        self.bucket = TokenBucket(behavior.max_rps)
+        self.stats = ServiceStats()
+
+
+# --- Кластер -----------------------------------------------------------------
+
+class FakeCluster:
+    '''Набор запущенных заглушек и переменные окружения, которые на них указывают'''
+
+    def __init__(self, servers: dict):
+        self.servers = servers
+        self.threads = []
+        for server in servers.values():
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def url(self, service: str) -> str:
+        host, port = self.servers[service].server_address[:2]
+        return f'http://{host}:{port}'
+
+    def recording_url(self, name: str = 'call', kb: int = 64, seconds: int = None) -> str:
+        size = f'seconds={seconds}' if seconds else f'kb={kb}'
+        return f"{self.url('speechkit')}/recordings/{name}.ogg?{size}"
+
+    @property
+    def env(self) -> dict:
+        env = {}
+        if 'mango' in self.servers:
+            env.update({
+                'MANGO_API_URL': self.url('mango') + '/vpbx',
+                'MANGO_VPBX_API_KEY': 'fake-key',
+                'MANGO_VPBX_API_SALT': 'fake-salt',
+                'MANGO_FROM_EXTENSION': '100'
+            })
+        if 'speechkit' in self.servers:
+            env.update({
+                'YANDEX_STT_URL': self.url('speechkit'),
+                'YANDEX_SPEECHKIT_API_KEY': 'fake-key',
+                'YANDEX_FOLDER_ID': 'fake-folder'
+            })
+        if 'yandexgpt' in self.servers:
+            env.update({
+                'YANDEX_GPT_URL': self.url('yandexgpt'),
+                'YANDEX_API_KEY': 'fake-key',
+                'YANDEX_FOLDER_ID': 'fake-folder'
+            })
+        if 'yookassa' in self.servers:
+            env.update({
+                'YOOKASSA_API_URL': self.url('yookassa') + '/v3',
+                'YOOKASSA_SHOP_ID': 'fake-shop',
+                'YOOKASSA_SECRET_KEY': 'fake-secret'
+            })
+        if 'email-sender' in self.servers:
+            env['EMAIL_SENDER_URL'] = self.url('email-sender') + '/'
+        if 'smtp' in self.servers:
+            host, port = self.servers['smtp'].server_address[:2]
+            env.update({
+                'SMTP_HOST': host,
+                'SMTP_PORT': str(port),
+                'SMTP_USER': 'robot@fake.local',
+                'SMTP_USERNAME': 'robot@fake.local',
+                'SMTP_PASSWORD': 'fake-password',
+                'SMTP_STARTTLS': 'false'
+            })
+        return env
+
+    def stats(self) -> dict:
+        return {name: server.stats.snapshot() for name, server in self.servers.items()}
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+def start_fakes(behavior: Behavior = None, services=SERVICES, overrides: dict = None, ports: dict = None) -> FakeCluster:
+    '''Запускает заглушки; overrides позволяет задать поведение отдельного сервиса'''
+    behavior = behavior or Behavior()
+    overrides = overrides or {}
+    ports = ports or {}
+    servers = {}
+    for service in services:
+        service_behavior = replace(behavior, rng=None, **overrides.get(service, {}))
+        if service == 'smtp':
+            servers[service] = FakeSMTPServer(service_behavior, ports.get(service, 0))
+        else:
+            servers[service] = FakeHTTPServer(service, service_behavior, ports.get(service, 0))
+    return FakeCluster(servers)
+
+
+def parse_override(value: str):
+    '''Разбирает "сервис:ключ=значение,ключ=значение" в (сервис, словарь)'''
+    service, _, settings = value.partition(':')
+    if service not in SERVICES:
+        raise argparse.ArgumentTypeError(f'неизвестный сервис {service}')
+    parsed = {}
+    for item in filter(None, settings.split(',')):
+        key, _, raw = item.partition('=')
+        if key not in ('latency_ms', 'jitter_ms', 'error_rate', 'max_rps'):
+            raise argparse.ArgumentTypeError(f'неизвестный параметр {key}')
+        parsed[key] = float(raw)
+    return service, parsed
+
+
+def add_behavior_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--max-rps', type=float, default=0.0, help='0 — без ограничения')
+    parser.add_argument('--fake-override', action='append', type=parse_override, default=[],
+                        metavar='SERVICE:key=value,...',
+                        help='Поведение отдельного сервиса, например yandexgpt:latency_ms=1500')
+
+
+def behavior_from_args(args) -> tuple:
+    behavior = Behavior(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate, max_rps=args.max_rps
+    )
+    return behavior, dict(args.fake_override)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Локальные заглушки внешних сервисов')
+    add_behavior_arguments(parser)
+    parser.add_argument('--base-port', type=int, default=0,
+                        help='Фиксированные порты base-port, base-port+1, ... (по умолчанию случайные)')
+    args = parser.parse_args(argv)
+
+    behavior, overrides = behavior_from_args(args)
+    ports = {service: args.base_port + i for i, service in enumerate(SERVICES)} if args.base_port else None
+    cluster = start_fakes(behavior, overrides=overrides, ports=ports)
+
+    for key, value in sorted(cluster.env.items()):
+        print(f'export {key}={value}')
+    print(f"# записи разговоров: {cluster.recording_url('example')}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cluster.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+'''Нагрузочный бенчмарк обработчиков: вызывает handler(event, context) напрямую на локальной PostgreSQL.
+
+Пример:
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/avt_bench \\
+        python -m benchmarks.handlers --clients 100000 --calls 500000 --iterations 200
+
+Схема t_p3568014_customer_engagement_ в указанной базе пересоздается при каждом прогоне
+(если не передан --no-seed). Результаты пишутся в benchmarks/results/*.json.
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import fakes, harness
+from benchmarks.seed import prepare_database, bench_dsn
+
+
+# (имя сценария, функция, построитель события). Построитель получает генератор
+# случайных чисел и контекст с диапазонами id из наполненной базы.
+SCENARIOS = [
+    ('crm.stats', 'crm-api', lambda rng, ctx: harness.make_event('GET', {'path': 'stats'})),
+    ('crm.clients', 'crm-api', lambda rng, ctx: harness.make_event('GET', {'path': 'clients'})),
+    ('crm.calls', 'crm-api', lambda rng, ctx: harness.make_event('GET', {'path': 'calls'})),
+    ('crm.search_calls', 'crm-api', lambda rng, ctx: harness.make_event('GET', {
+        'path': 'search_calls', 'q': rng.choice(('колодки', 'конкурент', 'доставка склад', 'скидка'))
+    })),
+    ('crm.initiate_call', 'crm-api', lambda rng, ctx: harness.make_event('POST', {'path': 'initiate_call'}, {
+        'client_id': rng.randint(*ctx['client_ids']), 'phone': '+79990000000'
+    })),
+    ('crm.mango_webhook', 'crm-api', lambda rng, ctx: harness.make_event('POST', {'path': 'mango_webhook'}, {
+        'event': 'call',
+        'call': {
+            'entry_id': str(rng.random()),
+            'call_state': 'Disconnected',
+            'to': {'number': '+7999' + str(rng.randint(1, ctx['clients'])).zfill(7)},
+            'total_time': rng.randint(0, 600)
+        }
+    })),
+    ('payment.plans', 'payment-api', lambda rng, ctx: harness.make_event('GET', {'path': 'plans'})),
+    ('payment.subscription', 'payment-api', lambda rng, ctx: harness.make_event('GET', {
+        'path': 'subscription', 'user_id': str(rng.randint(*ctx['user_ids']))
+    })),
+    ('payment.payment_history', 'payment-api', lambda rng, ctx: harness.make_event('GET', {
+        'path': 'payment_history', 'user_id': str(rng.randint(*ctx['user_ids']))
+    })),
+    ('payment.check_access', 'payment-api', lambda rng, ctx: harness.make_event('POST', {'path': 'check_access'}, {
+        'user_id': rng.randint(*ctx['user_ids']), 'feature': rng.choice(('ai_analysis', 'ai_suggestions'))
+    })),
+    ('payment.create_payment', 'payment-api', lambda rng, ctx: harness.make_event('POST', {'path': 'create_payment'}, {
+        'user_id': rng.randint(*ctx['user_ids']), 'plan_type': 'professional', 'billing_period': 'monthly'
+    })),
+    ('payment.check_expiring', 'payment-api', lambda rng, ctx: harness.make_event('POST', {'path': 'check_expiring'})),
+    ('email.send_call_summary', 'email-sender', lambda rng, ctx: harness.make_event('POST', body={
+        'action': 'send_call_summary', 'to_email': 'manager@bench.local', 'client_name': 'Клиент',
+        'company': 'ООО Автодеталь', 'phone': '+79990000001', 'duration': '3:15', 'status': 'success',
+        'result': 'Звонок завершен', 'summary': 'Клиент заинтересован', 'full_analysis': 'Клиент заинтересован'
+    })),
+    ('email.subscription_notification', 'email-sender', lambda rng, ctx: harness.make_event('POST', body={
+        'action': 'send_subscription_notification', 'to_email': 'user@bench.local', 'subject': 'Подписка',
+        'message': 'Подписка истекает', 'plan_type': 'starter', 'days_left': 3, 'auto_renew': False, 'name': 'Пользователь'
+    })),
+    ('crm.mango_webhook_recording', 'crm-api', lambda rng, ctx: harness.make_event('POST', {'path': 'mango_webhook'}, {
+        'event': 'call',
+        'call': {
+            'entry_id': str(rng.random()),
+            'call_state': 'Disconnected',
+            'to': {'number': '+7999' + str(rng.randint(1, ctx['clients'])).zfill(7)},
+            'total_time': rng.randint(30, 600),
+            'recording': {'url': ctx['fakes'].recording_url(str(rng.randint(1, 10 ** 6)))}
+        }
+    })),
+    ('crm.ai_analyze', 'crm-api', lambda rng, ctx: harness.make_event('POST', {'path': 'ai_analyze'}, {
+        'call_id': rng.randint(*ctx['call_ids'])
+    })),
+    ('crm.ai_suggest', 'crm-api', lambda rng, ctx: harness.make_event('POST', {'path': 'ai_suggest'}, {
+        'client_id': rng.randint(*ctx['client_ids'])
+    })),
+    ('sbp.get_payments', 'payment-sbp', lambda rng, ctx: harness.make_event('GET', {'action': 'get_payments'}, headers={
+        'X-Authorization': 'Bearer bench_token_' + str(rng.randint(1, ctx['users']))
+    })),
+]
+
+# Сценарии, которые без заглушек внешних сервисов упираются в сеть или в отсутствие настроек
+REQUIRES_FAKES = {
+    'email.send_call_summary', 'email.subscription_notification',
+    'crm.mango_webhook_recording', 'crm.ai_analyze', 'crm.ai_suggest'
+}
+
+
+def load_context(dsn: str, volumes: dict) -> dict:
+    '''Диапазоны id из базы, чтобы события ссылались на существующие строки'''
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT min(id), max(id) FROM clients')
+            client_ids = cursor.fetchone()
+            cursor.execute('SELECT min(id), max(id) FROM calls')
+            call_ids = cursor.fetchone()
+            cursor.execute("SELECT min(id), max(id) FROM users WHERE username LIKE 'bench_user_%'")
+            user_ids = cursor.fetchone()
+    finally:
+        conn.close()
+    return dict(volumes, client_ids=client_ids, call_ids=call_ids, user_ids=user_ids)
+
+
+def run_scenario(name: str, function: str, build_event, ctx: dict, iterations: int,
+                 concurrency: int, warmup: int, seed: int) -> dict:
+    '''Прогоняет один сценарий и возвращает сводную статистику'''
+    handler = harness.load_function(function).handler
+    rng = random.Random(seed)
+    events = [build_event(rng, ctx) for _ in range(warmup + iterations)]
+
+    for event in events[:warmup]:
+        handler(event, None)
+
+    def invoke(event):
+        harness.reset_query_count()
+        response, elapsed_ms = harness.timed(handler, event, None)
+        failed = response.get('statusCode', 500) >= 500
+        return elapsed_ms, harness.get_query_count(), failed
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(invoke, events[warmup:]))
+    else:
+        samples = [invoke(event) for event in events[warmup:]]
+    wall_seconds = time.perf_counter() - started
+
+    latencies = [s[0] for s in samples]
+    queries = [s[1] for s in samples]
+    return harness.summarize(latencies, wall_seconds, {
+        'function': function,
+        'queries_per_call': round(sum(queries) / len(queries), 2) if queries else 0,
+        'errors': sum(1 for s in samples if s[2])
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк обработчиков облачных функций')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DATABASE_URL'),
+                        help='Локальная PostgreSQL (по умолчанию BENCH_DATABASE_URL)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=50000)
+    parser.add_argument('--payments', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', action='append', help='Запустить только сценарии с этим префиксом')
+    parser.add_argument('--no-seed', action='store_true', help='Не пересоздавать схему и данные')
+    parser.add_argument('--fakes', action='store_true',
+                        help='Поднять локальные заглушки MANGO, SpeechKit, YandexGPT, YooKassa и SMTP')
+    fakes.add_behavior_arguments(parser)
+    parser.add_argument('--output', help='Путь к JSON с результатами')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args(argv)
+
+    if not args.dsn:
+        parser.error('укажите --dsn или BENCH_DATABASE_URL')
+
+    volumes = {'users': args.users, 'clients': args.clients, 'calls': args.calls, 'payments': args.payments}
+
+    if args.no_seed:
+        dsn = bench_dsn(args.dsn)
+    else:
+        print(f'Наполнение базы: {volumes}', file=sys.stderr)
+        dsn = prepare_database(args.dsn, **volumes)
+
+    # Обработчики читают DSN из окружения; внешние интеграции остаются в демо-режиме
+    os.environ['DATABASE_URL'] = dsn
+    os.environ['MAIN_DB_SCHEMA'] = 't_p3568014_customer_engagement_'
+    harness.install_query_counter()
+
+    cluster = None
+    if args.fakes:
+        behavior, overrides = fakes.behavior_from_args(args)
+        cluster = fakes.start_fakes(behavior, overrides=overrides)
+        os.environ.update(cluster.env)
+
+    ctx = load_context(dsn, volumes)
+    ctx['fakes'] = cluster
+    results = {}
+    for name, function, build_event in SCENARIOS:
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        if name in REQUIRES_FAKES and cluster is None:
+            continue
+        try:
+            results[name] = run_scenario(
+                name, function, build_event, ctx,
+                iterations=args.iterations, concurrency=args.concurrency,
+                warmup=args.warmup, seed=args.seed
+            )
+        except (ImportError, SyntaxError) as e:
+            # Например, payment-sbp без установленного qrcode или email_campaign на Python < 3.12
+            print(f'{name:<28} пропущен: {e}', file=sys.stderr)
+            continue
+        stats = results[name]
+        print(f"{name:<28} p50={stats['p50_ms']:>8.2f}ms p95={stats['p95_ms']:>8.2f}ms "
+              f"p99={stats['p99_ms']:>8.2f}ms rps={stats['throughput_rps']:>8.1f} "
+              f"queries={stats['queries_per_call']:>5} errors={stats['errors']}", file=sys.stderr)
+
+    config = dict(volumes, iterations=args.iterations, warmup=args.warmup,
+                  concurrency=args.concurrency, seed=args.seed, fakes=args.fakes)
+    if cluster is not None:
+        config['fake_behavior'] = {
+            'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+            'error_rate': args.error_rate, 'max_rps': args.max_rps,
+            'overrides': dict(args.fake_override)
+        }
+        results['_fakes'] = cluster.stats()
+        cluster.stop()
+
+    output = harness.write_results('handlers', results, config, args.output)
+    print(f'Результаты: {output}', file=sys.stderr)
+
+    if args.compare:
+        print(harness.compare_results(results, args.compare))
+
+
+if __name__ == '__main__':
+    main()
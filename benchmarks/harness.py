@@ -0,0 +1,183 @@
+'''Общие утилиты бенчмарков: загрузка обработчиков функций, подсчет SQL-запросов и статистика'''
+
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(REPO_ROOT, 'backend')
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+_query_counter = threading.local()
+
+
+def load_function(name: str):
+    '''Импортирует backend/<name>/index.py как отдельный модуль, не мешая другим функциям'''
+    function_dir = os.path.join(BACKEND_DIR, name)
+    module_name = 'bench_fn_' + name.replace('-', '_')
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    # Соседние модули функции (например, clients_bulk) импортируются по короткому имени
+    if function_dir not in sys.path:
+        sys.path.insert(0, function_dir)
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(function_dir, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_event(method: str = 'GET', params: dict = None, body=None, headers: dict = None) -> dict:
+    '''Формирует событие в формате, который платформа передает в handler'''
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body, ensure_ascii=False)
+    return {
+        'httpMethod': method,
+        'queryStringParameters': params or {},
+        'headers': headers or {},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+def install_query_counter():
+    '''Подменяет psycopg2.connect так, чтобы курсоры считали выполненные запросы в текущем потоке'''
+    import psycopg2
+    import psycopg2.extensions
+
+    if getattr(psycopg2.connect, '_bench_counting', False):
+        return
+
+    cursor_classes = {}
+
+    def counting_cursor_class(base):
+        if base not in cursor_classes:
+            def counted(method_name):
+                original = getattr(base, method_name)
+
+                def wrapper(self, *args, **kwargs):
+                    _query_counter.count = getattr(_query_counter, 'count', 0) + 1
+                    return original(self, *args, **kwargs)
+                return wrapper
+
+            cursor_classes[base] = type('Counting' + base.__name__, (base,), {
+                name: counted(name) for name in ('execute', 'executemany', 'copy_expert', 'callproc')
+            })
+        return cursor_classes[base]
+
+    class CountingConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+            kwargs['cursor_factory'] = counting_cursor_class(base)
+            return super().cursor(*args, **kwargs)
+
+    original_connect = psycopg2.connect
+
+    def counting_connect(*args, **kwargs):
+        kwargs.setdefault('connection_factory', CountingConnection)
+        return original_connect(*args, **kwargs)
+
+    counting_connect._bench_counting = True
+    psycopg2.connect = counting_connect
+
+
+def reset_query_count():
+    _query_counter.count = 0
+
+
+def get_query_count() -> int:
+    return getattr(_query_counter, 'count', 0)
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    '''Перцентиль с линейной интерполяцией по отсортированному списку'''
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(latencies_ms: list, wall_seconds: float, extra: dict = None) -> dict:
+    '''Сводная статистика по замерам одного сценария'''
+    ordered = sorted(latencies_ms)
+    summary = {
+        'iterations': len(ordered),
+        'p50_ms': round(percentile(ordered, 0.50), 3),
+        'p95_ms': round(percentile(ordered, 0.95), 3),
+        'p99_ms': round(percentile(ordered, 0.99), 3),
+        'mean_ms': round(statistics.fmean(ordered), 3) if ordered else 0.0,
+        'max_ms': round(ordered[-1], 3) if ordered else 0.0,
+        'throughput_rps': round(len(ordered) / wall_seconds, 2) if wall_seconds > 0 else 0.0
+    }
+    if extra:
+        summary.update(extra)
+    return summary
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_results(suite: str, results: dict, config: dict, output: str = None) -> str:
+    '''Сохраняет результаты прогона в JSON вместе с метаданными окружения'''
+    started = datetime.now(timezone.utc)
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{suite}-{started.strftime('%Y%m%dT%H%M%SZ')}.json")
+
+    document = {
+        'suite': suite,
+        'created_at': started.isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'results': results
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    return output
+
+
+def compare_results(current: dict, baseline_path: str, metrics=('p50_ms', 'p95_ms', 'p99_ms')) -> str:
+    '''Текстовое сравнение текущего прогона с сохраненным файлом результатов'''
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+
+    lines = [f"{'scenario':<32}" + ''.join(f'{m:>22}' for m in metrics)]
+    for name, stats in current.items():
+        if name not in baseline:
+            continue
+        cells = []
+        for metric in metrics:
+            before, after = baseline[name].get(metric), stats.get(metric)
+            if not before or after is None:
+                cells.append(f"{'n/a':>22}")
+                continue
+            delta = (after - before) / before * 100
+            cells.append(f'{before:>8.2f} → {after:>7.2f} {delta:+5.0f}%')
+        lines.append(f'{name:<32}' + ''.join(cells))
+    return '\n'.join(lines)
+
+
+def timed(fn, *args, **kwargs):
+    '''Выполняет функцию и возвращает (результат, миллисекунды)'''
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
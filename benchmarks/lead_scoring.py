@@ -0,0 +1,145 @@
+'''Бенчмарк скоринга лидов: полный пересчет по миллиону клиентов и инкрементальный после новых звонков.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/avt_bench \\
+        python -m benchmarks.lead_scoring --clients 1000000 --calls-per-client 3
+
+Клиенты и звонки генерируются в схеме бенчмарков внутри одной транзакции, которая
+в конце откатывается, поэтому схема остается в исходном состоянии (миграции должны быть применены).
+'''
+
+import argparse
+import os
+import sys
+import time
+
+from benchmarks import harness
+from benchmarks.seed import bench_dsn
+
+
+def generate(cursor, clients: int, calls_per_client: int):
+    cursor.execute("""
+        INSERT INTO clients (name, email, phone, company, status, last_contact, created_at)
+        SELECT
+            'Лид ' || i, 'lead_' || i || '@scoring.bench.local',
+            '+7998' || lpad(i::text, 7, '0'), 'ООО Лид ' || (i %% 1000),
+            (ARRAY['hot', 'warm', 'cold'])[1 + i %% 3],
+            NOW() - random() * INTERVAL '90 days',
+            NOW() - random() * INTERVAL '365 days'
+        FROM generate_series(1, %s) AS i
+        RETURNING id
+    """, (clients,))
+    client_ids = [row[0] for row in cursor.fetchall()]
+
+    # Число звонков у клиента неравномерное: от 0 до 2 * calls_per_client
+    cursor.execute("""
+        INSERT INTO calls (client_id, status, duration, result, created_at)
+        SELECT
+            c.id,
+            (ARRAY['success', 'failed', 'success', 'pending'])[1 + floor(random() * 4)::int],
+            floor(random() * 15)::int || ':' || lpad(floor(random() * 60)::int::text, 2, '0'),
+            'Звонок завершен',
+            NOW() - random() * INTERVAL '180 days'
+        FROM unnest(%s::int[]) AS c(id),
+             generate_series(1, (c.id::bigint * 7919) %% (2 * %s + 1))
+    """, (client_ids, calls_per_client))
+    calls = cursor.rowcount
+
+    cursor.execute("""
+        INSERT INTO lead_scores (client_id, emails_sent, emails_opened, emails_clicked)
+        SELECT id, 4, floor(random() * 4)::int, floor(random() * 2)::int
+        FROM unnest(%s::int[]) AS c(id)
+        WHERE random() < 0.3
+    """, (client_ids,))
+    cursor.execute('ANALYZE clients, calls, lead_scores')
+    return client_ids, calls
+
+
+def timed_stage(fn, *args) -> tuple:
+    started = time.perf_counter()
+    rows = fn(*args)
+    return rows, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк скоринга лидов')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--clients', type=int, default=1000000)
+    parser.add_argument('--calls-per-client', type=int, default=3)
+    parser.add_argument('--incremental', type=int, default=200, help='Сколько инкрементальных пересчетов замерить')
+    parser.add_argument('--output', help='Путь к JSON с результатами')
+    args = parser.parse_args(argv)
+
+    if not args.dsn:
+        parser.error('укажите --dsn или BENCH_DATABASE_URL')
+
+    import random
+
+    import psycopg2
+
+    harness.load_function('crm-api')
+    import scoring
+
+    conn = psycopg2.connect(bench_dsn(args.dsn))
+    try:
+        cursor = conn.cursor()
+        started = time.perf_counter()
+        client_ids, calls = generate(cursor, args.clients, args.calls_per_client)
+        print(f'сгенерировано клиентов={len(client_ids)} звонков={calls} '
+              f'за {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        full_rows, full_seconds = timed_stage(scoring.rebuild_scores, cursor)
+        # Повторные проходы: балл почти у всех прежний, переписываются только изменившиеся строки
+        rebuild_rows, rebuild_seconds = timed_stage(scoring.rebuild_scores, cursor)
+        refresh_rows, refresh_seconds = timed_stage(scoring.refresh_scores, cursor)
+
+        latencies = []
+        incremental_started = time.perf_counter()
+        for _ in range(args.incremental):
+            client_id = random.choice(client_ids)
+            cursor.execute("""
+                INSERT INTO calls (client_id, status, duration, result)
+                VALUES (%s, 'success', '3:15', 'Звонок завершен')
+            """, (client_id,))
+            _, elapsed_ms = harness.timed(scoring.score_clients, cursor, [client_id])
+            latencies.append(elapsed_ms)
+        incremental_wall = time.perf_counter() - incremental_started
+
+        cursor.execute("""
+            SELECT COUNT(*) FILTER (WHERE score IS NOT NULL), MIN(score), MAX(score), AVG(score)::real
+            FROM lead_scores WHERE client_id = ANY(%s)
+        """, (client_ids,))
+        scored, min_score, max_score, avg_score = cursor.fetchone()
+    finally:
+        conn.rollback()
+        conn.close()
+
+    results = {
+        'full': {
+            'clients': len(client_ids),
+            'calls': calls,
+            'rows': full_rows,
+            'seconds': round(full_seconds, 3),
+            'clients_per_second': round(len(client_ids) / full_seconds),
+            'rebuild_rows': rebuild_rows,
+            'rebuild_seconds': round(rebuild_seconds, 3),
+            'refresh_rows': refresh_rows,
+            'refresh_seconds': round(refresh_seconds, 3),
+            'scored': scored,
+            'score_range': [min_score, max_score],
+            'score_avg': avg_score
+        },
+        'incremental': harness.summarize(latencies, incremental_wall, {'calls': args.incremental})
+    }
+    full = results['full']
+    print(f"полный пересчет: {full_rows} строк за {full['seconds']}s, "
+          f"повторно: {rebuild_rows} строк за {full['rebuild_seconds']}s, "
+          f"из признаков: {refresh_rows} строк за {full['refresh_seconds']}s, "
+          f"инкрементально p50={results['incremental']['p50_ms']:.2f}ms "
+          f"p99={results['incremental']['p99_ms']:.2f}ms", file=sys.stderr)
+
+    config = {'clients': args.clients, 'calls_per_client': args.calls_per_client, 'incremental': args.incremental}
+    print(f"Результаты: {harness.write_results('lead_scoring', results, config, args.output)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
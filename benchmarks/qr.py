@@ -0,0 +1,75 @@
+'''Бенчмарк генерации QR-кодов СБП: сколько QR в секунду выдает каждый способ и какого они размера.
+
+    python -m benchmarks.qr --iterations 500
+'''
+
+import argparse
+import base64
+import sys
+import time
+
+from benchmarks import harness
+
+
+def measure(fn, iterations: int, payments: list, description: str) -> dict:
+    latencies = []
+    size = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        result, elapsed_ms = harness.timed(fn, *payments[i % len(payments)], description)
+        latencies.append(elapsed_ms)
+        size = len(result)
+    wall_seconds = time.perf_counter() - started
+    summary = harness.summarize(latencies, wall_seconds, {'output_bytes': size})
+    summary['qr_per_second'] = summary.pop('throughput_rps')
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк генерации QR-кодов СБП')
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--distinct-payments', type=int, default=3,
+                        help='Сколько разных платежей чередовать (картинку платежа запрашивают повторно)')
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    sbp = harness.load_function('payment-sbp')
+    description = 'Подписка professional (monthly)'
+    payments = [(f'AVT-1-{1760000000 + i}', 990.0 + 1000 * i) for i in range(args.distinct_payments)]
+
+    def legacy_png(payment_id, amount, desc):
+        # Прежний путь: перебор масок, PNG box_size=10 через PIL, base64 в data URI на каждый платеж
+        import qrcode
+        from io import BytesIO
+
+        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
+        qr.add_data(sbp.build_sbp_url(payment_id, amount, desc))
+        qr.make(fit=True)
+        buffer = BytesIO()
+        qr.make_image(fill_color='black', back_color='white').save(buffer, format='PNG')
+        return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+    methods = {
+        'png_legacy_inline': legacy_png,
+        'png_compact_uncached': lambda payment_id, amount, desc: sbp.render_sbp_qr_png.__wrapped__(payment_id, amount, desc),
+        'svg_uncached': sbp.render_sbp_qr_svg.__wrapped__,
+        'svg_cached': sbp.render_sbp_qr_svg,
+    }
+
+    results = {}
+    for name, fn in methods.items():
+        try:
+            results[name] = measure(fn, args.iterations, payments, description)
+        except ImportError as e:
+            print(f'{name:<24} пропущен: {e}', file=sys.stderr)
+            continue
+        stats = results[name]
+        print(f"{name:<24} {stats['qr_per_second']:>10.1f} QR/s  p50={stats['p50_ms']:.3f}ms  "
+              f"size={stats['output_bytes']} B", file=sys.stderr)
+
+    config = {'iterations': args.iterations, 'distinct_payments': args.distinct_payments}
+    print(f"Результаты: {harness.write_results('qr', results, config, args.output)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
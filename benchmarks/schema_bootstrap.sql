@@ -0,0 +1,27 @@
+-- Таблицы, которые в production созданы вне db_migrations, но нужны миграциям и функциям.
+-- Применяется к пустой схеме перед миграциями V*.sql.
+CREATE TABLE IF NOT EXISTS plan_limits (
+    plan_type VARCHAR(50) PRIMARY KEY,
+    max_clients INTEGER,
+    max_calls_per_month INTEGER,
+    max_email_campaigns INTEGER,
+    ai_analysis_enabled BOOLEAN DEFAULT FALSE,
+    ai_suggestions_enabled BOOLEAN DEFAULT FALSE,
+    priority_support BOOLEAN DEFAULT FALSE,
+    price_monthly DECIMAL(10, 2) NOT NULL,
+    price_yearly DECIMAL(10, 2) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    plan_type VARCHAR(50) NOT NULL REFERENCES plan_limits(plan_type),
+    status VARCHAR(20) NOT NULL DEFAULT 'active',
+    start_date TIMESTAMP NOT NULL DEFAULT NOW(),
+    end_date TIMESTAMP NOT NULL,
+    auto_renew BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id);
@@ -0,0 +1,153 @@
+'''Создание локальной схемы из db_migrations и наполнение ее синтетическими данными для бенчмарков'''
+
+import glob
+import os
+
+from benchmarks.harness import REPO_ROOT
+
+SCHEMA = 't_p3568014_customer_engagement_'
+MIGRATIONS_DIR = os.path.join(REPO_ROOT, 'db_migrations')
+BOOTSTRAP_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_bootstrap.sql')
+
+# Колонки, которые используют функции, но которых нет в миграциях
+POST_MIGRATION_SQL = '''
+ALTER TABLE users ADD COLUMN IF NOT EXISTS full_name VARCHAR(255);
+'''
+
+TRANSCRIPT_WORDS = (
+    'здравствуйте', 'интересует', 'колодки', 'тормозные', 'фильтр', 'масляный', 'доставка',
+    'склад', 'цена', 'скидка', 'оптовый', 'заказ', 'счет', 'амортизатор', 'сцепление',
+    'оригинал', 'аналог', 'конкурент', 'перезвоните', 'завтра', 'договорились', 'отправьте'
+)
+
+
+def bench_dsn(base_dsn: str) -> str:
+    '''DSN, у которого search_path указывает на схему приложения'''
+    from psycopg2.extensions import make_dsn
+    return make_dsn(base_dsn, options=f'-c search_path={SCHEMA},public')
+
+
+def reset_schema(conn):
+    '''Пересоздает схему приложения и применяет все миграции по порядку'''
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        cursor.execute(f'CREATE SCHEMA {SCHEMA}')
+        cursor.execute(f'SET search_path TO {SCHEMA}, public')
+
+        with open(BOOTSTRAP_SQL, encoding='utf-8') as f:
+            cursor.execute(f.read())
+
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+            with open(path, encoding='utf-8') as f:
+                cursor.execute(f.read())
+
+        cursor.execute(POST_MIGRATION_SQL)
+    conn.commit()
+
+
+def seed(conn, users: int, clients: int, calls: int, payments: int):
+    '''Наполняет схему синтетическими данными заданного объема одним набором INSERT ... SELECT'''
+    words = '{' + ','.join(TRANSCRIPT_WORDS) + '}'
+
+    with conn.cursor() as cursor:
+        cursor.execute(f'SET search_path TO {SCHEMA}, public')
+
+        cursor.execute("""
+            INSERT INTO plan_limits (
+                plan_type, max_clients, max_calls_per_month, max_email_campaigns,
+                ai_analysis_enabled, ai_suggestions_enabled, priority_support,
+                price_monthly, price_yearly
+            ) VALUES
+                ('starter', 100, 500, 5, FALSE, FALSE, FALSE, 990, 9900),
+                ('professional', 1000, 5000, 50, TRUE, TRUE, FALSE, 2990, 29900),
+                ('enterprise', NULL, NULL, NULL, TRUE, TRUE, TRUE, 9990, 99900)
+            ON CONFLICT (plan_type) DO NOTHING
+        """)
+
+        cursor.execute("""
+            INSERT INTO users (
+                username, password_hash, email, phone, full_name,
+                session_token, token_expiry, email_verified, is_active
+            )
+            SELECT
+                'bench_user_' || i, 'x', 'bench_user_' || i || '@bench.local',
+                '+7900' || lpad(i::text, 7, '0'), 'Пользователь ' || i,
+                'bench_token_' || i, NOW() + INTERVAL '1 day', TRUE, TRUE
+            FROM generate_series(1, %s) AS i
+        """, (users,))
+
+        cursor.execute("""
+            INSERT INTO subscriptions (user_id, plan_type, status, start_date, end_date, auto_renew)
+            SELECT
+                u.id,
+                (ARRAY['starter', 'professional', 'enterprise'])[1 + u.id % 3],
+                'active',
+                NOW() - INTERVAL '20 days',
+                NOW() + (u.id % 30) * INTERVAL '1 day' + INTERVAL '1 hour',
+                u.id % 2 = 0
+            FROM users u
+            WHERE u.username LIKE 'bench_user_%'
+        """)
+
+        cursor.execute("""
+            INSERT INTO clients (name, email, phone, company, status, last_contact, created_at)
+            SELECT
+                'Клиент ' || i, 'client_' || i || '@bench.local',
+                '+7999' || lpad(i::text, 7, '0'), 'ООО Автодеталь ' || (i %% 500),
+                (ARRAY['hot', 'warm', 'cold'])[1 + i %% 3],
+                NOW() - random() * INTERVAL '90 days',
+                NOW() - random() * INTERVAL '365 days'
+            FROM generate_series(1, %s) AS i
+        """, (clients,))
+
+        cursor.execute("""
+            WITH bounds AS (SELECT min(id) AS lo, max(id) AS hi FROM clients)
+            INSERT INTO calls (client_id, status, duration, result, transcript, notes, recording_url, created_at)
+            SELECT
+                bounds.lo + floor(random() * (bounds.hi - bounds.lo + 1))::int,
+                (ARRAY['success', 'pending', 'failed'])[1 + i %% 3],
+                (i %% 15) || ':' || lpad((i %% 60)::text, 2, '0'),
+                'Звонок завершен',
+                (SELECT string_agg(w[1 + floor(random() * array_length(w, 1))::int], ' ')
+                 FROM generate_series(1, 40 + i %% 200) AS g(n), (SELECT %s::text[] AS w) words
+                 WHERE i IS NOT NULL),
+                CASE WHEN i %% 4 = 0 THEN 'ИИ-анализ: клиент заинтересован' END,
+                CASE WHEN i %% 5 = 0 THEN 'https://recordings.bench.local/' || i || '.ogg' END,
+                NOW() - random() * INTERVAL '180 days'
+            FROM generate_series(1, %s) AS i, bounds
+        """, (words, calls))
+
+        cursor.execute("""
+            WITH bounds AS (
+                SELECT min(id) AS lo, max(id) AS hi FROM users WHERE username LIKE 'bench_user_%%'
+            )
+            INSERT INTO payments (
+                user_id, amount, currency, payment_method, payment_system,
+                external_payment_id, status, metadata, created_at
+            )
+            SELECT
+                bounds.lo + floor(random() * (bounds.hi - bounds.lo + 1))::int,
+                2990, 'RUB', 'bank_card', 'yookassa',
+                'bench-payment-' || i,
+                (ARRAY['pending', 'succeeded', 'canceled'])[1 + i %% 3],
+                jsonb_build_object('plan_type', 'professional', 'billing_period', 'monthly'),
+                NOW() - random() * INTERVAL '365 days'
+            FROM generate_series(1, %s) AS i, bounds
+        """, (payments,))
+
+        cursor.execute('ANALYZE')
+    conn.commit()
+
+
+def prepare_database(base_dsn: str, users: int, clients: int, calls: int, payments: int) -> str:
+    '''Пересоздает и наполняет схему, возвращает DSN для обработчиков'''
+    import psycopg2
+
+    dsn = bench_dsn(base_dsn)
+    conn = psycopg2.connect(dsn)
+    try:
+        reset_schema(conn)
+        seed(conn, users=users, clients=clients, calls=calls, payments=payments)
+    finally:
+        conn.close()
+    return dsn
@@ -0,0 +1,136 @@
+'''Бенчмарк сериализации ответов списков: прежний путь с подготовкой строк против модуля serialization.
+
+    python -m benchmarks.serialization --rows 10000 --iterations 30
+
+Строки — RealDictRow того же вида, что отдают get_calls и get_payment_history; БД не нужна.
+'''
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from benchmarks import harness
+
+
+def make_calls(count: int, transcript_chars: int) -> list:
+    from psycopg2.extras import RealDictRow
+
+    rng = random.Random(42)
+    words = ('колодки', 'фильтр', 'масло', 'доставка', 'счет', 'скидка', 'Камри', 'Солярис', 'завтра', 'склад')
+    started = datetime(2026, 1, 1, 9, 0, 0)
+    rows = []
+    for i in range(count):
+        transcript = ' '.join(rng.choice(words) for _ in range(transcript_chars // 7))[:transcript_chars]
+        rows.append(RealDictRow({
+            'id': i + 1,
+            'client_id': rng.randint(1, count),
+            'status': rng.choice(('success', 'failed', 'pending')),
+            'duration': f'{rng.randint(0, 20)}:{rng.randint(0, 59):02d}',
+            'result': 'Звонок завершен',
+            'created_at': started + timedelta(seconds=37 * i, microseconds=rng.randint(0, 999999)),
+            'recording_url': f'https://records.example/{i}.mp3',
+            'transcript': transcript or None,
+            'notes': None,
+            'client_name': f'Клиент {i}',
+            'client_phone': f'+7999{i:07d}'
+        }))
+    return rows
+
+
+def make_payments(count: int) -> list:
+    from psycopg2.extras import RealDictRow
+
+    started = datetime(2026, 1, 1, 9, 0, 0)
+    return [
+        RealDictRow({
+            'id': i + 1,
+            'amount': Decimal('990.00') if i % 3 else Decimal('9900.00'),
+            'currency': 'RUB',
+            'payment_method': 'bank_card',
+            'status': 'succeeded',
+            'created_at': started + timedelta(minutes=i),
+            'plan_type': 'professional'
+        })
+        for i in range(count)
+    ]
+
+
+def legacy(rows: list, key: str, date_keys: tuple) -> bytes:
+    '''Прежний путь: isoformat() по строкам, копия каждой строки в dict, json.dumps(default=str)'''
+    for row in rows:
+        for date_key in date_keys:
+            if row[date_key] and not isinstance(row[date_key], str):
+                row[date_key] = row[date_key].isoformat()
+    return json.dumps({key: [dict(row) for row in rows]}, ensure_ascii=False, default=str).encode('utf-8')
+
+
+def measure(fn, make_rows, iterations: int) -> dict:
+    latencies = []
+    size = 0
+    wall_seconds = 0.0
+    for _ in range(iterations):
+        # Прежний путь меняет строки на месте, поэтому каждая итерация получает свежие
+        rows = make_rows()
+        started = time.perf_counter()
+        body = fn(rows)
+        elapsed = time.perf_counter() - started
+        wall_seconds += elapsed
+        latencies.append(elapsed * 1000)
+        size = len(body)
+    summary = harness.summarize(latencies, wall_seconds, {'body_bytes': size})
+    summary.pop('throughput_rps')
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк сериализации ответов списков')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--transcript-chars', type=int, default=600,
+                        help='Средняя длина транскрипции в строке звонка')
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    harness.load_function('crm-api')
+    import serialization
+
+    calls = make_calls(args.rows, args.transcript_chars)
+    payments = make_payments(args.rows)
+
+    def fresh_calls():
+        return [row.copy() for row in calls]
+
+    def fresh_payments():
+        return [row.copy() for row in payments]
+
+    methods = {
+        'legacy_prepass_json': lambda key, date_keys: lambda rows: legacy(rows, key, date_keys),
+        'python_fallback': lambda key, date_keys: lambda rows: serialization.dumps_bytes_python({key: rows}),
+        'orjson': lambda key, date_keys: lambda rows: serialization.dumps_bytes_orjson({key: rows}),
+    }
+    datasets = {
+        'calls': (fresh_calls, 'calls', ('created_at',)),
+        'payments': (fresh_payments, 'payments', ('created_at',)),
+    }
+
+    results = {}
+    for dataset, (make_rows, key, date_keys) in datasets.items():
+        for name, build in methods.items():
+            if name == 'orjson' and serialization.orjson is None:
+                print(f'{dataset}/{name:<20} пропущен: orjson не установлен', file=sys.stderr)
+                continue
+            scenario = f'{dataset}/{name}'
+            results[scenario] = stats = measure(build(key, date_keys), make_rows, args.iterations)
+            print(f"{scenario:<32} p50={stats['p50_ms']:>8.2f}ms  p95={stats['p95_ms']:>8.2f}ms  "
+                  f"body={stats['body_bytes']} B", file=sys.stderr)
+
+    config = {'rows': args.rows, 'iterations': args.iterations, 'transcript_chars': args.transcript_chars}
+    print(f"Результаты: {harness.write_results('serialization', results, config, args.output)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+'''Конкурентный тест вебхука ЮKassa: параллельные дубликаты одного уведомления на локальной PostgreSQL.
+
+Для каждого раунда создается платеж в статусе pending, после чего --duplicates
+потоков одновременно доставляют один и тот же payment.succeeded. После раунда
+проверяется, что создана ровно одна подписка, она единственная активная и платеж привязан к ней.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/avt_bench \\
+        python -m benchmarks.webhook_race --rounds 20 --duplicates 16
+
+Данные берутся из схемы бенчмарков (python -m benchmarks.handlers наполняет ее).
+Код выхода 1, если хотя бы в одном раунде инвариант нарушен.
+'''
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from benchmarks import harness
+from benchmarks.seed import bench_dsn
+
+
+def run_round(payment_api, conn, user_id: int, duplicates: int, round_no: int) -> dict:
+    external_id = f'race-{os.getpid()}-{round_no}-{time.monotonic_ns()}'
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO payments (user_id, amount, currency, payment_system, external_payment_id, status, metadata)
+            VALUES (%s, 2990, 'RUB', 'yookassa', %s, 'pending', %s)
+            RETURNING clock_timestamp()
+        """, (user_id, external_id, json.dumps({'plan_type': 'professional', 'billing_period': 'monthly'})))
+        round_started = cursor.fetchone()[0]
+    conn.commit()
+
+    event = harness.make_event('POST', {'path': 'yookassa_webhook'}, {
+        'event': 'payment.succeeded',
+        'object': {'id': external_id, 'status': 'succeeded'}
+    })
+    barrier = threading.Barrier(duplicates)
+    latencies = [0.0] * duplicates
+    messages = [None] * duplicates
+
+    def deliver(index):
+        barrier.wait()
+        response, latencies[index] = harness.timed(payment_api.handler, dict(event), None)
+        body = json.loads(response['body'])
+        messages[index] = body.get('message') or body.get('error')
+
+    threads = [threading.Thread(target=deliver, args=(i,)) for i in range(duplicates)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM subscriptions WHERE user_id = %(user_id)s AND status = 'active') AS active,
+                (SELECT COUNT(*) FROM subscriptions
+                 WHERE user_id = %(user_id)s AND created_at >= %(round_started)s) AS created,
+                (SELECT COUNT(*) FROM subscriptions s JOIN payments p ON p.subscription_id = s.id
+                 WHERE p.external_payment_id = %(external_id)s AND s.status = 'active') AS linked
+        """, {'user_id': user_id, 'external_id': external_id, 'round_started': round_started})
+        active, created, linked = cursor.fetchone()
+    conn.commit()
+
+    return {
+        'active_subscriptions': active,
+        'created_subscriptions': created,
+        'linked': linked,
+        'processed': messages.count('Webhook processed'),
+        'skipped': messages.count('Webhook already processed'),
+        'latencies': latencies,
+        'wall_seconds': wall_seconds
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Параллельные дубликаты вебхука ЮKassa')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--duplicates', type=int, default=16)
+    parser.add_argument('--output', help='Путь к JSON с результатами')
+    args = parser.parse_args(argv)
+
+    if not args.dsn:
+        parser.error('укажите --dsn или BENCH_DATABASE_URL')
+
+    import psycopg2
+
+    dsn = bench_dsn(args.dsn)
+    os.environ['DATABASE_URL'] = dsn
+    os.environ['INSTRUMENTATION'] = 'off'
+    payment_api = harness.load_function('payment-api')
+
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id FROM users ORDER BY id LIMIT %s", (args.rounds,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+    if not user_ids:
+        parser.error('в схеме бенчмарков нет пользователей, сначала запустите benchmarks.handlers')
+
+    latencies = []
+    violations = 0
+    processed = skipped = 0
+    wall_seconds = 0.0
+    for round_no in range(args.rounds):
+        user_id = user_ids[round_no % len(user_ids)]
+        outcome = run_round(payment_api, conn, user_id, args.duplicates, round_no)
+        latencies.extend(outcome['latencies'])
+        wall_seconds += outcome['wall_seconds']
+        processed += outcome['processed']
+        skipped += outcome['skipped']
+        if outcome['active_subscriptions'] != 1 or outcome['created_subscriptions'] != 1 or outcome['linked'] != 1:
+            violations += 1
+            print(f"раунд {round_no}: user {user_id} активных подписок={outcome['active_subscriptions']}, "
+                  f"создано={outcome['created_subscriptions']}, привязано={outcome['linked']}", file=sys.stderr)
+    conn.close()
+
+    results = {'webhook_duplicates': harness.summarize(latencies, wall_seconds, {
+        'rounds': args.rounds,
+        'duplicates': args.duplicates,
+        'processed': processed,
+        'skipped': skipped,
+        'violations': violations
+    })}
+    stats = results['webhook_duplicates']
+    print(f"раундов={args.rounds} дубликатов={args.duplicates} обработано={processed} пропущено={skipped} "
+          f"нарушений={violations} p50={stats['p50_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms", file=sys.stderr)
+
+    config = {'rounds': args.rounds, 'duplicates': args.duplicates}
+    print(f"Результаты: {harness.write_results('webhook_race', results, config, args.output)}", file=sys.stderr)
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+-- Полнотекстовый поиск по транскрипциям, ИИ-заметкам и результатам звонков
+ALTER TABLE calls ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('russian', coalesce(result, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(notes, '')), 'B') ||
+        setweight(to_tsvector('russian', coalesce(transcript, '')), 'C')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_calls_search_vector ON calls USING GIN (search_vector);
+
+-- Keyset-пагинация по свежести результатов
+CREATE INDEX IF NOT EXISTS idx_calls_created_at_id ON calls (created_at DESC, id DESC);
@@ -0,0 +1,28 @@
+-- Компания клиента используется в ИИ-анализе и импорте из ERP
+ALTER TABLE clients ADD COLUMN IF NOT EXISTS company VARCHAR(255);
+
+-- Дубли email без учета регистра миграция не сливает: это решение по данным клиентов.
+-- Если они есть, миграция останавливается и перечисляет id, которые нужно объединить вручную
+DO $$
+DECLARE
+    conflicts TEXT;
+BEGIN
+    SELECT string_agg(duplicate, '; ') INTO conflicts
+    FROM (
+        SELECT lower(email) || ': ' || string_agg(id::text, ', ' ORDER BY id) AS duplicate
+        FROM clients
+        WHERE email <> ''
+        GROUP BY lower(email)
+        HAVING COUNT(*) > 1
+        ORDER BY lower(email)
+        LIMIT 100
+    ) duplicates;
+
+    IF conflicts IS NOT NULL THEN
+        RAISE EXCEPTION 'clients share an email (case-insensitive), merge them before creating uq_clients_email: %', conflicts;
+    END IF;
+END $$;
+
+-- Уникальный email без учета регистра служит ключом слияния при массовом импорте (ON CONFLICT);
+-- хранимые адреса не переписываются, импорт приводит входящие к нижнему регистру
+CREATE UNIQUE INDEX IF NOT EXISTS uq_clients_email ON clients(lower(email)) WHERE email <> '';
@@ -0,0 +1,18 @@
+-- Счетчики использования тарифных лимитов: period = 'YYYY-MM' для месячных лимитов, 'total' для накопительных
+CREATE TABLE IF NOT EXISTS usage_counters (
+    user_id INTEGER NOT NULL,
+    metric VARCHAR(30) NOT NULL,
+    period VARCHAR(7) NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, metric, period)
+);
+
+-- Владелец записей, по которым сверяются счетчики
+ALTER TABLE clients ADD COLUMN IF NOT EXISTS user_id INTEGER;
+ALTER TABLE calls ADD COLUMN IF NOT EXISTS user_id INTEGER;
+ALTER TABLE email_campaigns ADD COLUMN IF NOT EXISTS user_id INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_clients_user_id ON clients(user_id) WHERE user_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_calls_user_id_created_at ON calls(user_id, created_at) WHERE user_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_email_campaigns_user_id_created_at ON email_campaigns(user_id, created_at) WHERE user_id IS NOT NULL;
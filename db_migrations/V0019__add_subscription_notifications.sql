@@ -0,0 +1,14 @@
+-- Состояние уведомлений об окончании подписки: одна строка на подписку и порог (7/3/1 дней)
+CREATE TABLE IF NOT EXISTS subscription_notifications (
+    subscription_id INTEGER NOT NULL REFERENCES subscriptions(id),
+    threshold_days SMALLINT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 1,
+    sent_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (subscription_id, threshold_days)
+);
+
+-- Выборка истекающих подписок и массовое истечение читают только активные подписки по end_date
+CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end_date ON subscriptions(status, end_date) WHERE status = 'active';
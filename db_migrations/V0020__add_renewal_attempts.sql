@@ -0,0 +1,19 @@
+-- Попытки автопродления: одна строка на подписку и продлеваемый период, служит захватом для воркеров
+CREATE TABLE IF NOT EXISTS renewal_attempts (
+    id SERIAL PRIMARY KEY,
+    subscription_id INTEGER NOT NULL REFERENCES subscriptions(id),
+    period_end TIMESTAMP NOT NULL,
+    idempotence_key VARCHAR(64) NOT NULL UNIQUE,
+    status VARCHAR(20) NOT NULL DEFAULT 'claimed' CHECK (status IN ('claimed', 'created', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 1,
+    claimed_by VARCHAR(100),
+    claimed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    payment_id INTEGER REFERENCES payments(id),
+    external_payment_id VARCHAR(255),
+    error TEXT,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE (subscription_id, period_end)
+);
+
+CREATE INDEX IF NOT EXISTS idx_renewal_attempts_status ON renewal_attempts(status, updated_at);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_auto_renew_end_date ON subscriptions(end_date) WHERE status = 'active' AND auto_renew = TRUE;
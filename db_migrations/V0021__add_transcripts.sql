@@ -0,0 +1,14 @@
+-- Кэш транскрипций записей звонков: одна строка на URL записи, захват на время распознавания
+CREATE TABLE IF NOT EXISTS transcripts (
+    id SERIAL PRIMARY KEY,
+    recording_url TEXT NOT NULL UNIQUE,
+    content_hash CHAR(64),
+    transcript TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'done', 'failed')),
+    claimed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Та же запись под другим URL находится по хэшу содержимого
+CREATE INDEX IF NOT EXISTS idx_transcripts_content_hash ON transcripts(content_hash) WHERE status = 'done';
@@ -0,0 +1,17 @@
+-- Разговоры, идущие по сценарию: состояние — номер шага в скомпилированном сценарии версии version
+CREATE TABLE IF NOT EXISTS scenario_runs (
+    id BIGSERIAL PRIMARY KEY,
+    scenario_id BIGINT NOT NULL REFERENCES scenarios(id) ON DELETE CASCADE,
+    client_id INTEGER REFERENCES clients(id),
+    call_id INTEGER REFERENCES calls(id),
+    step SMALLINT NOT NULL DEFAULT 0,
+    turns SMALLINT NOT NULL DEFAULT 0,
+    status VARCHAR(20) NOT NULL DEFAULT 'active' CHECK (status IN ('active', 'completed', 'abandoned')),
+    version TIMESTAMP NOT NULL,
+    started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Пересчет номеров шагов при сохранении сценария затрагивает только активные разговоры
+CREATE INDEX IF NOT EXISTS idx_scenario_runs_active ON scenario_runs(scenario_id) WHERE status = 'active';
+CREATE INDEX IF NOT EXISTS idx_scenario_runs_client ON scenario_runs(client_id, started_at DESC);
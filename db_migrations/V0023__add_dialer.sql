@@ -0,0 +1,38 @@
+-- Обзвон сегмента клиентов: кампания с бюджетом звонков и общая для воркеров очередь
+CREATE TABLE IF NOT EXISTS dial_campaigns (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    user_id INTEGER,
+    segment JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'paused', 'completed', 'cancelled')),
+    concurrency INTEGER NOT NULL DEFAULT 5 CHECK (concurrency > 0),
+    calls_per_minute INTEGER NOT NULL DEFAULT 30 CHECK (calls_per_minute > 0),
+    -- Ведро токенов: пополняется со скоростью calls_per_minute, вмещает не больше concurrency
+    tokens REAL NOT NULL DEFAULT 0,
+    tokens_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    total INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS dial_queue (
+    id BIGSERIAL PRIMARY KEY,
+    campaign_id INTEGER NOT NULL REFERENCES dial_campaigns(id) ON DELETE CASCADE,
+    client_id INTEGER NOT NULL REFERENCES clients(id),
+    phone VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'dialing', 'done', 'failed')),
+    call_id INTEGER REFERENCES calls(id),
+    claimed_by VARCHAR(100),
+    claimed_at TIMESTAMP,
+    error TEXT,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE (campaign_id, client_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_dial_queue_pending ON dial_queue(campaign_id, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_dial_queue_dialing ON dial_queue(campaign_id, claimed_at) WHERE status = 'dialing';
+CREATE INDEX IF NOT EXISTS idx_dial_campaigns_running ON dial_campaigns(id) WHERE status = 'running';
+
+-- Сегмент кампании выбирается по статусу и окну последнего контакта
+CREATE INDEX IF NOT EXISTS idx_clients_status_last_contact ON clients(status, last_contact);
@@ -0,0 +1,19 @@
+-- Скоринг лидов: признаки по звонкам и письмам и итоговый балл, по строке на клиента.
+-- Балл хранится здесь, а не в clients: массовый пересчет переписывает узкую таблицу
+-- с двумя индексами вместо широкой clients со всеми ее индексами
+CREATE TABLE IF NOT EXISTS lead_scores (
+    client_id INTEGER PRIMARY KEY REFERENCES clients(id) ON DELETE CASCADE,
+    calls_total INTEGER NOT NULL DEFAULT 0,
+    calls_success INTEGER NOT NULL DEFAULT 0,
+    talk_seconds INTEGER NOT NULL DEFAULT 0,
+    last_call_at TIMESTAMP,
+    emails_sent INTEGER NOT NULL DEFAULT 0,
+    emails_opened INTEGER NOT NULL DEFAULT 0,
+    emails_clicked INTEGER NOT NULL DEFAULT 0,
+    last_email_at TIMESTAMP,
+    score SMALLINT,
+    scored_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_lead_scores_score ON lead_scores(score DESC NULLS LAST, client_id);
@@ -0,0 +1,44 @@
+-- Исходы звонков по часам недели (0 = понедельник 00:00 по Москве) для клиента и для сегмента
+-- (статуса клиента на момент звонка). Счетчики пополняются при завершении звонка
+CREATE TABLE IF NOT EXISTS client_contact_hours (
+    client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+    hour_of_week SMALLINT NOT NULL CHECK (hour_of_week BETWEEN 0 AND 167),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (client_id, hour_of_week)
+);
+
+CREATE TABLE IF NOT EXISTS segment_contact_hours (
+    segment VARCHAR(20) NOT NULL,
+    hour_of_week SMALLINT NOT NULL CHECK (hour_of_week BETWEEN 0 AND 167),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (segment, hour_of_week)
+);
+
+-- Звонок учитывается в статистике один раз, повторный вебхук о завершении его не удваивает
+ALTER TABLE calls ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP;
+
+-- Уже завершенные звонки считаем завершенными в момент создания и заполняем статистику по ним
+UPDATE calls SET completed_at = created_at WHERE status <> 'pending' AND completed_at IS NULL;
+
+INSERT INTO client_contact_hours (client_id, hour_of_week, attempts, successes)
+SELECT
+    client_id,
+    ((EXTRACT(ISODOW FROM local_at) - 1) * 24 + EXTRACT(HOUR FROM local_at))::smallint AS hour_of_week,
+    COUNT(*),
+    COUNT(*) FILTER (WHERE status = 'success')
+FROM (
+    SELECT client_id, status, (created_at AT TIME ZONE 'UTC') AT TIME ZONE 'Europe/Moscow' AS local_at
+    FROM calls
+    WHERE completed_at IS NOT NULL
+) c
+GROUP BY 1, 2
+ON CONFLICT (client_id, hour_of_week) DO NOTHING;
+
+INSERT INTO segment_contact_hours (segment, hour_of_week, attempts, successes)
+SELECT cl.status, h.hour_of_week, SUM(h.attempts), SUM(h.successes)
+FROM client_contact_hours h
+JOIN clients cl ON cl.id = h.client_id
+GROUP BY 1, 2
+ON CONFLICT (segment, hour_of_week) DO NOTHING;
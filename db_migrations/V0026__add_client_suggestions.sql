@@ -0,0 +1,38 @@
+-- Утренний список дел: задание подбирает следующий шаг для каждого клиента сегмента
+CREATE TABLE IF NOT EXISTS suggestion_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER,
+    segment JSONB NOT NULL DEFAULT '{}',
+    calls_per_client SMALLINT NOT NULL DEFAULT 5 CHECK (calls_per_client BETWEEN 1 AND 20),
+    concurrency SMALLINT NOT NULL DEFAULT 4 CHECK (concurrency > 0),
+    status VARCHAR(20) NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'completed')),
+    total INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    cached INTEGER NOT NULL DEFAULT 0,
+    -- Клиенты обходятся по возрастанию id; задание выполняет один воркер, пока не истекла аренда
+    last_client_id INTEGER NOT NULL DEFAULT 0,
+    leased_until TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS client_suggestions (
+    id BIGSERIAL PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES suggestion_jobs(id) ON DELETE CASCADE,
+    client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+    -- Балл лида на момент подбора; клиенты без балла идут в конце списка
+    score SMALLINT NOT NULL DEFAULT 0,
+    prompt_hash CHAR(64) NOT NULL,
+    suggestion TEXT,
+    status VARCHAR(20) NOT NULL CHECK (status IN ('done', 'failed')),
+    error TEXT,
+    cached BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE (job_id, client_id)
+);
+
+-- Дашборд листает список по убыванию балла лида
+CREATE INDEX IF NOT EXISTS idx_client_suggestions_job_score ON client_suggestions(job_id, score DESC, client_id);
+-- Тот же промпт (клиент без новых звонков) не отправляется в модель повторно
+CREATE INDEX IF NOT EXISTS idx_client_suggestions_prompt_hash ON client_suggestions(prompt_hash, created_at) WHERE status = 'done';
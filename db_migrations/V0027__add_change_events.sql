@@ -0,0 +1,18 @@
+-- Транзакционный outbox: каждое изменение клиентов, звонков, платежей и подписок пишет сюда
+-- компактное событие в той же транзакции. txid — номер записавшей транзакции (txid_current()):
+-- читатели отдают события в порядке (txid, id) и только транзакций старше горизонта снимка,
+-- поэтому событие, закоммиченное позже соседей с большим id, не пропускается
+CREATE TABLE IF NOT EXISTS change_events (
+    id BIGSERIAL PRIMARY KEY,
+    txid BIGINT NOT NULL,
+    entity VARCHAR(20) NOT NULL CHECK (entity IN ('client', 'call', 'payment', 'subscription')),
+    op VARCHAR(10) NOT NULL CHECK (op IN ('insert', 'update', 'delete')),
+    entity_id INTEGER NOT NULL,
+    user_id INTEGER,
+    -- Только изменившиеся поля; для вставки — поля, которые отдают списочные эндпоинты
+    data JSONB NOT NULL DEFAULT '{}',
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_change_events_txid ON change_events(txid, id);
+CREATE INDEX IF NOT EXISTS idx_change_events_user ON change_events(user_id, txid, id) WHERE user_id IS NOT NULL;
@@ -0,0 +1,11 @@
+-- Счетчики версий для данных, изменения которых не попадают в change_events построчно:
+-- массовый пересчет баллов лидов и кампании рассылок. Вместе с последним событием outbox
+-- служат дешевым ETag списков и статистики
+CREATE TABLE IF NOT EXISTS data_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO data_versions (name) VALUES ('lead_scores'), ('email_campaigns')
+ON CONFLICT (name) DO NOTHING;
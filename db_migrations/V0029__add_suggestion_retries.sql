@@ -0,0 +1,8 @@
+-- Границы сегмента фиксируются при создании задания: no_contact_days иначе пересчитывался
+-- бы от текущего времени на каждом продолжении, и состав сегмента расходился бы с total
+ALTER TABLE suggestion_jobs ADD COLUMN IF NOT EXISTS segment_bounds JSONB;
+
+-- Неудачные подсказки повторяются до SUGGESTION_MAX_ATTEMPTS раз, прежде чем задание завершится
+ALTER TABLE client_suggestions ADD COLUMN IF NOT EXISTS attempts SMALLINT NOT NULL DEFAULT 1;
+
+CREATE INDEX IF NOT EXISTS idx_client_suggestions_failed ON client_suggestions(job_id, client_id) WHERE status = 'failed';